@@ -152,9 +152,16 @@ elseif sar == 1
 endif
 fclose(fid_output);
 
-% extra
-savename_2 = strrep(inputfile,'.txt','_temage.mat');
-save(savename_2 , 'tempage', '-v7')
+% extra: iteration results for LANDO as raw binary file (little-endian), which is memory-mapped by AggDataUndatable
+% header (24 bytes): 'LANDOAGE' (8 x char), version, number of depths, number of iterations, 0 (4 x uint32)
+% followed by the depths (number of depths x float64) and the ages (float32, depth by depth, i.e. all iterations of the first depth first)
+savename_2 = strrep(inputfile,'.txt','_temage.bin');
+fid_temage = fopen(savename_2,'w','ieee-le');
+fwrite(fid_temage,'LANDOAGE','char*1');
+fwrite(fid_temage,[1, size(tempage,1), size(tempage,2), 0],'uint32');
+fwrite(fid_temage,depthrange,'float64');
+fwrite(fid_temage,tempage','float32');
+fclose(fid_temage);
 
 end % end function
 
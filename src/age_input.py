@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Module within LANDO to normalize age determination data from database or file column by column
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import numpy as np
+import pandas as pd
+import datetime
+import ipysheet
+from IPython.display import display
+from psycopg2.extras import NumericRange
+
+#### Values of the artificial surface sample that are the same for every core
+SURFACE_SAMPLE = {'thickness': 0,
+                  'lab_location': 'NaN',
+                  'material_category': 'other',
+                  'material_description': 'derived surface age',
+                  'material_weight': 'NaN',
+                  'pretreatment_dating': 'None',
+                  'reservoir_age': 0,
+                  'reservoir_error': 0}
+#### Calibration curves that can be selected
+CALIBRATION_CURVES = ['IntCal20', 'Marine20', 'SHCal20', 'none']
+#### Calibration curve of every radiocarbon material category within the boundaries of the curves; 'default' is the
+#### default curve of the user and 'hemisphere' the atmospheric curve of the hemisphere
+CALIBRATION_RULES = {'14C sediment': 'default',
+                     '14C terrestrial fossil': 'hemisphere',
+                     '14C marine fossil': 'Marine20'}
+HEMISPHERE_CURVES = {'NH': 'IntCal20', 'SH': 'SHCal20'}
+#### Boundaries of the calibration curves (yr BP) for the age minus reservoir age
+CALIBRATION_BOUNDS = (75, 50000)
+
+
+def age_bounds(values):
+    """
+    Function to get the lower and upper bound of ages, either from NumericRange objects of the database or from
+    the values of an input file, where detection limits are written as '>value' (lower bound) or '<value' (upper bound)
+
+    parameters:
+    @values: series with NumericRange objects, numbers or strings
+
+    returns:
+    @bounds: dataframe with the float columns lower and upper and the index of values; open bounds and values
+    that are not ages are NaN
+    """
+    values = pd.Series(values, dtype = object)
+    bounds = pd.DataFrame({'lower': np.nan, 'upper': np.nan}, index = values.index)
+    is_range = np.fromiter((isinstance(value, NumericRange) for value in values), dtype = bool, count = len(values))
+    if is_range.any():
+        ranges = values[is_range]
+        bounds.loc[is_range, 'lower'] = pd.to_numeric(pd.Series([value.lower for value in ranges], index = ranges.index, dtype = object))
+        bounds.loc[is_range, 'upper'] = pd.to_numeric(pd.Series([value.upper for value in ranges], index = ranges.index, dtype = object))
+    if not is_range.all():
+        #### Detection limits keep the number after the sign, which is cut to an integer as in the database
+        parts = values[~is_range].astype(str).str.extract(r'^\s*([<>]?)\s*(.*?)\s*$')
+        number = np.trunc(pd.to_numeric(parts[1], errors = 'coerce'))
+        bounds.loc[~is_range, 'lower'] = number.where(parts[0] != '<')
+        bounds.loc[~is_range, 'upper'] = number.where(parts[0] != '>')
+    return bounds
+
+def exact_ages(data, column = 'age'):
+    """
+    Function to keep only the rows with an exact age (lower bound equal to upper bound), whose bound becomes the age;
+    ages with a detection limit and missing ages are dropped
+
+    parameters:
+    @data: dataframe with age determination data
+    @column: name of the column with the ages; default value: 'age'
+
+    returns:
+    @data: dataframe with the rows of exact ages and the original index; the ages are integers if all of them are whole numbers
+    """
+    bounds = age_bounds(data[column])
+    exact = (bounds['lower'] == bounds['upper']).to_numpy()
+    data = data[exact].copy()
+    ages = bounds.loc[exact, 'upper']
+    if len(ages) and (ages == np.trunc(ages)).all():
+        ages = ages.astype(np.int64)
+    data[column] = ages
+    return data
+
+def surface_samples(expedition, columns, surface_uncertainty = 5):
+    """
+    Function to create the artificial surface samples of all cores at once, dated to the expedition year
+
+    parameters:
+    @expedition: dataframe with the columns coreid and expeditionyear
+    @columns: columns of the age determination data, in which the surface samples are returned
+    @surface_uncertainty: age uncertainty of the surface samples; default value: 5
+
+    returns:
+    @surface: dataframe with one surface sample per core, flagged in the column is_surface
+    """
+    coreid = expedition['coreid'].astype(str).reset_index(drop = True)
+    surface = pd.DataFrame({'coreid': coreid,
+                            'compositedepth': 0.0,
+                            'measurementid': coreid + ' 0',
+                            'labid': coreid + '_Surface',
+                            'age': 1950 - expedition['expeditionyear'].astype(int).to_numpy(),
+                            'age_error': surface_uncertainty,
+                            **SURFACE_SAMPLE,
+                            'is_surface': True})
+    return surface.reindex(columns = columns)
+
+def surface_mask(all_ages):
+    """
+    Function to find the artificial surface samples, from the column is_surface or, for age determination data
+    from earlier versions, from the LabID ('<CoreID>_Surface')
+
+    returns:
+    @surface: boolean array marking the surface samples
+    """
+    if 'is_surface' in all_ages.columns:
+        return all_ages['is_surface'].fillna(False).to_numpy(dtype = bool)
+    return all_ages['labid'].astype(str).str.contains('_Surface', regex = False).to_numpy()
+
+def calibration_curves(all_ages, default_curve = 'IntCal20', hemisphere = 'NH'):
+    """
+    Function to select the calibration curve of every age from material category, age, reservoir age and errors;
+    radiocarbon ages (minus reservoir age) that are within the boundaries of the calibration curves and whose lower
+    error bound is older than today get the curve of their category, everything else including the surface samples gets 'none'
+    
+    parameters:
+    @all_ages: dataframe with age determination data
+    @default_curve: string with calibration curve for 14C sediment samples, such as 'IntCal20', 'Marine20', 'SHCal20', or 'none'; default value: 'IntCal20'
+    @hemisphere: string with abbreviation of hemisphere from which the samples are from - 'NH' for Northern Hemisphere or 'SH' for Southern Hemisphere; default value: 'NH'
+    
+    returns:
+    @curves: series with the calibration curve of every row and the index of all_ages
+    """
+    check_curves = [ele for ele in CALIBRATION_CURVES if (ele in default_curve)]
+    if bool(check_curves) == False:
+        raise Exception("Please provide one of the following curves as default curve: 'IntCal20', 'Marine20', 'SHCal20', or 'none'")
+    if hemisphere not in HEMISPHERE_CURVES:
+        raise Exception("Please provie one of the following abbreviations for hemisphere: 'NH' for Northern Hemisphere or 'SH' for Southern Hemisphere")
+    outcomes = {'default': default_curve, 'hemisphere': HEMISPHERE_CURVES[hemisphere]}
+    age = pd.to_numeric(all_ages['age'], errors = 'coerce') - pd.to_numeric(all_ages['reservoir_age'], errors = 'coerce')
+    error = pd.to_numeric(all_ages['age_error'], errors = 'coerce') + pd.to_numeric(all_ages['reservoir_error'], errors = 'coerce')
+    in_bounds = ((age > CALIBRATION_BOUNDS[0]) & (age <= CALIBRATION_BOUNDS[1]) & 
+                 ((age - error) > (1950 - datetime.datetime.now().year))).to_numpy()
+    surface = (all_ages['material_description'] == 'derived surface age').to_numpy()
+    category = all_ages['material_category']
+    conditions = [~surface & in_bounds & (category == material).to_numpy() for material in CALIBRATION_RULES]
+    choices = [outcomes.get(curve, curve) for curve in CALIBRATION_RULES.values()]
+    return pd.Series(np.select(conditions, choices, default = 'none'), index = all_ages.index, dtype = object)
+
+def calibration_sheet(all_ages):
+    """
+    Function to show the age determination data without the surface samples as sheet widget, in which the 
+    calibration curve of every age can be changed by the user
+
+    parameters:
+    @all_ages: dataframe with age determination data and the column calibration_curve (see calibration_curves)
+
+    returns:
+    @sheet: sheet widget with the columns MeasurementID, LabID, Category, Material, Uncalibrated Age (yr BP),
+    Uncalibrated Age Error (+/- yr) and Calibration Curve
+    """
+    col_for_selection = ['measurementid',
+                         'labid',
+                         'material_category', 
+                         'material_description', 
+                         'age', 
+                         'age_error', 
+                         'calibration_curve']
+    view_ages = all_ages[~surface_mask(all_ages)].copy()
+    view_ages = view_ages[col_for_selection]
+    view_ages.reset_index(inplace = True, drop = True)
+    sheet = ipysheet.from_dataframe(view_ages)
+    col_headers = ['MeasurementID',
+                   'LabID',
+                   'Category',
+                   'Material',
+                   'Uncalibrated Age (yr BP)',
+                   'Uncalibrated Age Error (+/- yr)',
+                   'Calibration Curve'
+                  ]
+    sheet.column_headers = col_headers
+    for header in range(len(col_headers)):
+        if header == col_headers.index('Calibration Curve'):
+            sheet.cells[header].style['backgroundColor'] = '#eefbdd'
+            sheet.cells[header].choice = CALIBRATION_CURVES
+            sheet.cells[header].type = 'dropdown'
+            sheet.cells[header].send_state()
+        else:
+            sheet.cells[header].read_only = True
+            sheet.cells[header].squeeze_column = True
+            sheet.cells[header].textAlign = 'right'
+            sheet.cells[header].send_state()
+    display(sheet)
+    return sheet
@@ -20,29 +20,49 @@ import os
 import datetime
 import copy
 import math
+from .measurement_keys import depth_keys, frame_keys, has_key_index, select_cores
+from .summary_stats import confidence_intervals, pooled_iterations
+from .ragged_iterations import to_ragged
+from .sedi_rate import sed_rate_array
 
 class PlotAgeSR(object):
-    def __init__(self, plot_data, coreid, dttp):
+    def __init__(self, plot_data, coreid, dttp, iterations = None, weights = None, n_draws = 10000, seed = None):
         """
         parameters:
         @self.model_plot_data: dictionary with aggregated age and sedimentation rate results indexed by modeling software
         @self.coreid: list of CoreIDs used within the LANDO environmen
         @self.dttp: value 'Yes' or 'No', if reservoir correction took place
+        @self.iterations: dictionary with the iteration results (e.g. Bacon_core_results) indexed by modeling software; 
+        if given, the combined model is the pooled posterior of the iterations of all models instead of the mean 
+        and the outer sigma boundaries of the aggregated results; default value: None
+        @self.weights: dictionary with the weight of each modeling software in the pooled posterior; default value: None 
+        (every model contributes equally)
+        @self.n_draws: number of iterations of the pooled posterior per sediment core; default value: 10000
+        @self.seed: seed for drawing the iterations of the pooled posterior; default value: None
         """
         self.model_plot_data = copy.deepcopy(plot_data)
         self.coreid = coreid
         self.dttp = dttp
+        self.iterations = iterations
+        self.weights = weights
+        self.n_draws = n_draws
+        self.seed = seed
         
     def __prep_for_plot(self, data, input_type = 'SR'):
         """
-        Helper function to split MeasurementID into CoreID and composite depth and 
-        ensuring the correct data type is assigned to each column
+        Helper function to add CoreID and composite depth as columns, taken from the key index of the results 
+        (or split from MeasurementID), and ensuring the correct data type is assigned to each column
         
         returns:
         @data: dataframe with new columns 'coreid' and 'compositedepth', sorted by both columns 
         and assigning float as column type for numeric columns
         """
-        data[['coreid','compositedepth']] = data['measurementid'].str.split(' ', n = 1, expand = True)
+        #### Results that carry the key index in order do not have to be sorted again
+        in_order = has_key_index(data) and data.index.is_monotonic_increasing
+        keys = frame_keys(data)
+        data.reset_index(drop = True, inplace = True)
+        data['coreid'] = keys['coreid']
+        data['compositedepth'] = keys['compositedepth']
         if input_type == 'age':
             data = data.astype(dtype = {'compositedepth': float,
                                         'modeloutput_mean': float,
@@ -60,7 +80,8 @@ class PlotAgeSR(object):
                                         'SR_upper_1_sigma': float,
                                         'SR_upper_2_sigma': float})
             
-        data = data.sort_values(by = ['coreid','compositedepth'], ignore_index = True)
+        if not in_order:
+            data = data.sort_values(by = ['coreid','compositedepth'], ignore_index = True)
         
         return data
     
@@ -86,8 +107,8 @@ class PlotAgeSR(object):
                 self.Un_SR_data.replace(0, np.nan, inplace = True)
                 self.Un_SR_data['compositedepth'] = self.Un_SR_data['compositedepth'].replace(np.nan, 0)
                 if len(self.coreid) == 1:
-                    self.Un_Age_data = self.Un_Age_data[self.Un_Age_data.coreid.str.contains(self.coreid[0])]
-                    self.Un_SR_data = self.Un_SR_data[self.Un_SR_data.coreid.str.contains(self.coreid[0])]
+                    self.Un_Age_data = self.Un_Age_data[self.Un_Age_data.coreid == self.coreid[0]]
+                    self.Un_SR_data = self.Un_SR_data[self.Un_SR_data.coreid == self.coreid[0]]
                 self.age_data.append(self.Un_Age_data)
                 self.SR_data.append(self.Un_SR_data)
             elif key == 'Bchron':
@@ -96,8 +117,8 @@ class PlotAgeSR(object):
                 self.Bc_SR_data.replace(0, np.nan, inplace = True)
                 self.Bc_SR_data['compositedepth'] = self.Bc_SR_data['compositedepth'].replace(np.nan, 0)
                 if len(self.coreid) == 1:
-                    self.Bc_Age_data = self.Bc_Age_data[self.Bc_Age_data.coreid.str.contains(self.coreid[0])]
-                    self.Bc_SR_data = self.Bc_SR_data[self.Bc_SR_data.coreid.str.contains(self.coreid[0])]
+                    self.Bc_Age_data = self.Bc_Age_data[self.Bc_Age_data.coreid == self.coreid[0]]
+                    self.Bc_SR_data = self.Bc_SR_data[self.Bc_SR_data.coreid == self.coreid[0]]
                 self.age_data.append(self.Bc_Age_data)
                 self.SR_data.append(self.Bc_SR_data)
             elif key == 'hamstr':
@@ -106,8 +127,8 @@ class PlotAgeSR(object):
                 self.ha_SR_data.replace(0, np.nan, inplace = True)
                 self.ha_SR_data['compositedepth'] = self.ha_SR_data['compositedepth'].replace(np.nan, 0)
                 if len(self.coreid) == 1:
-                    self.ha_Age_data = self.ha_Age_data[self.ha_Age_data.coreid.str.contains(self.coreid[0])]
-                    self.ha_SR_data = self.ha_SR_data[self.ha_SR_data.coreid.str.contains(self.coreid[0])]
+                    self.ha_Age_data = self.ha_Age_data[self.ha_Age_data.coreid == self.coreid[0]]
+                    self.ha_SR_data = self.ha_SR_data[self.ha_SR_data.coreid == self.coreid[0]]
                 self.age_data.append(self.ha_Age_data)
                 self.SR_data.append(self.ha_SR_data)
             elif key == 'Bacon':
@@ -116,8 +137,8 @@ class PlotAgeSR(object):
                 self.Ba_SR_data.replace(0, np.nan, inplace = True)
                 self.Ba_SR_data['compositedepth'] = self.Ba_SR_data['compositedepth'].replace(np.nan, 0)
                 if len(self.coreid) == 1:
-                    self.Ba_Age_data = self.Ba_Age_data[self.Ba_Age_data.coreid.str.contains(self.coreid[0])]
-                    self.Ba_SR_data = self.Ba_SR_data[self.Ba_SR_data.coreid.str.contains(self.coreid[0])]
+                    self.Ba_Age_data = self.Ba_Age_data[self.Ba_Age_data.coreid == self.coreid[0]]
+                    self.Ba_SR_data = self.Ba_SR_data[self.Ba_SR_data.coreid == self.coreid[0]]
                 self.age_data.append(self.Ba_Age_data)
                 self.SR_data.append(self.Ba_SR_data)
             elif key == 'OxCal':
@@ -126,8 +147,8 @@ class PlotAgeSR(object):
                 self.Ox_SR_data.replace(0, np.nan, inplace = True)
                 self.Ox_SR_data['compositedepth'] = self.Ox_SR_data['compositedepth'].replace(np.nan, 0)
                 if len(self.coreid) == 1:
-                    self.Ox_Age_data = self.Ox_Age_data[self.Ox_Age_data.coreid.str.contains(self.coreid[0])]
-                    self.Ox_SR_data = self.Ox_SR_data[self.Ox_SR_data.coreid.str.contains(self.coreid[0])]
+                    self.Ox_Age_data = self.Ox_Age_data[self.Ox_Age_data.coreid == self.coreid[0]]
+                    self.Ox_SR_data = self.Ox_SR_data[self.Ox_SR_data.coreid == self.coreid[0]]
                 self.age_data.append(self.Ox_Age_data)
                 self.SR_data.append(self.Ox_SR_data)
             elif key == 'clam':
@@ -145,18 +166,19 @@ class PlotAgeSR(object):
                     self.cl_SR_data.replace(0, np.nan, inplace = True)
                     self.cl_SR_data['compositedepth'] = self.cl_SR_data['compositedepth'].replace(np.nan, 0)
                     if len(self.coreid) == 1:
-                        self.cl_Age_data = self.cl_Age_data[self.cl_Age_data.coreid.str.contains(self.coreid[0])]
-                        self.cl_SR_data = self.cl_SR_data[self.cl_SR_data.coreid.str.contains(self.coreid[0])]
+                        self.cl_Age_data = self.cl_Age_data[self.cl_Age_data.coreid == self.coreid[0]]
+                        self.cl_SR_data = self.cl_SR_data[self.cl_SR_data.coreid == self.coreid[0]]
                         if self.cl_Age_data.empty == True or self.cl_SR_data.empty == True:
                             continue
                     self.age_data.append(self.cl_Age_data)
                     self.SR_data.append(self.cl_SR_data)
             elif key == 'calib_dates':
                 self.calib_dates = model_plot_data.get(key)
-                self.calib_dates[['coreid','compositedepth']] = self.calib_dates['id'].str.split(' ', n = 1, expand = True)
-                self.calib_dates['compositedepth'] = self.calib_dates['compositedepth'].astype(np.float32)
+                keys = depth_keys(self.calib_dates['id'])
+                self.calib_dates['coreid'] = keys['coreid']
+                self.calib_dates['compositedepth'] = keys['compositedepth'].astype(np.float32)
                 if len(self.coreid) == 1:
-                    self.calib_dates = self.calib_dates[self.calib_dates.coreid.str.contains(self.coreid[0])]
+                    self.calib_dates = self.calib_dates[self.calib_dates.coreid == self.coreid[0]]
             else:
                 raise Exception(f'There is an error in the model name')
         
@@ -178,9 +200,15 @@ class PlotAgeSR(object):
         """
         model_plot_data = self.model_plot_data
         self.age_SR_core_dict = {}
+        rng = np.random.default_rng(self.seed)
+        #### The iterations of every model are moved once into the ragged layout for all cores
+        ragged = None
+        if self.iterations is not None:
+            ragged = {key: to_ragged(iterations, self.coreid) for key, iterations in self.iterations.items()}
         for core in self.coreid:
             combine_age = []
             combine_SR = []
+            models = []
             for key in model_plot_data.keys():
                 if key == 'calib_dates':
                     pass
@@ -191,20 +219,26 @@ class PlotAgeSR(object):
                 elif core not in model_plot_data[key][0]['coreid'].unique():
                     continue                
                 else:
+                    models.append(key)
                     if self.sigma_range == '1sigma':
-                        age_core_selection = model_plot_data[key][0][model_plot_data[key][0].coreid.str.contains(core)]
-                        sedi_core_selection = model_plot_data[key][1][model_plot_data[key][1].coreid.str.contains(core)]
+                        age_core_selection = model_plot_data[key][0][model_plot_data[key][0].coreid == core]
+                        sedi_core_selection = model_plot_data[key][1][model_plot_data[key][1].coreid == core]
                         combine_age.append(age_core_selection.astype(dtype = {'compositedepth': float})                                      .sort_values(by = ['coreid','compositedepth'], ignore_index = True)                                      [['measurementid','modeloutput_mean','lower_1_sigma','upper_1_sigma']]                                      .rename({'modeloutput_mean': f'{key}_mean', 'lower_1_sigma': f'{key}_l_1_sigma', 'upper_1_sigma': f'{key}_u_1_sigma'}, axis='columns'))
                         combine_SR.append(sedi_core_selection.astype(dtype = {'compositedepth': float})                                           .sort_values(by = ['coreid','compositedepth'], ignore_index = True)                                           [['measurementid','SR_mean', 'SR_lower_1_sigma','SR_upper_1_sigma']]                                           .rename({'SR_mean': f'{key}_SR_mean', 'SR_lower_1_sigma': f'{key}_SR_l_1_sigma', 'SR_upper_1_sigma': f'{key}_SR_u_1_sigma'}, axis='columns'))
                     else:
-                        age_core_selection = model_plot_data[key][0][model_plot_data[key][0].coreid.str.contains(core)]
-                        sedi_core_selection = model_plot_data[key][1][model_plot_data[key][1].coreid.str.contains(core)]
+                        age_core_selection = model_plot_data[key][0][model_plot_data[key][0].coreid == core]
+                        sedi_core_selection = model_plot_data[key][1][model_plot_data[key][1].coreid == core]
                         combine_age.append(age_core_selection.astype(dtype = {'compositedepth': float})                                      .sort_values(by = ['coreid','compositedepth'], ignore_index = True)                                      [['measurementid','modeloutput_mean','lower_2_sigma','upper_2_sigma']]                                      .rename({'modeloutput_mean': f'{key}_mean', 'lower_2_sigma': f'{key}_l_2_sigma', 'upper_2_sigma': f'{key}_u_2_sigma'}, axis='columns'))
                         combine_SR.append(sedi_core_selection.astype(dtype = {'compositedepth': float})                                           .sort_values(by = ['coreid','compositedepth'], ignore_index = True)                                           [['measurementid','SR_mean', 'SR_lower_2_sigma','SR_upper_2_sigma']]                                           .rename({'SR_mean': f'{key}_SR_mean', 'SR_lower_2_sigma': f'{key}_SR_l_2_sigma', 'SR_upper_2_sigma': f'{key}_SR_u_2_sigma'}, axis='columns'))
             
             #### This is to check if there are results for the CoreID, otherwise this core will be skipped
             if not combine_age:
                 continue
+            #### With the iterations of the models, the combined model is taken from their pooled posterior
+            if self.iterations is not None:
+                combine_age_df, combine_SR_df = self.__pooled_posterior(core, models, ragged, rng)
+                self.age_SR_core_dict[core] = [combine_age_df, combine_SR_df]
+                continue
             #### This section combines all age-depth model results and finds the maximum and minimum age 
             #### as well as the weighted mean age and adds each result per sediment core to the dictionary
             combine_age_df = pd.concat(combine_age, axis = 1)
@@ -221,8 +255,9 @@ class PlotAgeSR(object):
             combine_age_df.reset_index(inplace = True)
             combine_age_df = combine_age_df[['measurementid','Max_age','Min_age']].copy()
             combine_age_df['Weighted_mean_age'] = self.weighted_mean_core_age
-            combine_age_df[['coreid','compositedepth']] = combine_age_df['measurementid'].str.split(' ', n = 1, expand = True)
-            combine_age_df['compositedepth'] = combine_age_df['compositedepth'].astype(np.float32)
+            keys = depth_keys(combine_age_df['measurementid'])
+            combine_age_df['coreid'] = keys['coreid']
+            combine_age_df['compositedepth'] = keys['compositedepth'].astype(np.float32)
             self.age_SR_core_dict.setdefault(core,[]).append(combine_age_df)
             
             #### This section combines all results the sedimentation rate (SR) calculation and finds 
@@ -250,8 +285,9 @@ class PlotAgeSR(object):
             combine_SR_df.reset_index(inplace = True)
             combine_SR_df = combine_SR_df[['measurementid','Max_SR','Min_SR']].copy()
             combine_SR_df['Weighted_mean_SR'] = self.weighted_mean_core_SR
-            combine_SR_df[['coreid','compositedepth']] = combine_SR_df['measurementid'].str.split(' ', n = 1, expand = True)
-            combine_SR_df['compositedepth'] = combine_SR_df['compositedepth'].astype(np.float32)
+            keys = depth_keys(combine_SR_df['measurementid'])
+            combine_SR_df['coreid'] = keys['coreid']
+            combine_SR_df['compositedepth'] = keys['compositedepth'].astype(np.float32)
             self.age_SR_core_dict.setdefault(core,[]).append(combine_SR_df)
         
         #### All results from the dictionary are now added to the two main return dataframes
@@ -263,6 +299,65 @@ class PlotAgeSR(object):
         self.combine_age_df = self.combine_age_df.astype(dtype = {'Max_age' : float,
                                                                   'Min_age' : float,
                                                                   'Weighted_mean_age' : float})
+
+    def __pooled_posterior(self, core, models, ragged, rng):
+        """
+        Helper function to combine the age-depth models of one sediment core by pooling their iterations: every model 
+        contributes n_draws * weight iterations, which are interpolated onto the common depths, and the median and 
+        sigma ranges of the ages and of the sedimentation rates are taken from the pooled iterations
+        
+        parameters:
+        @core: CoreID
+        @models: list of modeling software with results for the core
+        @ragged: dictionary with the RaggedIterations object of every model, indexed by the modeling software
+        @rng: numpy Generator for drawing the iterations
+        
+        returns:
+        @combine_age_df: dataframe with the combined age-depth model of the core; 'Weighted_mean_age' holds the median
+        (the name of the column is kept for the plotting code) and 'Min_age'/'Max_age' the boundaries of the selected 
+        sigma range of the pooled iterations
+        @combine_SR_df: dataframe with the combined sedimentation rates of the core, the same for 'Weighted_mean_SR', 
+        'Min_SR' and 'Max_SR'
+        """
+        missing = [key for key in models if key not in ragged]
+        if missing:
+            raise Exception(f'There are no iterations for {missing} to pool the age-depth models')
+        members = []
+        measurementid = []
+        for key in models:
+            rows = ragged[key].rows(core)
+            members.append((ragged[key].depths[rows], ragged[key][core]))
+            measurementid.append(pd.Series(ragged[key].measurementid[rows].astype(str), index = ragged[key].depths[rows]))
+        measurementid = pd.concat(measurementid)
+        measurementid = measurementid[~measurementid.index.duplicated()].sort_index()
+        depths = measurementid.index.to_numpy()
+        weights = None if self.weights is None else [self.weights.get(key, 0) for key in models]
+        pooled = pooled_iterations(members, depths, self.n_draws, weights, rng)
+        #### Columns of the sigma range shown as band, the 2-sigma range is shown for 'both'
+        band = [3, 4] if self.sigma_range == '1sigma' else [2, 5]
+        combine = {}
+        for label, summary in (('age', confidence_intervals(pooled)), ('SR', confidence_intervals(sed_rate_array(pooled, self.__SR_mode(core, models))))):
+            combine_df = pd.DataFrame({'measurementid': measurementid.to_numpy(),
+                                       f'Max_{label}': summary[:,band[1]],
+                                       f'Min_{label}': summary[:,band[0]],
+                                       f'Weighted_mean_{label}': summary[:,0]})
+            if label == 'SR':
+                combine_df.replace(0, np.nan, inplace = True)
+            combine_df['coreid'] = core
+            combine_df['compositedepth'] = depths.astype(np.float32)
+            combine[label] = combine_df
+        return combine['age'], combine['SR']
+
+    def __SR_mode(self, core, models):
+        """
+        Helper function to get the mode of the sedimentation rates of a core, which is used for the pooled posterior
+        """
+        for key in models:
+            SR_data = self.model_plot_data[key][1]
+            modes = SR_data.loc[SR_data.coreid == core, 'SR_mode'].dropna().unique()
+            if len(modes):
+                return modes[0]
+        return 'naive'
         
     def __SR_median_age(self):
         """
@@ -283,8 +378,8 @@ class PlotAgeSR(object):
             for core in self.coreid:
                 for i in range(len(self.model_name_list)):
                     model_name = self.model_name_list[i]
-                    left_df = self.model_plot_data[model_name][1][self.model_plot_data[model_name][1].coreid.str.contains(core)].copy()
-                    right_df = self.model_plot_data[model_name][0][self.model_plot_data[model_name][0].coreid.str.contains(core)].copy()
+                    left_df = self.model_plot_data[model_name][1][self.model_plot_data[model_name][1].coreid == core].copy()
+                    right_df = self.model_plot_data[model_name][0][self.model_plot_data[model_name][0].coreid == core].copy()
                     left_df.replace(0, np.nan, inplace = True)
                     left_df['compositedepth'] = left_df['compositedepth'].replace(np.nan, 0)
                     merge_frame = pd.merge(left = left_df, right = right_df, on = ['measurementid','coreid','compositedepth'])
@@ -326,7 +421,7 @@ class PlotAgeSR(object):
                 #### This section is dedicated to the binning of results for each model
                 self.model_frame = pd.DataFrame(columns = ['Binned_mid_age', 'SR_median', 'SR_upper_1_sigma', 'SR_lower_1_sigma', 'SR_upper_2_sigma', 'SR_lower_2_sigma', 'coreid', 'model_name'])
                 for core in self.coreid:
-                    sliced_merge_frame = merge_frame[merge_frame.coreid.str.contains(core)]
+                    sliced_merge_frame = merge_frame[merge_frame.coreid == core]
                     if len(sliced_merge_frame.index) != 0:
                         sliced_merge_frame = sliced_merge_frame.drop(['compositedepth','coreid','model_name'], axis = 1).set_index('modeloutput_median')
                         if sliced_merge_frame.index.min() != 0:
@@ -1247,8 +1342,8 @@ class PlotAgeSR(object):
                 for core in self.fitting_values.keys():
                     excluded_models = [key for key in fitting_values[core].keys() if fitting_values[core][key] <= self.inclusion_threshold]
                     for model in excluded_models:
-                        self.model_plot_data[model][0].drop(self.model_plot_data[model][0][self.model_plot_data[model][0].measurementid.str.contains(core)].index, inplace = True)
-                        self.model_plot_data[model][1].drop(self.model_plot_data[model][1][self.model_plot_data[model][1].measurementid.str.contains(core)].index, inplace = True)
+                        self.model_plot_data[model][0].drop(select_cores(self.model_plot_data[model][0], core).index, inplace = True)
+                        self.model_plot_data[model][1].drop(select_cores(self.model_plot_data[model][1], core).index, inplace = True)
                         #self.model_plot_data[model][0].drop(self.model_plot_data[model][0][self.model_plot_data[model][0]['coreid'] == core].index, inplace = True)
                         #self.model_plot_data[model][1].drop(self.model_plot_data[model][1][self.model_plot_data[model][1]['coreid'] == core].index, inplace = True)
             self.__frame_prep()
@@ -12,18 +12,28 @@ import pandas as pd
 import os
 import scipy.io as sio
 import datetime
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .summary_stats import summarize, thinned_positions, SKETCH_SIZE
+from .measurement_keys import depth_keys, set_key_index, as_categorical
+from .age_input import surface_mask
 
 
 #### Undatable
 class AggDataUndatable(object):
-    def __init__(self, prep_Undatable, orig_dir, dttp):
+    def __init__(self, prep_Undatable, orig_dir, dttp, n_iterations = None, seed = 0):
         """
         parameters:
         @self.prep_Undatable: object containing the variables from the Undatable object from preparation phase
         @self.location_UndatableFolder: string containing the location for the Undatable folder that is used by MATLAB/Octave
         @self.CoreIDs: list of CoreIDs used within the LANDO environment
         @self.orig_dir: original directory, where user excute LANDO
-        @self.dttp: value 'Yes' or 'No', if reservoir correction took place
+        @self.dttp: value 'Yes' or 'No', if reservoir correction took place, or the correction of every core as dictionary
+        indexed by CoreID (core_dttp of AggDataReservoir) or dataframe with the columns coreid and dttp (see core_preselection)
+        @self.n_iterations: number of iterations per core that are kept for the sedimentation rates (the summaries are 
+        taken from Undatable); cores with more iterations are thinned, cores with fewer are resampled (see 
+        thin_core_results); default value: None (all iterations are kept)
+        @self.seed: seed for drawing the iterations; default value: 0
         """
         self.prep_Undatable = prep_Undatable
         self.location_UndatableFolder = prep_Undatable.location_UndatableFolder
@@ -31,6 +41,8 @@ class AggDataUndatable(object):
         #self.CoreIDs = self.CoreIDs[1:].reset_index(drop = True)
         self.orig_dir = orig_dir
         self.dttp = dttp
+        self.n_iterations = n_iterations
+        self.seed = seed
     
     def results_agg(self):
         """
@@ -39,9 +51,12 @@ class AggDataUndatable(object):
         returns:
         @self.age_model_result_Undatable: dataframe holding the results from the aggregation 
         @self.Undatable_core_results: iteration results from Undatable with MeasurementID and model name added
+        @self.Undatable_iteration_files: dictionary with the location of the binary file with the iteration results 
+        indexed by CoreID, from which the out-of-core sedimentation rates are read; empty if the iterations were thinned
         """
         CoreIDs = self.CoreIDs
         dttp = self.dttp
+        self.Undatable_iteration_files = {}
         self.__age_model_columns = ['measurementid',
                                     'modeloutput_median',
                                     'modeloutput_mean',
@@ -51,94 +66,196 @@ class AggDataUndatable(object):
                                     'upper_2_sigma',
                                     'model_name']
         self.age_model_result_Undatable = pd.DataFrame(columns = self.__age_model_columns)
+        self.__individual_result_columns = ['measurementid',
+                                            'modeloutput_median',
+                                            'modeloutput_mean',
+                                            'lower_2_sigma',
+                                            'lower_1_sigma',
+                                            'upper_1_sigma',
+                                            'upper_2_sigma']
         
-        #### This section reads the individual txt files that are produced by Undatable
+        #### This section reads the txt files with the summaries and the .mat files with the iteration results 
+        #### that are produced by Undatable for all cores at the same time
         os.chdir(fr'{self.orig_dir}/{self.location_UndatableFolder}')
-        __individual_result_columns = ['measurementid',
-                                     'modeloutput_median',
-                                     'modeloutput_mean',
-                                     'lower_2_sigma',
-                                     'lower_1_sigma',
-                                     'upper_1_sigma',
-                                     'upper_2_sigma']
-        for i in range(0, len(CoreIDs)):
-            __individual_result = pd.read_csv(f'{CoreIDs.iloc[i,0]}_admodel.txt',sep = '\t', 
-                                            header = 1,
-                                            index_col = False,
-                                            usecols = [0,1,2,3,4,5,6],
-                                            names = __individual_result_columns,
-                                            converters = {'measurementid': str,
-                                                          'modeloutput_median': np.int64,
-                                                          'modeloutput_mean': np.int64,
-                                                          'lower_2_sigma': np.int64,
-                                                          'lower_1_sigma': np.int64,
-                                                          'upper_1_sigma': np.int64,
-                                                          'upper_2_sigma': np.int64}
-                                           )
-            __individual_result['measurementid'] = __individual_result['measurementid'].str.replace('.000000', '', regex = True)
-            __individual_result['measurementid'] = __individual_result['measurementid'].str.replace('00000', '', regex = True)
-            __individual_result['measurementid'] = __individual_result['measurementid'].str.replace('0000', '', regex = True)
-            __individual_result['measurementid'] = CoreIDs.iloc[i,0] + ' ' + __individual_result['measurementid']
-            __individual_result.insert(7, 'model_name', 'Undatable', True)
-            __individual_result.insert(8, 'preselection', dttp, True)
-            #self.age_model_result_Undatable = self.age_model_result_Undatable.append(__individual_result)
-            self.age_model_result_Undatable = pd.concat([self.age_model_result_Undatable, __individual_result], axis = 0)
+        core_list = list(CoreIDs.iloc[:,0])
+        if core_list:
+            with ThreadPoolExecutor(max_workers = min(len(core_list), (os.cpu_count() or 1) * 2)) as executor:
+                loaded = list(executor.map(self.__read_core, core_list))
+            self.age_model_result_Undatable = pd.concat([summary for summary, temp_age in loaded], ignore_index = True)
+            self.age_model_result_Undatable.insert(7, 'model_name', 'Undatable', True)
+            coreid = np.concatenate([np.repeat(core, len(summary)) for core, (summary, temp_age) in zip(core_list, loaded)])
+            self.age_model_result_Undatable.insert(8, 'preselection', core_preselection(dttp, coreid), True)
+            temp_ages = [temp_age for summary, temp_age in loaded]
+            if self.n_iterations is None:
+                self.Undatable_iteration_files = {core: os.path.abspath(f'{core}_temage.bin') for core in core_list 
+                                                  if os.path.exists(f'{core}_temage.bin')}
+            #### A single memory-mapped core is used as it is instead of being copied by the concatenation
+            self.Undatable_core_results = temp_ages[0] if len(temp_ages) == 1 else pd.concat(temp_ages, ignore_index = True)
+            self.Undatable_core_results = self.Undatable_core_results.assign(model_name = 'Undatable')
+        else:
+            self.Undatable_core_results = pd.DataFrame()
+        self.Undatable_core_results = self.Undatable_core_results.assign(measurementid = self.age_model_result_Undatable['measurementid'])
+        #### Cores that are already in order keep their rows, so memory-mapped iterations are not copied
+        self.age_model_result_Undatable = set_key_index(self.age_model_result_Undatable)
+        self.Undatable_core_results = set_key_index(self.Undatable_core_results)
+        self.age_model_result_Undatable = as_categorical(self.age_model_result_Undatable)
+        self.Undatable_core_results = as_categorical(self.Undatable_core_results)
+    
+    def __read_core(self, coreid):
+        """
+        Helper function to read the summaries and the iteration results of one core
         
-        self.age_model_result_Undatable = self.age_model_result_Undatable.reset_index(drop = True)
+        parameters:
+        @coreid: CoreID of the sediment core
         
-        #### This section loads the iteration results from the additional .mat file into the variable
-        self.Undatable_core_results = pd.DataFrame()
-        for i in range(0, len(CoreIDs)):
-            __load_temp_age = sio.loadmat(f'{CoreIDs.iloc[i,0]}_temage.mat')
-            __individual_temp_age = pd.DataFrame(__load_temp_age['tempage'])
-            __individual_temp_age = __individual_temp_age.assign(model_name = 'Undatable')
-            #self.Undatable_core_results = self.Undatable_core_results.append(__individual_temp_age)
-            self.Undatable_core_results = pd.concat([self.Undatable_core_results, __individual_temp_age], axis = 0)
-        self.Undatable_core_results = self.Undatable_core_results.reset_index(drop = True)
-        self.Undatable_core_results = self.Undatable_core_results.assign(measurementid = self.age_model_result_Undatable['measurementid'])
+        returns:
+        @individual_result: dataframe with the summaries from the txt file, with MeasurementID made of CoreID and depth
+        @individual_temp_age: dataframe with the iteration results (depth x iteration) from the binary file, 
+        which is memory-mapped, or from the .mat file
+        """
+        individual_result = pd.read_csv(f'{coreid}_admodel.txt', sep = '\t', 
+                                        header = 1,
+                                        index_col = False,
+                                        usecols = [0,1,2,3,4,5,6],
+                                        names = self.__individual_result_columns,
+                                        dtype = {'measurementid': np.float64,
+                                                 'modeloutput_median': np.int64,
+                                                 'modeloutput_mean': np.int64,
+                                                 'lower_2_sigma': np.int64,
+                                                 'lower_1_sigma': np.int64,
+                                                 'upper_1_sigma': np.int64,
+                                                 'upper_2_sigma': np.int64}
+                                       )
+        individual_result['measurementid'] = undatable_measurementid(coreid, individual_result['measurementid'])
+        if os.path.exists(f'{coreid}_temage.bin'):
+            depths, temp_age = read_temage(f'{coreid}_temage.bin')
+            if len(depths) != len(individual_result):
+                raise Exception(f'{coreid}_temage.bin and {coreid}_admodel.txt do not have the same number of depths')
+        else:
+            #### Results of earlier versions of the Undatable wrapper
+            temp_age = sio.loadmat(f'{coreid}_temage.mat', variable_names = ['tempage'])['tempage']
+        individual_temp_age = pd.DataFrame(temp_age, copy = False)
+        if self.n_iterations is not None:
+            individual_temp_age = thin_core_results(individual_temp_age, self.n_iterations, self.seed, np.repeat(coreid, len(individual_temp_age)))
+        return individual_result, individual_temp_age
             
+def undatable_measurementid(coreid, depths):
+    """
+    Helper function to create the MeasurementIDs of the depths of Undatable; depths are written with six decimals ('%f'),
+    which are dropped as far as they are zero, so depths from the binary file give the same MeasurementIDs as the txt file
+    
+    parameters:
+    @coreid: CoreID of the sediment core
+    @depths: float array with the depths
+    
+    returns:
+    @measurementid: list with the MeasurementIDs
+    """
+    return [f'{coreid} {np.format_float_positional(float(f"{depth:f}"), trim = "-")}' for depth in depths]
+
+def read_temage(path):
+    """
+    Function to open the iteration results of one core that the Undatable wrapper (udsummary.m) writes as raw binary file
+    without copying them into memory
+    
+    Layout (little-endian):
+    header of 24 bytes: b'LANDOAGE', version, number of depths, number of iterations, 0 (4 x uint32)
+    depths: number of depths x float64
+    ages: number of depths x number of iterations float32, all iterations of the first depth first
+    
+    parameters:
+    @path: string with the location of the <CoreID>_temage.bin file
+    
+    returns:
+    @depths: float array with the depths
+    @temp_age: memory-mapped float32 array (depth x iteration) with the ages
+    """
+    with open(path, 'rb') as file:
+        magic = file.read(8)
+        version, n_depths, n_iterations, _ = np.fromfile(file, dtype = '<u4', count = 4)
+        depths = np.fromfile(file, dtype = '<f8', count = n_depths)
+    if magic != b'LANDOAGE' or version != 1:
+        raise Exception(f'{path} is not a binary file with iteration results from the Undatable wrapper')
+    temp_age = np.memmap(path, dtype = '<f4', mode = 'r', offset = 24 + 8 * int(n_depths), shape = (int(n_depths), int(n_iterations)))
+    return depths, temp_age
+
+def core_preselection(dttp, coreid):
+    """
+    Function to get the value of the column preselection ('Yes' if reservoir correction took place) for every row 
+    from the correction of its core
+    
+    parameters:
+    @dttp: value 'Yes' or 'No' for all cores, dictionary or series with 'Yes' or 'No' indexed by CoreID (e.g. core_dttp of 
+    AggDataReservoir), or dataframe with the columns coreid and dttp (e.g. all_ages after add_reservoir); cores that are not 
+    in the dictionary, series or dataframe get 'No'
+    @coreid: array with the CoreID of every row
+    
+    returns:
+    @preselection: value 'Yes' or 'No' for all rows, or array with the value of every row
+    """
+    if isinstance(dttp, pd.DataFrame):
+        dttp = dttp.drop_duplicates('coreid').set_index('coreid')['dttp']
+    if isinstance(dttp, dict):
+        dttp = pd.Series(dttp, dtype = object)
+    if isinstance(dttp, pd.Series):
+        dttp = pd.Series(dttp.to_numpy(dtype = object), index = dttp.index.astype(str))
+        return pd.Series(np.asarray(coreid).astype(str)).map(dttp).fillna('No').to_numpy(dtype = object)
+    return dttp
+
+def core_seed(seed, coreid):
+    """
+    Helper function to derive the seed of one core from the seed of the aggregation, so that the iterations drawn for 
+    a core do not depend on the other cores
+    """
+    return [seed, zlib.crc32(str(coreid).encode())]
+
+def thin_core_results(core_results, n_iterations, seed = 0, groups = None):
+    """
+    Function to thin or resample the iterations of every core to the same number of iterations (see 
+    summary_stats.thinned_positions); iterations that are missing for all depths of a core are not drawn
+    
+    parameters:
+    @core_results: dataframe with only iteration columns, indexed by MeasurementID
+    @n_iterations: number of iterations per core
+    @seed: seed of the aggregation; default value: 0
+    @groups: array with the group of every row whose iterations are drawn together; default value: None (the CoreID)
+    
+    returns:
+    @core_results: dataframe with the iteration columns V1 to V<n_iterations> and the same index
+    """
+    if groups is None:
+        groups = depth_keys(pd.Series(core_results.index.astype(str), index = core_results.index))['coreid'].astype(str)
+    groups = np.asarray(groups)
+    values = np.empty((len(core_results), n_iterations))
+    for group in pd.unique(groups):
+        rows = np.flatnonzero(groups == group)
+        block = core_results.iloc[rows].to_numpy(dtype = np.float64)
+        columns = np.flatnonzero(~np.isnan(block).all(axis = 0))
+        values[rows] = block[:,columns[thinned_positions(len(columns), n_iterations, core_seed(seed, group))]]
+    return pd.DataFrame(values, index = core_results.index, columns = [f'V{i}' for i in range(1, n_iterations + 1)])
+
 #### Bchron  
 class AggDataBchron(object):
-    def __init__(self, Bchron_core_results, dttp):
+    def __init__(self, Bchron_core_results, dttp, approximate = False, sketch_size = SKETCH_SIZE, n_iterations = None, seed = 0):
         """
         parameters:
         @self.Bchron_core_results: dataframe with 10,000 iteration results from Bchron
-        @self.dttp: value 'Yes' or 'No', if reservoir correction took place
+        @self.dttp: value 'Yes' or 'No', if reservoir correction took place, or the correction of every core as dictionary
+        indexed by CoreID (core_dttp of AggDataReservoir) or dataframe with the columns coreid and dttp (see core_preselection)
+        @self.approximate: boolean value, if the quantiles should be approximated with a mergeable quantile sketch 
+        (see summary_stats.QuantileSketch for the error bound); default value: False
+        @self.sketch_size: number of values per depth and level of the quantile sketch; default value: SKETCH_SIZE
+        @self.n_iterations: number of iterations per core that are kept for the summaries and the sedimentation rates; 
+        cores with more iterations are thinned, cores with fewer are resampled (see thin_core_results); default value: 
+        None (all iterations are kept)
+        @self.seed: seed for drawing the iterations; default value: 0
         """
         self.Bchron_core_results = Bchron_core_results
         self.dttp = dttp
-    
-    def __confidence_intervals(self, g):
-        """
-        Helper function to get basic statistics (median, mean, 1-sigma range, 2-sigma range)
-        
-        returns:
-        @median: median value of input data
-        @mean:  mean value of input data
-        @two_sigma_lo: lower boundary value of 2-sigma range of input data
-        @one_sigma_lo: lower boundary value of 1-sigma range of input data
-        @one_sigma_hi: upper boundary value of 1-sigma range of input data
-        @two_sigma_hi: upper boundary value of 2-sigma range of input data
-        """
-        median = g.median()
-        mean = g.mean()
-        two_sigma_hi = g.quantile(q = 0.954, interpolation = 'nearest') 
-        two_sigma_lo = g.quantile(q = 0.046, interpolation = 'nearest')
-        one_sigma_hi = g.quantile(q = 0.683, interpolation = 'nearest') 
-        one_sigma_lo = g.quantile(q = 0.317, interpolation = 'nearest')
-        return median, mean, two_sigma_lo, one_sigma_lo, one_sigma_hi, two_sigma_hi
-    
-    def __sort_data(self, data):
-        """
-        Helper function to sort MeasurementID
-        
-        returns:
-        @data: dataframe with sorted MeasurementID, where composite depth is sorted numeric not as string
-        """
-        data[['coreid','compositedepth']] = data['measurementid'].str.split(' ', n = 1, expand = True)
-        data = data.astype(dtype = {'compositedepth' : float}).sort_values(by = ['coreid','compositedepth'], ignore_index = True)
-        data.drop(['compositedepth','coreid'], axis = 1, inplace = True)
-        return data 
+        self.approximate = approximate
+        self.sketch_size = sketch_size
+        self.n_iterations = n_iterations
+        self.seed = seed
     
     def results_agg(self):
         """
@@ -150,7 +267,9 @@ class AggDataBchron(object):
         """
         Bchron_core_results = self.Bchron_core_results
         dttp = self.dttp
-        self.age_model_result_Bchron = Bchron_core_results.apply(self.__confidence_intervals, axis = 1, result_type='expand')
+        if self.n_iterations is not None:
+            Bchron_core_results = self.Bchron_core_results = thin_core_results(Bchron_core_results, self.n_iterations, self.seed)
+        self.age_model_result_Bchron = pd.DataFrame(summarize(Bchron_core_results, self.approximate, self.sketch_size), index = Bchron_core_results.index)
         self.age_model_result_Bchron.columns = ['modeloutput_median',
                                            'modeloutput_mean',
                                            'lower_2_sigma',
@@ -160,56 +279,39 @@ class AggDataBchron(object):
         self.age_model_result_Bchron = self.age_model_result_Bchron.astype(int)
         self.age_model_result_Bchron = self.age_model_result_Bchron.reset_index()
         self.age_model_result_Bchron = self.age_model_result_Bchron.rename(columns={"index": "measurementid"})
-        self.age_model_result_Bchron = self.__sort_data(self.age_model_result_Bchron)
+        self.age_model_result_Bchron = set_key_index(self.age_model_result_Bchron)
         self.age_model_result_Bchron.insert(7, 'model_name', 'Bchron', True)
-        self.age_model_result_Bchron.insert(8, 'preselection', dttp, True)
+        self.age_model_result_Bchron.insert(8, 'preselection', core_preselection(dttp, self.age_model_result_Bchron.index.get_level_values('coreid')), True)
         ###
         self.Bchron_core_results.reset_index(inplace = True)
         self.Bchron_core_results['model_name'] = 'Bchron'
         self.Bchron_core_results.rename(columns={"index": "measurementid"}, inplace = True)
+        self.Bchron_core_results = set_key_index(self.Bchron_core_results)
+        self.age_model_result_Bchron = as_categorical(self.age_model_result_Bchron)
+        self.Bchron_core_results = as_categorical(self.Bchron_core_results)
 
 #### hamstr     
 class AggDataHamstr(object):
-    def __init__(self, hamstr_core_results, dttp):
+    def __init__(self, hamstr_core_results, dttp, approximate = False, sketch_size = SKETCH_SIZE, n_iterations = None, seed = 0):
         """
         parameters:
         @self.hamstr_core_results: dataframe with 10,000 iteration results from hamstr
-        @self.dttp: value 'Yes' or 'No', if reservoir correction took place
+        @self.dttp: value 'Yes' or 'No', if reservoir correction took place, or the correction of every core as dictionary
+        indexed by CoreID (core_dttp of AggDataReservoir) or dataframe with the columns coreid and dttp (see core_preselection)
+        @self.approximate: boolean value, if the quantiles should be approximated with a mergeable quantile sketch 
+        (see summary_stats.QuantileSketch for the error bound); default value: False
+        @self.sketch_size: number of values per depth and level of the quantile sketch; default value: SKETCH_SIZE
+        @self.n_iterations: number of iterations per core that are kept for the summaries and the sedimentation rates; 
+        cores with more iterations are thinned, cores with fewer are resampled (see thin_core_results); default value: 
+        None (all iterations are kept)
+        @self.seed: seed for drawing the iterations; default value: 0
         """
         self.hamstr_core_results = hamstr_core_results
         self.dttp = dttp
-    
-    def __confidence_intervals(self, g):
-        """
-        Helper function to get basic statistics (median, mean, 1-sigma range, 2-sigma range)
-        
-        returns:
-        @median: median value of input data
-        @mean:  mean value of input data
-        @two_sigma_lo: lower boundary value of 2-sigma range of input data
-        @one_sigma_lo: lower boundary value of 1-sigma range of input data
-        @one_sigma_hi: upper boundary value of 1-sigma range of input data
-        @two_sigma_hi: upper boundary value of 2-sigma range of input data
-        """
-        median = g.median()
-        mean = g.mean()
-        two_sigma_hi = g.quantile(q = 0.954, interpolation = 'nearest') 
-        two_sigma_lo = g.quantile(q = 0.046, interpolation = 'nearest')
-        one_sigma_hi = g.quantile(q = 0.683, interpolation = 'nearest') 
-        one_sigma_lo = g.quantile(q = 0.317, interpolation = 'nearest')
-        return median, mean, two_sigma_lo, one_sigma_lo, one_sigma_hi, two_sigma_hi
-    
-    def __sort_data(self, data):
-        """
-        Helper function to sort MeasurementID
-        
-        returns:
-        @data: dataframe with sorted MeasurementID, where composite depth is sorted numeric not as string
-        """
-        data[['coreid','compositedepth']] = data['measurementid'].str.split(' ', n = 1, expand = True)
-        data = data.astype(dtype = {'compositedepth' : float}).sort_values(by = ['coreid','compositedepth'], ignore_index = True)
-        data.drop(['compositedepth','coreid'], axis = 1, inplace = True)
-        return data 
+        self.approximate = approximate
+        self.sketch_size = sketch_size
+        self.n_iterations = n_iterations
+        self.seed = seed
     
     def results_agg(self):
         """
@@ -224,7 +326,9 @@ class AggDataHamstr(object):
         hamstr_core_results.rename_axis('index', inplace = True)
         hamstr_core_results.dropna(axis = 0, inplace = True)
         dttp = self.dttp
-        self.age_model_result_hamstr = hamstr_core_results.apply(self.__confidence_intervals, axis = 1, result_type='expand')
+        if self.n_iterations is not None:
+            hamstr_core_results = self.hamstr_core_results = thin_core_results(hamstr_core_results, self.n_iterations, self.seed)
+        self.age_model_result_hamstr = pd.DataFrame(summarize(hamstr_core_results, self.approximate, self.sketch_size), index = hamstr_core_results.index)
         self.age_model_result_hamstr.columns = ['modeloutput_median',
                                            'modeloutput_mean',
                                            'lower_2_sigma',
@@ -234,57 +338,39 @@ class AggDataHamstr(object):
         self.age_model_result_hamstr = self.age_model_result_hamstr.astype(int)
         self.age_model_result_hamstr = self.age_model_result_hamstr.reset_index()
         self.age_model_result_hamstr = self.age_model_result_hamstr.rename(columns={"index": "measurementid"})
-        self.age_model_result_hamstr = self.__sort_data(self.age_model_result_hamstr)
+        self.age_model_result_hamstr = set_key_index(self.age_model_result_hamstr)
         self.age_model_result_hamstr.insert(7, 'model_name', 'hamstr', True)
-        self.age_model_result_hamstr.insert(8, 'preselection', dttp, True)
+        self.age_model_result_hamstr.insert(8, 'preselection', core_preselection(dttp, self.age_model_result_hamstr.index.get_level_values('coreid')), True)
         ###
         self.hamstr_core_results.reset_index(inplace = True)
         self.hamstr_core_results = self.hamstr_core_results.rename(columns={"index": "measurementid"})
-        self.hamstr_core_results = self.__sort_data(self.hamstr_core_results)
+        self.hamstr_core_results = set_key_index(self.hamstr_core_results)
         self.hamstr_core_results['model_name'] = 'hamstr'
+        self.age_model_result_hamstr = as_categorical(self.age_model_result_hamstr)
+        self.hamstr_core_results = as_categorical(self.hamstr_core_results)
 
 #### Bacon
 class AggDataBacon(object):
-    def __init__(self, Bacon_core_results, dttp):
+    def __init__(self, Bacon_core_results, dttp, approximate = False, sketch_size = SKETCH_SIZE, n_iterations = None, seed = 0):
         """
         parameters:
         @self.Bacon_core_results: dataframe with 10,000 iteration results from Bacon
-        @self.dttp: value 'Yes' or 'No', if reservoir correction took place
+        @self.dttp: value 'Yes' or 'No', if reservoir correction took place, or the correction of every core as dictionary
+        indexed by CoreID (core_dttp of AggDataReservoir) or dataframe with the columns coreid and dttp (see core_preselection)
+        @self.approximate: boolean value, if the quantiles should be approximated with a mergeable quantile sketch 
+        (see summary_stats.QuantileSketch for the error bound); default value: False
+        @self.sketch_size: number of values per depth and level of the quantile sketch; default value: SKETCH_SIZE
+        @self.n_iterations: number of iterations per core that are kept for the summaries and the sedimentation rates; 
+        cores with more iterations are thinned, cores with fewer are resampled (see thin_core_results); default value: 
+        None (all iterations are kept)
+        @self.seed: seed for drawing the iterations; default value: 0
         """
         self.Bacon_core_results = Bacon_core_results
         self.dttp = dttp
-    
-    def __confidence_intervals(self, g):
-        """
-        Helper function to get basic statistics (median, mean, 1-sigma range, 2-sigma range)
-        
-        returns:
-        @median: median value of input data
-        @mean:  mean value of input data
-        @two_sigma_lo: lower boundary value of 2-sigma range of input data
-        @one_sigma_lo: lower boundary value of 1-sigma range of input data
-        @one_sigma_hi: upper boundary value of 1-sigma range of input data
-        @two_sigma_hi: upper boundary value of 2-sigma range of input data
-        """
-        median = g.median()
-        mean = g.mean()
-        two_sigma_hi = g.quantile(q = 0.954, interpolation = 'nearest') 
-        two_sigma_lo = g.quantile(q = 0.046, interpolation = 'nearest')
-        one_sigma_hi = g.quantile(q = 0.683, interpolation = 'nearest') 
-        one_sigma_lo = g.quantile(q = 0.317, interpolation = 'nearest')
-        return median, mean, two_sigma_lo, one_sigma_lo, one_sigma_hi, two_sigma_hi
-    
-    def __sort_data(self, data):
-        """
-        Helper function to sort MeasurementID
-        
-        returns:
-        @data: dataframe with sorted MeasurementID, where composite depth is sorted numeric not as string
-        """
-        data[['coreid','compositedepth']] = data['measurementid'].str.split(' ', n = 1, expand = True)
-        data = data.astype(dtype = {'compositedepth' : float}).sort_values(by = ['coreid','compositedepth'], ignore_index = True)
-        data.drop(['compositedepth','coreid'], axis = 1, inplace = True)
-        return data 
+        self.approximate = approximate
+        self.sketch_size = sketch_size
+        self.n_iterations = n_iterations
+        self.seed = seed
     
     def results_agg(self):
         """
@@ -299,7 +385,9 @@ class AggDataBacon(object):
         Bacon_core_results.rename_axis('index', inplace = True)
         Bacon_core_results.dropna(axis = 0, inplace = True)
         dttp = self.dttp
-        self.age_model_result_Bacon = Bacon_core_results.apply(self.__confidence_intervals, axis = 1, result_type='expand')
+        if self.n_iterations is not None:
+            Bacon_core_results = self.Bacon_core_results = thin_core_results(Bacon_core_results, self.n_iterations, self.seed)
+        self.age_model_result_Bacon = pd.DataFrame(summarize(Bacon_core_results, self.approximate, self.sketch_size), index = Bacon_core_results.index)
         self.age_model_result_Bacon.columns = ['modeloutput_median',
                                            'modeloutput_mean',
                                            'lower_2_sigma',
@@ -309,45 +397,39 @@ class AggDataBacon(object):
         self.age_model_result_Bacon = self.age_model_result_Bacon.astype(int)
         self.age_model_result_Bacon = self.age_model_result_Bacon.reset_index()
         self.age_model_result_Bacon = self.age_model_result_Bacon.rename(columns={"index": "measurementid"})
-        self.age_model_result_Bacon = self.__sort_data(self.age_model_result_Bacon)
+        self.age_model_result_Bacon = set_key_index(self.age_model_result_Bacon)
         self.age_model_result_Bacon.insert(7, 'model_name', 'Bacon', True)
-        self.age_model_result_Bacon.insert(8, 'preselection', dttp, True)
+        self.age_model_result_Bacon.insert(8, 'preselection', core_preselection(dttp, self.age_model_result_Bacon.index.get_level_values('coreid')), True)
         ###
         self.Bacon_core_results.reset_index(inplace = True)
         self.Bacon_core_results = self.Bacon_core_results.rename(columns={"index": "measurementid"})
-        self.Bacon_core_results = self.__sort_data(self.Bacon_core_results)
-        self.Bacon_core_results['model_name'] = 'Bacon'       
+        self.Bacon_core_results = set_key_index(self.Bacon_core_results)
+        self.Bacon_core_results['model_name'] = 'Bacon'
+        self.age_model_result_Bacon = as_categorical(self.age_model_result_Bacon)
+        self.Bacon_core_results = as_categorical(self.Bacon_core_results)       
             
 #### Clam
 class AggDataClam(object):
-    def __init__(self, clam_core_results, dttp):
+    def __init__(self, clam_core_results, dttp, approximate = False, sketch_size = SKETCH_SIZE, n_iterations = None, seed = 0):
         """
         parameters:
         @self.clam_core_results: dataframe with 10,000 iteration results from clam
-        @self.dttp: value 'Yes' or 'No', if reservoir correction took place
+        @self.dttp: value 'Yes' or 'No', if reservoir correction took place, or the correction of every core as dictionary
+        indexed by CoreID (core_dttp of AggDataReservoir) or dataframe with the columns coreid and dttp (see core_preselection)
+        @self.approximate: boolean value, if the quantiles should be approximated with a mergeable quantile sketch 
+        (see summary_stats.QuantileSketch for the error bound); default value: False
+        @self.sketch_size: number of values per depth and level of the quantile sketch; default value: SKETCH_SIZE
+        @self.n_iterations: number of iterations per core that are kept for the summaries and the sedimentation rates; 
+        cores with more iterations are thinned, cores with fewer are resampled (see thin_core_results); default value: 
+        None (all iterations are kept)
+        @self.seed: seed for drawing the iterations; default value: 0
         """
         self.clam_core_results = clam_core_results
         self.dttp = dttp
-    
-    def __confidence_intervals(self, g):
-        """
-        Helper function to get basic statistics (median, mean, 1-sigma range, 2-sigma range)
-        
-        returns:
-        @median: median value of input data
-        @mean:  mean value of input data
-        @two_sigma_lo: lower boundary value of 2-sigma range of input data
-        @one_sigma_lo: lower boundary value of 1-sigma range of input data
-        @one_sigma_hi: upper boundary value of 1-sigma range of input data
-        @two_sigma_hi: upper boundary value of 2-sigma range of input data
-        """
-        median = g.median()
-        mean = g.mean()
-        two_sigma_hi = g.quantile(q = 0.954, interpolation = 'nearest') 
-        two_sigma_lo = g.quantile(q = 0.046, interpolation = 'nearest')
-        one_sigma_hi = g.quantile(q = 0.683, interpolation = 'nearest') 
-        one_sigma_lo = g.quantile(q = 0.317, interpolation = 'nearest')
-        return median, mean, two_sigma_lo, one_sigma_lo, one_sigma_hi, two_sigma_hi
+        self.approximate = approximate
+        self.sketch_size = sketch_size
+        self.n_iterations = n_iterations
+        self.seed = seed
     
     def results_agg(self):
         """
@@ -364,95 +446,115 @@ class AggDataClam(object):
             self.age_model_result_clam = []
             print ('No age data available!')
         else:
-            clam_core_results.set_index('model_label', inplace = True)
-            self.age_model_result_clam = clam_core_results.apply(self.__confidence_intervals, axis = 1, result_type='expand')
-            self.age_model_result_clam.columns = ['modeloutput_median',
-                                               'modeloutput_mean',
-                                               'lower_2_sigma',
-                                               'lower_1_sigma',
-                                               'upper_1_sigma',
-                                               'upper_2_sigma']
-            self.age_model_result_clam = self.age_model_result_clam.astype(int)
-            self.age_model_result_clam = self.age_model_result_clam.reset_index()
-            self.age_model_result_clam = self.age_model_result_clam.rename(columns={"model_label": "measurementid"})
-            #### This transforms the clam-specific MeasurementID into it's components
-            self.age_model_result_clam['measurementid'] = self.age_model_result_clam['measurementid'].astype(str)
-            self.age_model_result_clam[['coreid','depth_model_type']] = self.age_model_result_clam['measurementid'].str.split(' ', n = 1, expand = True)
-            self.age_model_result_clam[['depth','model_name']] = self.age_model_result_clam['depth_model_type'].str.split('-', n = 1, expand = True)
-            self.age_model_result_clam['model_name'] = self.age_model_result_clam['model_name'].str.replace('_',' ')
-            self.age_model_result_clam.insert(8, 'preselection', dttp, True)
-            self.age_model_result_clam['measurementid'] = self.age_model_result_clam['coreid'] + ' ' + self.age_model_result_clam['depth']
-            self.age_model_result_clam = self.age_model_result_clam.astype(dtype = {'depth' : float}).sort_values(by = ['coreid','depth','model_name'], ignore_index = True)
-            self.age_model_result_clam.drop(['coreid','depth','depth_model_type'], axis = 1, inplace = True)
-            self.age_model_result_clam.reset_index(drop = True, inplace = True)
-            self.age_model_result_clam = self.age_model_result_clam.reindex(['measurementid','modeloutput_median','modeloutput_mean',
-                                                                             'lower_2_sigma','lower_1_sigma','upper_1_sigma','upper_2_sigma',
-                                                                             'model_name', 'preselection'], axis = 1)
-            #### This section checks if there were multiple results from clam
-            multiple_entries = {}
-            for i, r in self.age_model_result_clam.iterrows():
-                if i == 0:
-                    pass
-                else:
-                    if (self.age_model_result_clam.at[(i-1), 'measurementid'].split(' ')[0] == self.age_model_result_clam.at[i, 'measurementid'].split(' ')[0])                     and (self.age_model_result_clam.at[(i-1), 'model_name'] != self.age_model_result_clam.at[i, 'model_name']):
-                        multiple_entries_coreid = self.age_model_result_clam.at[i, 'measurementid'].split(' ')[0]
-                        multiple_entries[multiple_entries_coreid] = self.age_model_result_clam[self.age_model_result_clam.measurementid.str.contains(multiple_entries_coreid)]
+            #### This transforms the clam-specific label ('CoreID depth-clam_variant') into its components, 
+            #### which are used for the summaries and the iterations
+            clam_core_results = clam_core_results.reset_index(drop = True)
+            keys = clam_core_results['model_label'].astype(str).str.split(' ', n = 1, expand = True)
+            keys.columns = ['coreid','depth_model_type']
+            keys[['depth','model_name']] = keys['depth_model_type'].str.split('-', n = 1, expand = True)
+            keys['model_name'] = keys['model_name'].str.replace('_',' ')
+            keys['measurementid'] = keys['coreid'] + ' ' + keys['depth']
+            keys = keys.astype(dtype = {'depth' : float}).drop(['depth_model_type'], axis = 1)
+            iterations = clam_core_results.drop(['model_label'], axis = 1)
+            if self.n_iterations is not None:
+                iterations = thin_core_results(iterations, self.n_iterations, self.seed, keys['coreid'] + '-' + keys['model_name'])
+            summary = pd.DataFrame(summarize(iterations, self.approximate, self.sketch_size), index = iterations.index)
+            summary.columns = ['modeloutput_median',
+                               'modeloutput_mean',
+                               'lower_2_sigma',
+                               'lower_1_sigma',
+                               'upper_1_sigma',
+                               'upper_2_sigma']
+            summary = summary.astype(int)
+            summary.insert(0, 'measurementid', keys['measurementid'])
+            summary.insert(7, 'model_name', keys['model_name'])
+            summary.insert(8, 'preselection', core_preselection(dttp, keys['coreid']), True)
+            order = keys.sort_values(by = ['coreid','depth','model_name']).index
+            keys = keys.loc[order]
+            summary = summary.loc[order]
+            #### This section checks if there were multiple results from clam for a core
+            multiple = (keys.groupby('coreid')['model_name'].transform('nunique') > 1).to_numpy()
+            self.age_model_result_clam = summary[~multiple].reset_index(drop = True)
+            self.clam_core_results = iterations.loc[order[~multiple]].reset_index(drop = True)
+            self.clam_core_results['model_name'] = 'clam'
+            self.clam_core_results['measurementid'] = keys['measurementid'].to_numpy()[~multiple]
             
-            #### If there multiple entries, they are treated as one and statistics will be calculated from all results (10,000+)
-            if bool(multiple_entries) == False:
-                self.clam_core_results.reset_index(drop = True, inplace = True)
-                self.clam_core_results['model_name'] = 'clam'
-                self.clam_core_results['measurementid'] = self.age_model_result_clam['measurementid']
-            else:
-                list_of_keys = [*multiple_entries]
-                new_combined_result_list = []
-                for key in multiple_entries.keys():
-                    combined_results = []
-                    for unique_model_name in multiple_entries[key].model_name.unique():
-                        combined_results.append(multiple_entries[key][multiple_entries[key].model_name.str.contains(unique_model_name)].reset_index(drop = True))
-                    combined_results_df = pd.concat(combined_results, axis = 1)
-                    index_results_df = combined_results_df['measurementid'].dropna(axis = 1)
-                    index_results_df = index_results_df.loc[:,~index_results_df.columns.duplicated()]['measurementid']
-                    combined_results_df = combined_results_df.set_index(index_results_df)
-                    combined_results_df.drop(['measurementid','model_name'],axis = 1, inplace = True)
-                    new_combined_results = pd.DataFrame(columns = ['measurementid', 'modeloutput_median', 'modeloutput_mean', 'lower_2_sigma',
-                       'lower_1_sigma', 'upper_1_sigma', 'upper_2_sigma', 'model_name', 'preselection'])
-                    new_combined_results['measurementid'] = index_results_df
-                    new_combined_results['model_name'] = 'clam combined'
-                    for column in combined_results_df.columns.unique():
-                        if column == 'preselection':
-                            new_combined_results['preselection'] = combined_results_df['preselection'].dropna(axis = 1).values
-                        else:
-                            new_combined_results[f'{column}'] = combined_results_df[f'{column}'].mean(axis = 1).values
-                    new_combined_result_list.append(new_combined_results)
-                new_combined_result_df = pd.concat(new_combined_result_list, axis = 0)
-                self.age_model_result_clam = pd.concat([self.age_model_result_clam[~self.age_model_result_clam.measurementid.str.contains('|'.join(list_of_keys))], new_combined_result_df], axis = 0)
-                self.age_model_result_clam.reset_index(drop = True, inplace = True)
+            #### If there multiple entries, they are treated as one: the summaries of all clam variants are averaged per depth 
+            #### and their iterations are pooled (10,000+), with the iterations of the variants side by side in alphabetical order
+            if multiple.any():
+                multiple_keys = keys[multiple]
+                depth_groups = multiple_keys.groupby(['coreid','depth'], sort = False)
+                combined = summary[multiple].groupby([multiple_keys['coreid'], multiple_keys['depth']], sort = False).agg(
+                    {'measurementid': 'first', 'modeloutput_median': 'mean', 'modeloutput_mean': 'mean', 'lower_2_sigma': 'mean',
+                     'lower_1_sigma': 'mean', 'upper_1_sigma': 'mean', 'upper_2_sigma': 'mean', 'preselection': 'first'})
+                combined.insert(7, 'model_name', 'clam combined')
+                self.age_model_result_clam = pd.concat([self.age_model_result_clam, combined.reset_index(drop = True)], 
+                                                       axis = 0, ignore_index = True)
                 ###
-                self.clam_core_results.reset_index(inplace = True)
-                self.clam_core_results = self.clam_core_results.rename(columns={"index": "measurementid"})
-                self.clam_core_results[['coreid','depth_model_type']] = self.clam_core_results['measurementid'].str.split(' ', n = 1, expand = True)
-                self.clam_core_results[['depth','model_name']] = self.clam_core_results['depth_model_type'].str.split('-', n = 1, expand = True)
-                self.clam_core_results['model_name'] = self.clam_core_results['model_name'].str.replace('_',' ')
-                self.clam_core_results['measurementid'] = self.clam_core_results['coreid'] + ' ' + self.clam_core_results['depth']
-                self.clam_core_results.drop(['coreid','depth','depth_model_type'], axis = 1, inplace = True)
-                new_combined_result_list = []
-                for key in multiple_entries.keys():
-                    combined_results = []
-                    for unique_model_name in multiple_entries[key].model_name.unique():
-                        combined_results.append(self.clam_core_results[(self.clam_core_results.measurementid.str.contains(key))&(self.clam_core_results.model_name.str.contains(unique_model_name))].reset_index(drop = True))
-                    combined_results_df = pd.concat(combined_results, axis = 1)
-                    index_results_df = combined_results_df['measurementid'].dropna(axis = 1)
-                    index_results_df = index_results_df.loc[:,~index_results_df.columns.duplicated()]['measurementid']
-                    combined_results_df = combined_results_df.set_index(index_results_df)
-                    combined_results_df.drop(['measurementid','model_name'],axis = 1, inplace = True) 
-                    combined_results_df.columns = [f'V{i}' for i in range(1,len(combined_results_df.columns)+1)]
-                    combined_results_df.reset_index(inplace = True)
-                    combined_results_df['model_name'] = 'clam combined'
-                    new_combined_result_list.append(combined_results_df)
-                new_combined_result_df = pd.concat(new_combined_result_list, axis = 0)
-                self.clam_core_results = pd.concat([self.clam_core_results[~self.clam_core_results.measurementid.str.contains('|'.join(list_of_keys))], new_combined_result_df], axis = 0)
-                self.clam_core_results['model_name'] = 'clam'   
+                row = depth_groups.ngroup().to_numpy()
+                variant = multiple_keys.groupby(['coreid','model_name'], sort = True).ngroup()
+                variant = (variant - variant.groupby(multiple_keys['coreid']).transform('min')).to_numpy()
+                values = iterations.loc[multiple_keys.index].to_numpy(dtype = np.float64)
+                pooled = np.full((row.max() + 1, variant.max() + 1, values.shape[1]), np.nan)
+                pooled[row, variant] = values
+                pooled = pd.DataFrame(pooled.reshape(len(pooled), -1), columns = [f'V{i}' for i in range(1, pooled.shape[1] * pooled.shape[2] + 1)])
+                if self.n_iterations is not None:
+                    #### The pooled iterations of the variants are thinned again, so every core keeps n_iterations
+                    pooled = thin_core_results(pooled, self.n_iterations, self.seed, depth_groups['coreid'].first().to_numpy())
+                pooled['model_name'] = 'clam'
+                pooled['measurementid'] = depth_groups['measurementid'].first().to_numpy()
+                self.clam_core_results = pd.concat([self.clam_core_results, pooled], axis = 0, ignore_index = True)
+            self.age_model_result_clam = set_key_index(self.age_model_result_clam)
+            self.clam_core_results = set_key_index(self.clam_core_results)
+            self.age_model_result_clam = as_categorical(self.age_model_result_clam)
+            self.clam_core_results = as_categorical(self.clam_core_results)
+
+#### All models
+def run_results_agg(agg):
+    """
+    Helper function to aggregate the results of one model, also in a separate process
+    
+    returns:
+    @agg: aggregation object after results_agg
+    """
+    agg.results_agg()
+    return agg
+
+def aggregate_models(aggregations, max_workers = None, processes = False):
+    """
+    Function to aggregate the results of several modeling software at the same time instead of one after another; 
+    the summaries spend most of their time in NumPy, which releases the GIL, so the models run in threads by default
+    
+    parameters:
+    @aggregations: dictionary (or list) with the aggregation objects (e.g. AggDataBacon) of the models, 
+    created with their results
+    @max_workers: maximum number of models that are aggregated at the same time; default value: None (all models)
+    @processes: boolean value, if models other than Undatable should be aggregated in separate processes, which 
+    helps if pandas operations that hold the GIL dominate (e.g. many short cores); default value: False
+    
+    returns:
+    @aggregations: the same dictionary (or list), whose aggregation objects hold age_model_result_* and *_core_results 
+    as after calling results_agg on each of them
+    """
+    objects = list(aggregations.values()) if isinstance(aggregations, dict) else list(aggregations)
+    if not objects:
+        return aggregations
+    max_workers = max_workers or len(objects)
+    #### Undatable memory-maps its iterations and changes the working directory, so it always runs in a thread
+    in_process = [processes and not isinstance(agg, AggDataUndatable) for agg in objects]
+    pool = ProcessPoolExecutor(max_workers = min(max_workers, sum(in_process))) if any(in_process) else None
+    try:
+        with ThreadPoolExecutor(max_workers = max_workers) as threads:
+            futures = [(pool if separate else threads).submit(run_results_agg, agg) for agg, separate in zip(objects, in_process)]
+            for agg, separate, future in zip(objects, in_process, futures):
+                result = future.result()
+                #### Objects from a process are copies, their results are moved to the original objects
+                if separate:
+                    agg.__dict__.update(result.__dict__)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return aggregations
 
 #### Reservoir
 class AggDataReservoir(object):
@@ -467,26 +569,6 @@ class AggDataReservoir(object):
         self.surface_dates = surface_dates
         self.verbose = verbose
     
-    def __confidence_intervals(self, g):
-        """
-        Helper function to get basic statistics (median, mean, 1-sigma range, 2-sigma range)
-        
-        returns:
-        @median: median value of input data
-        @mean:  mean value of input data
-        @two_sigma_lo: lower boundary value of 2-sigma range of input data
-        @one_sigma_lo: lower boundary value of 1-sigma range of input data
-        @one_sigma_hi: upper boundary value of 1-sigma range of input data
-        @two_sigma_hi: upper boundary value of 2-sigma range of input data
-        """
-        median = g.median()
-        mean = g.mean()
-        two_sigma_hi = g.quantile(q = 0.954, interpolation = 'nearest') 
-        two_sigma_lo = g.quantile(q = 0.046, interpolation = 'nearest')
-        one_sigma_hi = g.quantile(q = 0.683, interpolation = 'nearest') 
-        one_sigma_lo = g.quantile(q = 0.317, interpolation = 'nearest')
-        return median, mean, two_sigma_lo, one_sigma_lo, one_sigma_hi, two_sigma_hi
-    
     def results_agg(self):
         """
         Main function to aggregate data for uppermost layer and compare it to desired target year
@@ -501,7 +583,7 @@ class AggDataReservoir(object):
         reservoir_core_results.set_index('depth', inplace = True)
         reservoir_core_results.rename_axis('index', inplace = True)
         reservoir_core_results.dropna(axis = 0, inplace = True)
-        self.age_model_result_reservoir = reservoir_core_results.apply(self.__confidence_intervals, axis = 1, result_type='expand')
+        self.age_model_result_reservoir = pd.DataFrame(summarize(reservoir_core_results), index = reservoir_core_results.index)
         self.age_model_result_reservoir.columns = ['modeloutput_median',
                                            'modeloutput_mean',
                                            'lower_2_sigma',
@@ -558,44 +640,52 @@ class AggDataReservoir(object):
         @self.which: string either 'all' (for 'all samples'), 'bulk' (for 'only bulk samples'), or 'without' ('if no reservoir values should be added'); default value: None
         
         returns:
-        @self.all_ages: altered dataframe with all age determiantion data plus added reservoir values
+        @self.all_ages: altered dataframe with all age determiantion data plus added reservoir values and the column dttp 
+        ('Yes' or 'No'), which shows for each core if reservoir values were added
+        @self.dttp: 'Yes' if reservoir values were added to at least one core, otherwise 'No'
+        @self.core_dttp: dictionary with 'Yes' or 'No' indexed by CoreID, which is handed to the aggregation classes 
+        to fill the column preselection for each core
         """
         self.all_ages = all_ages
+        if which is not None:
+            self.which = which
+        corrected_cores = []
         if self.reservoir_values:
             if which is None:
                 self.which = input("Would you like to add the reservoir values to all samples ('all'), to only bulk samples ('bulk'), or disregard the values ('without')? ")
             ####
-            if self.which == 'all':
-                for key in self.reservoir_values.keys():
-                    for i, r in self.all_ages.iterrows():
-                        if (self.all_ages.at[i, 'coreid'] == key) and ('14C' in self.all_ages.at[i, 'material_category']):
-                            self.all_ages.at[i, 'reservoir_age'] = float(self.all_ages.at[i, 'reservoir_age']) + float(self.reservoir_values[key][0])
-                            self.all_ages.at[i, 'reservoir_error'] = float(self.all_ages.at[i, 'reservoir_error']) + float(self.reservoir_values[key][1])
-                    self.dttp = 'Yes' ## Needs to be more sophisticated for multiple sediment cores, to answer which core had a transformation
-                if bool(self.reservoir_values) == False:
-                    self.dttp = 'No' 
-            elif self.which == 'bulk':
-                for key in self.reservoir_values.keys():
-                    for i, r in self.all_ages.iterrows():
-                        if (self.all_ages.at[i, 'coreid'] == key) and ('14C sediment' in self.all_ages.at[i, 'material_category']):
-                            self.all_ages.at[i, 'reservoir_age'] = float(self.all_ages.at[i, 'reservoir_age']) + float(self.reservoir_values[key][0])
-                            self.all_ages.at[i, 'reservoir_error'] = float(self.all_ages.at[i, 'reservoir_error']) + float(self.reservoir_values[key][1])
-                    self.dttp = 'Yes' ## Needs to be more sophisticated for multiple sediment cores, to answer which core had a transformation
-                if bool(self.reservoir_values) == False:
-                    self.dttp = 'No' 
-            else:
-                self.dttp = 'No' 
-        else:
-            self.dttp = 'No' 
+            if self.which in ['all', 'bulk']:
+                material = '14C' if self.which == 'all' else '14C sediment'
+                reservoir = pd.DataFrame.from_dict(self.reservoir_values, orient = 'index', columns = ['reservoir_age', 'reservoir_error'], dtype = float)
+                #### Reservoir values are joined to the samples on the CoreID
+                reservoir_age = self.all_ages['coreid'].map(reservoir['reservoir_age'])
+                reservoir_error = self.all_ages['coreid'].map(reservoir['reservoir_error'])
+                selected = reservoir_age.notna() & self.all_ages['material_category'].astype(str).str.contains(material, regex = False)
+                self.all_ages['reservoir_age'] = self.all_ages['reservoir_age'].astype(float) + reservoir_age.where(selected, 0)
+                self.all_ages['reservoir_error'] = self.all_ages['reservoir_error'].astype(float) + reservoir_error.where(selected, 0)
+                corrected_cores = list(reservoir.index)
+        self.dttp = 'Yes' if corrected_cores else 'No'
+        self.all_ages['dttp'] = np.where(self.all_ages['coreid'].isin(corrected_cores), 'Yes', 'No')
+        self.core_dttp = self.all_ages.drop_duplicates('coreid').set_index('coreid')['dttp'].to_dict()
         ### Check for logic, if age and reservoir effect are smaller than current date - this is important for Bchron
-        for i, r in self.all_ages.iterrows():
-            if ((float(self.all_ages.at[i, 'age']) - float(self.all_ages.at[i, 'reservoir_age'])) < (1950 - datetime.datetime.now().year)) and (self.all_ages.at[i,'compositedepth'] <= 1):
-                self.all_ages.at[i, 'reservoir_age'] = float(self.all_ages.at[i, 'age']) - float(self.all_ages[(self.all_ages.coreid == self.all_ages.at[i, 'coreid'])&(self.all_ages.labid.str.contains('_Surface'))]['age'])
-                self.all_ages.at[i, 'reservoir_error'] = 0
-            elif ((float(self.all_ages.at[i, 'age']) - float(self.all_ages.at[i, 'reservoir_age'])) < (1950 - datetime.datetime.now().year)) and (self.all_ages.at[i,'compositedepth'] > 1):
-                self.all_ages.at[i, 'reservoir_age'] = 0
-                self.all_ages.at[i, 'reservoir_error'] = 0
-            else:
-                pass
+        age = self.all_ages['age'].astype(float)
+        too_young = (age - self.all_ages['reservoir_age'].astype(float)) < (1950 - datetime.datetime.now().year)
+        compositedepth = self.all_ages['compositedepth'].astype(float)
+        shallow = too_young & (compositedepth <= 1)
+        deep = too_young & (compositedepth > 1)
+        if too_young.any():
+            self.all_ages['reservoir_age'] = self.all_ages['reservoir_age'].astype(float)
+            self.all_ages['reservoir_error'] = self.all_ages['reservoir_error'].astype(float)
+        if shallow.any():
+            surface = self.all_ages[surface_mask(self.all_ages)]
+            if surface['coreid'].duplicated().any():
+                raise Exception(f"More than one surface sample for {', '.join(surface.loc[surface['coreid'].duplicated(), 'coreid'].astype(str).unique())}")
+            surface_age = self.all_ages.loc[shallow, 'coreid'].map(surface.set_index('coreid')['age'].astype(float))
+            if surface_age.isna().any():
+                raise Exception(f"No surface sample for {', '.join(self.all_ages.loc[surface_age[surface_age.isna()].index, 'coreid'].astype(str).unique())}")
+            self.all_ages.loc[shallow, 'reservoir_age'] = age[shallow] - surface_age
+            self.all_ages.loc[shallow, 'reservoir_error'] = 0
+        self.all_ages.loc[deep, 'reservoir_age'] = 0
+        self.all_ages.loc[deep, 'reservoir_error'] = 0
             
         return self.all_ages
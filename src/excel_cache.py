@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Module within LANDO to read the sheets of input files only once and keep them as Parquet files next to the input file
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import numpy as np
+import pandas as pd
+import os
+import json
+import shutil
+import hashlib
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+
+#### Directory next to the input files with one subdirectory per input file and content hash
+CACHE_DIRECTORY = '.lando_cache'
+#### Key of the Parquet metadata with the columns that mix numbers and strings
+MIXED_KEY = b'lando_mixed_columns'
+#### Size of input files (bytes) from which several sheets are parsed in separate processes
+PARALLEL_FILE_SIZE = 1 << 20
+
+
+def file_hash(filename, chunk_size = 1 << 20):
+    """
+    Function to get the SHA-256 hash of the content of a file
+
+    returns:
+    @digest: string with the hexadecimal hash
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def parse_sheet(filename, sheet):
+    """
+    Helper function to parse one sheet of an input file, also within a separate process
+    """
+    return pd.read_excel(filename, sheet_name = sheet)
+
+def mixed_columns(data):
+    """
+    Helper function to find the columns with values of different types, e.g. ages with detection limit ('>45000')
+    between numbers, which Parquet cannot store as they are
+    """
+    mixed = []
+    for column in data.columns:
+        if data[column].dtype == object:
+            types = {type(value) for value in data[column] if not (isinstance(value, float) and np.isnan(value))}
+            if len(types) > 1:
+                mixed.append(column)
+    return mixed
+
+def tagged_value(value):
+    """
+    Helper function to store a value of a mixed column as string with a tag of its type, so that it is read back
+    with the same type and strings that look like numbers ('0123', '1e3') stay strings
+
+    returns:
+    @value: string '<tag>:<value>', None for missing values
+    @stored: boolean value, False if the type of the value cannot be stored
+    """
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None, True
+    if isinstance(value, (bool, np.bool_)):
+        return f'b:{int(value)}', True
+    if isinstance(value, (int, np.integer)):
+        return f'i:{int(value)}', True
+    if isinstance(value, (float, np.floating)):
+        return f'f:{float(value)!r}', True
+    if isinstance(value, str):
+        return f's:{value}', True
+    return None, False
+
+def restore_value(value):
+    """
+    Helper function to turn a stored value of a mixed column back into a boolean, integer, float or string by its tag
+    """
+    #### Missing values come back as None or NaN, depending on the string type of pandas
+    if not isinstance(value, str):
+        return np.nan
+    tag, value = value[0], value[2:]
+    if tag == 'b':
+        return bool(int(value))
+    if tag == 'i':
+        return int(value)
+    if tag == 'f':
+        return float(value)
+    return value
+
+
+class CachedWorkbook(object):
+    def __init__(self, filename, cache = True):
+        """
+        Input file whose sheets are parsed once and kept as Parquet files in a directory next to it, named after the
+        hash of the content (<directory of file>/.lando_cache/<name of file>/<hash>/); as long as the file is not
+        changed, its sheets are read from the Parquet files without opening the input file, a changed file is parsed again
+
+        parameters:
+        @self.filename: string with the address to file on system
+        @self.cache: boolean value, if the sheets should be kept as Parquet files; default value: True
+
+        returns:
+        @self.sheet_names: list with the names of all sheets of the input file
+        """
+        self.filename = filename
+        self.cache = cache
+        self.directory = None
+        self.sheet_names = None
+        if self.cache:
+            self.directory = os.path.join(os.path.dirname(os.path.abspath(filename)), CACHE_DIRECTORY,
+                                          os.path.basename(filename), file_hash(filename))
+            try:
+                with open(os.path.join(self.directory, 'sheet_names.json')) as file:
+                    self.sheet_names = json.load(file)
+            except (OSError, ValueError):
+                self.sheet_names = None
+        if self.sheet_names is None:
+            self.sheet_names = pd.ExcelFile(filename).sheet_names
+            self.__write_sheet_names()
+
+    def __write_sheet_names(self):
+        """
+        Helper function to start a new cache directory for the file; the directories of earlier versions of the file are removed
+        """
+        if self.directory is None:
+            return
+        try:
+            parent = os.path.dirname(self.directory)
+            if os.path.isdir(parent):
+                for name in os.listdir(parent):
+                    if name != os.path.basename(self.directory):
+                        shutil.rmtree(os.path.join(parent, name), ignore_errors = True)
+            os.makedirs(self.directory, exist_ok = True)
+            def write(path):
+                with open(path, 'w') as file:
+                    json.dump(self.sheet_names, file)
+            self.__replace(os.path.join(self.directory, 'sheet_names.json'), write)
+        except OSError:
+            print(f'The sheets of {self.filename} cannot be cached, they are read from the file every time.')
+            self.directory = None
+
+    def __replace(self, path, write):
+        """
+        Helper function to write a file under a temporary name first, so that no half-written file is read later
+        """
+        temporary = f'{path}.{os.getpid()}.tmp'
+        write(temporary)
+        os.replace(temporary, path)
+
+    def __path(self, sheet):
+        """
+        Helper function to get the Parquet file of a sheet, named after the position of the sheet in the file
+        """
+        return os.path.join(self.directory, f'sheet-{self.sheet_names.index(sheet)}.parquet')
+
+    def __read_cached(self, sheet):
+        """
+        Helper function to read one sheet from its Parquet file
+
+        returns:
+        @data: dataframe of the sheet, None if the sheet is not cached or the Parquet file cannot be read
+        """
+        if self.directory is None or not os.path.exists(self.__path(sheet)):
+            return None
+        try:
+            table = pq.read_table(self.__path(sheet))
+        except (OSError, pa.ArrowInvalid):
+            return None
+        data = table.to_pandas()
+        metadata = table.schema.metadata or {}
+        for column in json.loads(metadata.get(MIXED_KEY, b'[]')):
+            data[column] = pd.Series([restore_value(value) for value in data[column]], index = data.index, dtype = object)
+        return data
+
+    def __write_cached(self, sheet, data):
+        """
+        Helper function to write one sheet as Parquet file; columns that mix numbers and strings are stored as strings
+        with a tag of the type of every value and turned back into values of that type when they are read
+        """
+        if self.directory is None:
+            return
+        mixed = mixed_columns(data)
+        stored = data.copy(deep = False)
+        for column in mixed:
+            values, stored_types = zip(*[tagged_value(value) for value in data[column]]) if len(data) else ((), ())
+            #### Sheets with other types in a mixed column (e.g. dates between numbers) are read from the file every time
+            if not all(stored_types):
+                return
+            stored[column] = pd.Series(values, index = data.index, dtype = object)
+        try:
+            table = pa.Table.from_pandas(stored)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            return
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), MIXED_KEY: json.dumps(mixed).encode()})
+        try:
+            self.__replace(self.__path(sheet), lambda path: pq.write_table(table, path))
+        except OSError:
+            pass
+
+    def read(self, sheets = None, max_workers = None):
+        """
+        Function to get sheets of the input file, from the Parquet files if they are cached; sheets that are not cached
+        are parsed in separate processes if there are several of them in a large file, and then cached
+
+        parameters:
+        @sheets: list with the names of the sheets; default value: None (all sheets)
+        @max_workers: maximum number of processes that parse the sheets; default value: None (number of processors or sheets)
+
+        returns:
+        @sheets: dictionary with dataframes indexed by the names of the sheets, in the order of the input file
+        """
+        if sheets is None:
+            sheets = self.sheet_names
+        missing = [sheet for sheet in sheets if sheet not in self.sheet_names]
+        if missing:
+            raise Exception(f'There is no sheet named {missing} in {self.filename}')
+        sheets = [sheet for sheet in self.sheet_names if sheet in sheets]
+        data = {sheet: self.__read_cached(sheet) for sheet in sheets}
+        parse = [sheet for sheet in sheets if data[sheet] is None]
+        if max_workers is None:
+            max_workers = min(len(parse), os.cpu_count() or 1)
+        if len(parse) > 1 and max_workers > 1 and os.path.getsize(self.filename) >= PARALLEL_FILE_SIZE:
+            with ProcessPoolExecutor(max_workers = max_workers) as executor:
+                parsed = list(executor.map(parse_sheet, [self.filename] * len(parse), parse))
+        else:
+            parsed = [parse_sheet(self.filename, sheet) for sheet in parse]
+        for sheet, sheet_data in zip(parse, parsed):
+            self.__write_cached(sheet, sheet_data)
+            data[sheet] = sheet_data
+        return data
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Module within LANDO to handle the structured key (CoreID, composite depth) behind every MeasurementID
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import numpy as np
+import pandas as pd
+
+#### Names of the key columns and of the levels of the key index
+KEY_NAMES = ['coreid','compositedepth']
+#### Columns with few distinct strings that are repeated on many rows of the results
+CATEGORICAL_COLUMNS = ['measurementid','coreid','model_name','preselection','SR_mode']
+
+
+def depth_keys(measurementid):
+    """
+    Function to split MeasurementIDs into CoreID and numeric composite depth; every distinct MeasurementID
+    is only split once, so MeasurementIDs of several models can be prepared together
+
+    parameters:
+    @measurementid: series with MeasurementIDs ('CoreID depth')
+
+    returns:
+    @keys: dataframe with the columns coreid (categorical) and compositedepth (float) and the index of the MeasurementIDs
+    """
+    codes, uniques = pd.factorize(measurementid)
+    keys = pd.Series(uniques, dtype = object).str.split(' ', n = 1, expand = True)
+    keys.columns = KEY_NAMES
+    #### Categories are sorted, so the order of the codes is the order of the CoreIDs as strings
+    keys['coreid'] = pd.Categorical(keys['coreid'])
+    keys = keys.astype(dtype = {'compositedepth' : float}).iloc[codes]
+    keys.index = measurementid.index
+    return keys
+
+def has_key_index(data):
+    """
+    Helper function to check if a dataframe carries the key index set by set_key_index
+
+    returns:
+    @keyed: boolean value, if the index consists of the levels coreid and compositedepth
+    """
+    return list(data.index.names) == KEY_NAMES
+
+def set_key_index(data, sort = True):
+    """
+    Function to set the key (CoreID, composite depth) as index of a dataframe with MeasurementIDs and to sort the rows
+    by CoreID and numeric composite depth; the MeasurementIDs are only split if the dataframe does not carry the key yet
+    and the rows are only sorted if they are not sorted yet, so the function can be called at every stage
+
+    parameters:
+    @data: dataframe with the column measurementid or with the key index
+    @sort: boolean value, if the rows should be sorted by the key; default value: True
+
+    returns:
+    @data: dataframe with the multiindex (coreid, compositedepth), the data itself is not copied unless it has to be sorted
+    """
+    if not has_key_index(data):
+        index = pd.MultiIndex.from_frame(depth_keys(data['measurementid']))
+        data = data.copy(deep = False)
+        data.index = index
+    if sort and not data.index.is_monotonic_increasing:
+        data = data.sort_index(sort_remaining = True)
+    return data
+
+def frame_keys(data, sort = False):
+    """
+    Function to get the key of every row of a dataframe, from the key index if it is set or from the MeasurementIDs
+
+    parameters:
+    @data: dataframe with the column measurementid or with the key index
+    @sort: boolean value, if the keys should be ordered by CoreID and numeric composite depth; default value: False
+
+    returns:
+    @keys: dataframe with the columns coreid and compositedepth, indexed by the position of each row in data
+    """
+    if has_key_index(data):
+        keys = data.index.to_frame(index = False)
+    else:
+        keys = depth_keys(data['measurementid']).reset_index(drop = True)
+    if sort:
+        keys = sort_keys(keys)
+    return keys
+
+def sort_keys(keys):
+    """
+    Helper function to order keys by CoreID and numeric composite depth, which is skipped if they are already in order
+
+    parameters:
+    @keys: dataframe with the columns coreid and compositedepth
+
+    returns:
+    @keys: ordered dataframe, the index still points to the original rows
+    """
+    if pd.MultiIndex.from_frame(keys[KEY_NAMES]).is_monotonic_increasing:
+        return keys
+    return keys.sort_values(by = KEY_NAMES, kind = 'stable')
+
+def select_cores(data, cores):
+    """
+    Function to select the rows of some cores by their exact CoreID
+
+    parameters:
+    @data: dataframe with the column coreid, the key index or the column measurementid
+    @cores: CoreID or list of CoreIDs
+
+    returns:
+    @data: dataframe with the rows of the cores
+    """
+    if isinstance(cores, str):
+        cores = [cores]
+    if 'coreid' in data.columns:
+        coreid = data['coreid']
+    elif has_key_index(data):
+        coreid = data.index.get_level_values('coreid')
+    else:
+        coreid = frame_keys(data)['coreid']
+    return data[np.asarray(coreid.isin(cores))]
+
+def iteration_labels(core_results):
+    """
+    Helper function to get the labels of the iteration columns; CoreID and composite depth might be left as columns 
+    from an earlier calculation
+    
+    parameters:
+    @core_results: model-specific 10,000 iteration results with MeasurementID and model name added
+    
+    returns:
+    @labels: index with the labels of all iteration columns
+    """
+    return core_results.columns.difference(['measurementid','model_name','coreid','compositedepth'], sort = False)
+
+def as_categorical(data, columns = CATEGORICAL_COLUMNS):
+    """
+    Function to store the repeated string columns of a result dataframe as categoricals; other columns are not copied
+
+    parameters:
+    @data: dataframe with aggregated results, sedimentation rates or iterations
+    @columns: list of columns that are converted if they exist; default value: CATEGORICAL_COLUMNS
+
+    returns:
+    @data: dataframe with categorical columns
+    """
+    columns = [column for column in columns if column in data.columns and not isinstance(data[column].dtype, pd.CategoricalDtype)]
+    if not columns:
+        return data
+    data = data.copy(deep = False)
+    for column in columns:
+        data[column] = data[column].astype('category')
+    return data
@@ -13,6 +13,7 @@ import os
 import tempfile
 import math
 import datetime
+from .age_input import surface_mask
 
 
 ### For Undatable ### 
@@ -491,8 +492,9 @@ class PrepForReservoirCorrection(object):
         @self.__desired_surface_dates: dataframe with surface samples dervied from the expedition year 
         @self.__all_ages: altered dataframe with all age determination data, whereas the surface sample is removed
         """
-        self.__desired_surface_dates = self.__all_ages[self.__all_ages.labid.str.contains('_Surface')]
-        self.__dates_without_surface_sample = self.__all_ages[~self.__all_ages.labid.isin(self.__desired_surface_dates.labid)]
+        surface = surface_mask(self.__all_ages)
+        self.__desired_surface_dates = self.__all_ages[surface]
+        self.__dates_without_surface_sample = self.__all_ages[~surface]
         self.__dates_without_surface_sample = self.__dates_without_surface_sample[self.__dates_without_surface_sample.material_category.str.contains('14C')]
         for ID in self.__dates_without_surface_sample.coreid.unique():
             if len(self.__dates_without_surface_sample[self.__dates_without_surface_sample.coreid == ID]) < 2:
@@ -593,7 +595,7 @@ class PrepForCalibration(object):
         returns:
         @self.__txt_df_calib: dataframe with age determination data in the format usable with calib
         """
-        __all_ages = self.__all_ages[~self.__all_ages.labid.str.contains('_Surface')].copy()
+        __all_ages = self.__all_ages[~surface_mask(self.__all_ages)].copy()
         __all_ages = __all_ages.astype(dtype = {'age' : float,
                                                 'age_error' : float,
                                                 'reservoir_age' : float,
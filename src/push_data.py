@@ -12,6 +12,7 @@ import pandas as pd
 import os
 import sqlalchemy
 from sqlalchemy.exc import IntegrityError
+from .measurement_keys import frame_keys
 
 class PushIt(object):
     def __init__(self, agg, engine, model = ''):
@@ -55,12 +56,11 @@ class PushIt(object):
         elif self.engine == 'No Database':
             print ('Information: LANDO is not connected to a database, so nothing was uploaded.')
         else:
-            self.__measurementids__ = self.age_model_result.copy()
             model = self.model
             engine = self.engine
             try:
-                self.__measurementids__[['coreid','compositedepth']] = self.__measurementids__['measurementid'].str.split(' ', n = 1, expand = True)
-                self.__measurementids__ = self.__measurementids__[['measurementid','coreid','compositedepth']]
+                self.__measurementids__ = frame_keys(self.age_model_result)
+                self.__measurementids__.insert(0, 'measurementid', self.age_model_result['measurementid'].to_numpy())
                 self.__measurementids__ = self.__measurementids__.astype(dtype = {'measurementid':str, 'coreid': str, 'compositedepth': float}).drop_duplicates()
                 try:
                     con = engine.connect()
@@ -97,5 +97,7 @@ class PushIt(object):
         for i in range(0, len(self.coreids)):
             os.remove(f'{self.coreids.iloc[i,0]}.txt')
             os.remove(f'{self.coreids.iloc[i,0]}_admodel.txt')
-            os.remove(f'{self.coreids.iloc[i,0]}_temage.mat')
+            for ending in ['_temage.bin', '_temage.mat']:
+                if os.path.exists(f'{self.coreids.iloc[i,0]}{ending}'):
+                    os.remove(f'{self.coreids.iloc[i,0]}{ending}')
         print ('Information: All unwanted Undatable files have been deleted')
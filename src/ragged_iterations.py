@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Module within LANDO to keep the iterations of sediment cores of different lengths without padding
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import numpy as np
+import pandas as pd
+from .measurement_keys import frame_keys, sort_keys, iteration_labels
+
+
+class RaggedIterations(object):
+    def __init__(self, cores, buffer, offsets, row_offsets, widths, depths, measurementid, model_name):
+        """
+        Iterations of several sediment cores in one flat buffer: the iteration matrix (depth x iteration) of every core
+        is stored contiguously and only with the iterations that are complete for that core, so that a core is read as
+        view without scanning or copying the padding of the other cores (created with to_ragged)
+
+        parameters:
+        @self.cores: index with the CoreIDs in the order of the buffer
+        @self.buffer: float64 array with the iterations of all cores, one core after another and depth after depth
+        @self.offsets: integer array with the position of the first value of every core in the buffer and the end of the buffer
+        @self.row_offsets: integer array with the position of the first depth of every core and the total number of depths
+        @self.widths: integer array with the number of iterations of every core
+        @self.depths: float array with the composite depth of every row, sorted within each core
+        @self.measurementid: array with the MeasurementID of every row
+        @self.model_name: array with the model name of every row
+        """
+        self.cores = pd.Index(cores, name = 'coreid')
+        self.buffer = buffer
+        self.offsets = offsets
+        self.row_offsets = row_offsets
+        self.widths = widths
+        self.depths = depths
+        self.measurementid = measurementid
+        self.model_name = model_name
+
+    def __len__(self):
+        """
+        Helper function to get the number of cores
+        """
+        return len(self.cores)
+
+    def __contains__(self, core):
+        """
+        Helper function to check if a core is in the object
+        """
+        return core in self.cores
+
+    def __position(self, core):
+        """
+        Helper function to get the position of a core
+        """
+        if core not in self.cores:
+            raise Exception(f'There are no iterations for {core}')
+        return self.cores.get_loc(core)
+
+    def rows(self, core):
+        """
+        Function to get the rows of a core in the arrays of depths, MeasurementIDs and model names
+
+        returns:
+        @rows: slice of the rows of the core
+        """
+        position = self.__position(core)
+        return slice(self.row_offsets[position], self.row_offsets[position + 1])
+
+    def __getitem__(self, core):
+        """
+        Function to get the iterations of one core as view of the buffer
+
+        returns:
+        @ages: float64 array (depth x iteration) with the iterations of the core, sorted by depth
+        """
+        position = self.__position(core)
+        n_depths = self.row_offsets[position + 1] - self.row_offsets[position]
+        return self.buffer[self.offsets[position]:self.offsets[position + 1]].reshape(n_depths, self.widths[position])
+
+    def frame(self, core):
+        """
+        Function to get the iterations of one core as dataframe that shares the memory of the buffer
+
+        returns:
+        @frame: dataframe (depth x iteration) with the multiindex of MeasurementID, model name and CoreID
+        """
+        rows = self.rows(core)
+        index = pd.MultiIndex.from_arrays([self.measurementid[rows], self.model_name[rows], np.repeat(core, rows.stop - rows.start)],
+                                          names = ['measurementid','model_name','coreid'])
+        return pd.DataFrame(self[core], index = index, copy = False)
+
+    def items(self):
+        """
+        Function to iterate over the cores
+
+        returns:
+        @items: generator of tuples of CoreID and the view of its iterations
+        """
+        for core in self.cores:
+            yield core, self[core]
+
+def to_ragged(core_results, cores = None, keys = None):
+    """
+    Function to move the iterations of a dataframe into the ragged layout; every core is read once and iterations
+    with missing values for the core are left out, the same as dropna(axis = 1) on the rows of the core
+
+    parameters:
+    @core_results: model-specific iteration results with MeasurementID and model name added
+    @cores: list of CoreIDs that should be kept; default value: None (all cores)
+    @keys: dataframe with the columns coreid and compositedepth for every row, e.g. from frame_keys; default value: None
+    (taken from the key index or created from the MeasurementIDs)
+
+    returns:
+    @ragged: RaggedIterations object with the cores sorted by CoreID and the depths sorted within each core
+    """
+    if keys is None:
+        keys = frame_keys(core_results)
+    keys = sort_keys(keys.reset_index(drop = True))
+    column_positions = core_results.columns.get_indexer(iteration_labels(core_results))
+    measurementid = core_results['measurementid'].to_numpy()
+    model_name = core_results['model_name'].to_numpy()
+    #### First pass: rows and complete iterations of every core, which give the place of the core in the buffer
+    names, columns_per_core, rows_per_core = [], [], []
+    for core, rows in keys.groupby('coreid', sort = False, observed = True).groups.items():
+        if cores is not None and core not in cores:
+            continue
+        rows = np.asarray(rows)
+        complete = ~core_results.iloc[rows, column_positions].isna().to_numpy().any(axis = 0)
+        names.append(core)
+        columns_per_core.append(column_positions if complete.all() else column_positions[complete])
+        rows_per_core.append(rows)
+    row_offsets = np.concatenate(([0], np.cumsum([len(rows) for rows in rows_per_core], dtype = np.int64)))
+    widths = np.array([len(columns) for columns in columns_per_core], dtype = np.int64)
+    offsets = np.concatenate(([0], np.cumsum(np.diff(row_offsets) * widths, dtype = np.int64)))
+    #### Second pass: every core is read once more and written straight into its place in the buffer
+    buffer = np.empty(offsets[-1], dtype = np.float64)
+    for rows, columns, start, stop, width in zip(rows_per_core, columns_per_core, offsets[:-1], offsets[1:], widths):
+        buffer[start:stop].reshape(len(rows), width)[:] = core_results.iloc[rows, columns].to_numpy(dtype = np.float64)
+    rows = np.concatenate(rows_per_core) if rows_per_core else np.array([], dtype = np.intp)
+    depths = keys.loc[rows, 'compositedepth'].to_numpy(dtype = np.float64)
+    return RaggedIterations(names, buffer, offsets, row_offsets, widths, depths, measurementid[rows], model_name[rows])
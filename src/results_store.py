@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Module within LANDO to keep the results of the age-depth models and sedimentation rates on disk as Parquet files
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import numpy as np
+import pandas as pd
+import os
+import shutil
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from .measurement_keys import KEY_NAMES, set_key_index, as_categorical
+
+#### Tables of the store and the attributes of the aggregation (or sedimentation rate) objects they are written from
+STORE_TABLES = {'iterations': '{model}_core_results',
+                'age': 'age_model_result_{model}',
+                'SR': 'SR_model_result_{model}'}
+#### Columns of the iteration tables that are not iterations
+LABEL_COLUMNS = ['measurementid','model_name','compositedepth']
+#### Number of depths per row group of the iteration tables, the smallest unit in which iterations are read from disk
+ITERATION_ROW_GROUP = 256
+
+
+class ResultsStore(object):
+    def __init__(self, directory):
+        """
+        Store for the results of the age-depth models and sedimentation rates as columnar Parquet files, partitioned by
+        model and core in the layout <directory>/<table>/model=<model>/coreid=<CoreID>/part-0.parquet, so that the
+        results survive a restart of the kernel and single cores, depths or iterations can be read without loading the rest
+
+        parameters:
+        @self.directory: directory of the store, which is created if it does not exist
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+
+    def __path(self, table, model, core = None):
+        """
+        Helper function to get the directory of a model or of a core within a table
+        """
+        if table not in STORE_TABLES:
+            raise Exception(f'The store only has the tables {list(STORE_TABLES)}')
+        path = os.path.join(self.directory, table, f'model={model}')
+        if core is not None:
+            path = os.path.join(path, f'coreid={core}')
+        return path
+
+    def write_model(self, agg, model, tables = None):
+        """
+        Function to write the results of an aggregation object after results_agg (or of a sedimentation rate object after
+        calculating_SR) core by core; cores that are written again are replaced, other cores of the model are kept
+
+        parameters:
+        @agg: aggregation object, CalculateSediRate or CalculateSediRateModels object
+        @model: string of name of model, e.g. 'Bacon'
+        @tables: list of tables that should be written ('iterations', 'age', 'SR'); default value: None (every table
+        with results in agg)
+
+        returns:
+        @written: list of tables that were written
+        """
+        written = []
+        for table, attribute in STORE_TABLES.items():
+            if tables is not None and table not in tables:
+                continue
+            data = getattr(agg, attribute.format(model = model), None)
+            if not isinstance(data, pd.DataFrame) or data.empty:
+                continue
+            self.write(table, model, data)
+            written.append(table)
+        return written
+
+    def write(self, table, model, data):
+        """
+        Function to write one table of a model, one file per core
+
+        parameters:
+        @table: string of name of table ('iterations', 'age' or 'SR')
+        @model: string of name of model
+        @data: dataframe with the column measurementid or the key index
+        """
+        #### Sedimentation rates keep their order, so the modes stay in blocks
+        data = set_key_index(data, sort = table != 'SR')
+        coreid = data.index.get_level_values('coreid')
+        for core in pd.unique(coreid):
+            part = data.iloc[np.flatnonzero(coreid == core)].reset_index(level = 'compositedepth').reset_index(drop = True)
+            part.columns = part.columns.map(str)
+            path = self.__path(table, model, core)
+            shutil.rmtree(path, ignore_errors = True)
+            os.makedirs(path)
+            pq.write_table(pa.Table.from_pandas(part, preserve_index = False), os.path.join(path, 'part-0.parquet'),
+                           row_group_size = ITERATION_ROW_GROUP if table == 'iterations' else None)
+
+    def __dataset(self, table, model):
+        """
+        Helper function to open the files of one table and model as dataset; cores with different numbers of
+        iterations are read with the union of their columns, missing iterations are NaN
+
+        returns:
+        @dataset: pyarrow dataset with the partition field coreid, None if the store holds no results
+        """
+        path = self.__path(table, model)
+        if not os.path.isdir(path):
+            return None
+        files = [os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names if name.endswith('.parquet')]
+        if not files:
+            return None
+        partitioning = ds.partitioning(pa.schema([('coreid', pa.string())]), flavor = 'hive')
+        schema = pa.unify_schemas([pq.read_schema(file) for file in sorted(files)] + [pa.schema([('coreid', pa.string())])])
+        return ds.dataset(sorted(files), schema = schema, format = 'parquet', partitioning = partitioning, partition_base_dir = path)
+
+    def has(self, table, model):
+        """
+        Function to check if the store holds results of a model in a table
+
+        returns:
+        @stored: boolean value, if there is at least one core
+        """
+        return bool(self.cores(model, table))
+
+    def models(self, table = 'age'):
+        """
+        Function to list the models with results in a table
+
+        returns:
+        @models: list of names of models
+        """
+        path = os.path.join(self.directory, table)
+        if not os.path.isdir(path):
+            return []
+        return sorted(name.split('=', 1)[1] for name in os.listdir(path) if name.startswith('model='))
+
+    def cores(self, model, table = 'age'):
+        """
+        Function to list the cores of a model with results in a table
+
+        returns:
+        @cores: list of CoreIDs
+        """
+        path = self.__path(table, model)
+        if not os.path.isdir(path):
+            return []
+        return sorted(name.split('=', 1)[1] for name in os.listdir(path) if name.startswith('coreid='))
+
+    def iteration_columns(self, model):
+        """
+        Function to get the names of the iteration columns of a model without reading the iterations
+
+        returns:
+        @columns: list of names of the iteration columns (as strings)
+        """
+        dataset = self.__dataset('iterations', model)
+        if dataset is None:
+            return []
+        return [name for name in dataset.schema.names if name not in LABEL_COLUMNS + ['coreid']]
+
+    def iteration_rows(self, model, core, columns = None):
+        """
+        Function to open the iterations of one core for reading ranges of depths, e.g. block by block for the out-of-core
+        sedimentation rates, without reading the other depths
+
+        parameters:
+        @model: string of name of model
+        @core: CoreID
+        @columns: list or number of iteration columns that should be read; default value: None (all iterations)
+
+        returns:
+        @rows: StoredIterationRows object
+        """
+        path = self.__path('iterations', model, core)
+        files = sorted(name for name in os.listdir(path) if name.endswith('.parquet')) if os.path.isdir(path) else []
+        if len(files) != 1:
+            raise Exception(f'There are no iterations of {core} and {model} in the store {self.directory}')
+        return StoredIterationRows(os.path.join(path, files[0]), columns)
+
+    def read(self, table, model, cores = None, columns = None, depths = None):
+        """
+        Function to read one table of a model; only the files of the selected cores and only the selected columns are read
+
+        parameters:
+        @table: string of name of table ('iterations', 'age' or 'SR')
+        @model: string of name of model
+        @cores: list of CoreIDs; default value: None (all cores)
+        @columns: list of columns or, for the iterations, the number of iteration columns that should be read;
+        MeasurementID, model name and the key are always read; default value: None (all columns)
+        @depths: tuple with the upper and lower composite depth of the depths that should be read; default value: None (all depths)
+
+        returns:
+        @data: dataframe with the key index (coreid, compositedepth), sorted by the key except for sedimentation rates
+        """
+        dataset = self.__dataset(table, model)
+        if dataset is None:
+            raise Exception(f'There are no {table} results of {model} in the store {self.directory}')
+        names = [name for name in dataset.schema.names if name != 'coreid']
+        if columns is not None:
+            if isinstance(columns, (int, np.integer)):
+                columns = [name for name in names if name not in LABEL_COLUMNS][:columns]
+            columns = [str(column) for column in columns]
+            names = [name for name in names if name in LABEL_COLUMNS or name in columns]
+        expression = None
+        if cores is not None:
+            expression = ds.field('coreid').isin([str(core) for core in cores])
+        if depths is not None:
+            in_range = (ds.field('compositedepth') >= depths[0]) & (ds.field('compositedepth') <= depths[1])
+            expression = in_range if expression is None else expression & in_range
+        data = dataset.to_table(columns = names + ['coreid'], filter = expression).to_pandas()
+        data['coreid'] = pd.Categorical(data['coreid'])
+        data = data.set_index(KEY_NAMES)
+        return as_categorical(set_key_index(data, sort = table != 'SR'))
+
+    def load_model(self, model, cores = None, columns = None):
+        """
+        Function to get an object that stands in for the aggregation object of a model and reads its results from the
+        store on first use, e.g. for CalculateSediRate, CalculateSediRateModels or PushIt after a restart of the kernel
+
+        parameters:
+        @model: string of name of model
+        @cores: list of CoreIDs; default value: None (all cores)
+        @columns: list or number of iteration columns that should be read; default value: None (all iterations)
+
+        returns:
+        @agg: StoredModel object
+        """
+        return StoredModel(self, model, cores, columns)
+
+    def plot_data(self, models = None, cores = None):
+        """
+        Function to read the aggregated ages and sedimentation rates of several models for PlotAgeSR without reading the iterations
+
+        parameters:
+        @models: list of names of models; default value: None (all models with ages and sedimentation rates)
+        @cores: list of CoreIDs; default value: None (all cores)
+
+        returns:
+        @plot_data: dictionary with lists of the aggregated ages and sedimentation rates indexed by model
+        """
+        if models is None:
+            models = [model for model in self.models('age') if self.has('SR', model)]
+        return {model: [self.read('age', model, cores), self.read('SR', model, cores)] for model in models}
+
+class StoredModel(object):
+    def __init__(self, store, model, cores = None, columns = None):
+        """
+        Aggregation object of one model whose results (age_model_result_<model>, <model>_core_results,
+        SR_model_result_<model>, dttp) are only read from the store when they are used for the first time
+
+        parameters:
+        @self.store: ResultsStore with the results
+        @self.model: string of name of model
+        @self.cores: list of CoreIDs that are read; default value: None (all cores)
+        @self.columns: list or number of iteration columns that are read; default value: None (all iterations)
+        """
+        self.store = store
+        self.model = model
+        self.cores = cores
+        self.columns = columns
+
+    def __getattr__(self, name):
+        """
+        Helper function to read a table the first time its attribute is used; afterwards it is an ordinary attribute
+        """
+        if name.startswith('__') or name in ('store','model','cores','columns'):
+            raise AttributeError(name)
+        for table, attribute in STORE_TABLES.items():
+            if name == attribute.format(model = self.model) and self.store.has(table, self.model):
+                data = self.store.read(table, self.model, self.cores, self.columns if table == 'iterations' else None)
+                setattr(self, name, data)
+                return data
+        if name == 'dttp' and self.store.has('age', self.model):
+            preselection = getattr(self, f'age_model_result_{self.model}')['preselection']
+            #### Preselection is set per core, the model counts as corrected if at least one core was corrected
+            return 'Yes' if (preselection.astype(str) == 'Yes').any() else 'No'
+        raise AttributeError(name)
+
+    def stored_iterations(self):
+        """
+        Function to get the iterations of the model as they are on disk, which are kept as attribute, so that the cache of
+        the sedimentation rates recognizes them on later calls
+
+        returns:
+        @iterations: StoredIterations object
+        """
+        if 'iterations' not in vars(self):
+            self.iterations = StoredIterations(self.store, self.model, self.cores, self.columns)
+        return self.iterations
+
+class StoredIterations(object):
+    def __init__(self, store, model, cores = None, columns = None):
+        """
+        Iterations of one model that stay in the store and are only read core by core and block by block, used by
+        CalculateSediRate in the out-of-core mode instead of the iteration dataframe
+
+        parameters:
+        @self.store: ResultsStore with the iterations
+        @self.model: string of name of model
+        @self.cores: list of CoreIDs; default value: None (all cores)
+        @self.columns: list or number of iteration columns that are read; default value: None (all iterations)
+        """
+        self.store = store
+        self.model = model
+        self.cores = cores
+        self.columns = columns
+
+    def core_list(self):
+        """
+        Function to list the cores with iterations in the store
+
+        returns:
+        @cores: list of CoreIDs
+        """
+        cores = self.store.cores(self.model, 'iterations')
+        if self.cores is not None:
+            cores = [core for core in cores if core in [str(selected) for selected in self.cores]]
+        return cores
+
+    def rows(self, core):
+        """
+        Function to open the iterations of one core (see ResultsStore.iteration_rows)
+        """
+        return self.store.iteration_rows(self.model, core, self.columns)
+
+class StoredIterationRows(object):
+    def __init__(self, path, columns = None):
+        """
+        Iterations of one core in a Parquet file that can be sliced like an array (depth x iteration); a slice of depths
+        only reads the row groups that hold them, the last row groups that were read are kept for the next slice
+
+        parameters:
+        @path: string with the location of the Parquet file
+        @columns: list or number of iteration columns that should be read; default value: None (all iterations)
+
+        returns:
+        @self.columns: list with the names of the iteration columns
+        @self.shape: tuple with the number of depths and iterations
+        @self.depths: float array with the composite depth of every row, sorted
+        @self.measurementid: array with the MeasurementID of every row
+        @self.model_name: array with the model name of every row
+        """
+        self.file = pq.ParquetFile(path)
+        names = [name for name in self.file.schema_arrow.names if name not in LABEL_COLUMNS + ['coreid']]
+        if isinstance(columns, (int, np.integer)):
+            names = names[:columns]
+        elif columns is not None:
+            names = [name for name in names if name in [str(column) for column in columns]]
+        self.columns = names
+        sizes = [self.file.metadata.row_group(group).num_rows for group in range(self.file.num_row_groups)]
+        self.offsets = np.concatenate(([0], np.cumsum(sizes, dtype = np.int64)))
+        self.shape = (int(self.offsets[-1]), len(self.columns))
+        labels = self.file.read(columns = LABEL_COLUMNS).to_pandas()
+        self.depths = labels['compositedepth'].to_numpy(dtype = np.float64)
+        self.measurementid = labels['measurementid'].to_numpy()
+        self.model_name = labels['model_name'].to_numpy()
+        self.__groups = None
+        self.__block = None
+
+    def __len__(self):
+        """
+        Helper function to get the number of depths
+        """
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        """
+        Function to read a range of depths
+
+        parameters:
+        @rows: slice of depths
+
+        returns:
+        @ages: float64 array (depth x iteration) with the iterations of the depths
+        """
+        start, stop, step = rows.indices(len(self))
+        if step != 1:
+            raise Exception('Only ranges of consecutive depths can be read from the store')
+        if start >= stop:
+            return np.empty((0, self.shape[1]), dtype = np.float64)
+        first = int(np.searchsorted(self.offsets, start, side = 'right')) - 1
+        last = int(np.searchsorted(self.offsets, stop, side = 'left'))
+        if self.__groups != (first, last):
+            table = self.file.read_row_groups(list(range(first, last)), columns = self.columns)
+            self.__block = table.to_pandas().to_numpy(dtype = np.float64)
+            self.__groups = (first, last)
+        offset = self.offsets[first]
+        return self.__block[start - offset:stop - offset]
@@ -10,45 +10,217 @@ github: GPawi
 import numpy as np
 import pandas as pd
 import os
+import atexit
+import weakref
+import tempfile
 import dask
 import dask.distributed
-from dask.distributed import Client , LocalCluster
-import joblib
-import multiprocessing
+from dask.distributed import Client , LocalCluster, as_completed
 import warnings
 import logging
-
-tmp_path = "/tmp"
+from .summary_stats import confidence_intervals, QuantileSketch, SKETCH_SIZE
+from .measurement_keys import depth_keys, frame_keys, has_key_index, set_key_index, as_categorical, iteration_labels
+from .ragged_iterations import to_ragged
+from .results_store import StoredModel, StoredIterations
+from .aggregate_data import read_temage, undatable_measurementid
 
 logging.getLogger("distributed").setLevel(logging.ERROR)
 logging.getLogger("distributed.diskutils").setLevel(logging.CRITICAL)
 logging.getLogger("distributed.worker").setLevel(logging.ERROR)
-dask.config.set({
-    'temporary-directory': tmp_path,
-    'distributed.comm.timeouts.tcp': "90s",
-    'distributed.worker.memory.target': 0.6,
-    'distributed.worker.memory.spill': 0.7,
-    'distributed.worker.memory.pause': 0.8,
-    'distributed.worker.memory.terminate': 0.95})
 warnings.simplefilter(action='ignore', category=pd.errors.PerformanceWarning)
 
+#### Depths behind (lag) and ahead (lead) of each depth that span the window of a sedimentation rate mode
+SR_WINDOWS = {'naive': (0, 1),
+              'move_three': (1, 1),
+              'move_five': (2, 2)}
+
+def sr_window(mode):
+    """
+    Helper function to get the window of a sedimentation rate mode
+    
+    parameters:
+    @mode: string of mode; options are 'naive', 'move_three', 'move_five', and 'move_k' for any odd window k >= 3
+    
+    returns:
+    @window: tuple with the number of depths behind (lag) and ahead (lead), or None for unknown modes
+    """
+    if mode in SR_WINDOWS:
+        return SR_WINDOWS[mode]
+    size = str(mode)[len('move_'):]
+    if str(mode).startswith('move_') and size.isdigit() and int(size) >= 3 and int(size) % 2 == 1:
+        return (int(size) // 2, int(size) // 2)
+    return None
+
+def sr_modes(mode):
+    """
+    Helper function to turn a mode or a list of modes into a list of unique modes
+    
+    parameters:
+    @mode: string of mode or list of modes
+    
+    returns:
+    @modes: list of modes in the given order without duplicates
+    """
+    if isinstance(mode, str):
+        return [mode]
+    return list(dict.fromkeys(mode))
+
+#### Number of ages (depths x iterations) above which a single core is split into chunks of depths on the cluster
+PARALLEL_MIN_AGES = 10000000
+
+#### Columns of the summarized sedimentation rate results
+SR_COLUMNS = ['SR_median',
+              'SR_mean',
+              'SR_lower_2_sigma',
+              'SR_lower_1_sigma',
+              'SR_upper_1_sigma',
+              'SR_upper_2_sigma',
+              'measurementid',
+              'model_name',
+              'SR_mode']
+
+
+class DaskClusterManager(object):
+    def __init__(self, n_workers = None, threads_per_worker = None, memory_limit = 'auto', spill_directory = None, compress_spill = False):
+        """
+        parameters:
+        @self.n_workers: number of worker processes; default value: None (chosen by dask based on the available CPUs)
+        @self.threads_per_worker: number of threads per worker process; default value: None (chosen by dask)
+        @self.memory_limit: memory limit per worker, such as '4GB'; default value: 'auto' (memory divided by workers)
+        @self.spill_directory: directory where workers spill data to disk; default value: None 
+        (environment variable LANDO_SPILL_DIR or, if not set, the temporary directory of the system)
+        @self.compress_spill: boolean value, if data spilled to disk should be compressed; default value: False
+        """
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker
+        self.memory_limit = memory_limit
+        if spill_directory is None:
+            spill_directory = os.environ.get('LANDO_SPILL_DIR', tempfile.gettempdir())
+        self.spill_directory = spill_directory
+        self.compress_spill = compress_spill
+        self.cluster = None
+        self.client = None
+        self.config = None
+    
+    def start(self):
+        """
+        Function to start the local cluster, or to reuse it if it is already running
+        
+        returns:
+        @self.client: dask client connected to the local cluster
+        """
+        if self.client is not None and self.client.status == 'running':
+            return self.client
+        self.shutdown()
+        os.makedirs(self.spill_directory, exist_ok = True)
+        #### The settings only hold while the cluster is running, the earlier settings are restored by shutdown
+        self.config = dask.config.set({
+            'temporary-directory': self.spill_directory,
+            'distributed.comm.timeouts.tcp': "90s",
+            'distributed.worker.memory.target': 0.6,
+            'distributed.worker.memory.spill': 0.7,
+            'distributed.worker.memory.pause': 0.8,
+            'distributed.worker.memory.terminate': 0.95,
+            'distributed.worker.memory.spill-compression': 'auto' if self.compress_spill else False})
+        try:
+            self.cluster = LocalCluster(scheduler_port = 0,
+                                        n_workers = self.n_workers,
+                                        threads_per_worker = self.threads_per_worker,
+                                        memory_limit = self.memory_limit,
+                                        local_directory = self.spill_directory)
+            self.client = Client(self.cluster, timeout="90s")
+        except Exception:
+            self.shutdown()
+            raise
+        return self.client
+    
+    def shutdown(self):
+        """
+        Function to close the client and the local cluster and to restore the dask settings from before the start
+        """
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        if self.cluster is not None:
+            self.cluster.close()
+            self.cluster = None
+        if self.config is not None:
+            self.config.__exit__(None, None, None)
+            self.config = None
+
+#### Cluster shared by all sedimentation rate calculations of one session
+cluster_manager = None
+
+def start_cluster(**kwargs):
+    """
+    Function to start the cluster that is shared by all sedimentation rate calculations; a running cluster is reused 
+    unless new settings are given
+    
+    parameters:
+    @kwargs: settings passed on to DaskClusterManager, such as n_workers, threads_per_worker, memory_limit, 
+    spill_directory, and compress_spill
+    
+    returns:
+    @client: dask client connected to the shared local cluster
+    """
+    global cluster_manager
+    if cluster_manager is None or kwargs:
+        shutdown_cluster()
+        cluster_manager = DaskClusterManager(**kwargs)
+    return cluster_manager.start()
+
+def shutdown_cluster():
+    """
+    Function to shut down the cluster that is shared by all sedimentation rate calculations
+    """
+    if cluster_manager is not None:
+        cluster_manager.shutdown()
+
+atexit.register(shutdown_cluster)
+
 
 class CalculateSediRate(object):
-    def __init__(self, agg, model, coreid, mode):
+    def __init__(self, agg, model, coreid, mode, block_size = None, directory = None, approximate = False, sketch_size = SKETCH_SIZE, 
+                 keep_posterior = False, chunk_size = None):
         """
         parameters:
         @self.agg: object containing the results from the aggregation function
         @self.coreids: list of CoreIDs used within the LANDO environment
         @self.mode: string of mode that should be used for sedimentation rate calculation; options are 'naive',
-        'move_three', and 'move_five' 
+        'move_three', 'move_five', and 'move_k' for any odd window k (e.g. 'move_7'), or a list of modes, 
+        which are calculated together from one read of the iterations
         @self.model: string of name of model that the aggregation object is coming from
         @self.core_results: model-specific 10,000 iteration results with MeasurementID and model name added
+        @self.block_size: number of depths per block for the out-of-core mode, in which the iterations of each core are 
+        streamed block by block: from the files of a ResultsStore (agg from ResultsStore.load_model) or the binary files 
+        of the Undatable wrapper, or from the iteration dataframe without copying the core; default value: None 
+        (everything is calculated in memory)
+        @self.directory: directory for the memory-mapped summaries (and kept iterations) of the out-of-core mode, which are 
+        kept after the calculation; default value: None (temporary directory in LANDO_SPILL_DIR that is removed afterwards)
+        @self.approximate: boolean value, if the quantiles should be approximated with a mergeable quantile sketch that 
+        summarizes the iterations in chunks instead of all at once (see summary_stats.QuantileSketch for the error bound); 
+        default value: False
+        @self.sketch_size: number of values per depth and level of the quantile sketch; default value: SKETCH_SIZE
+        @self.keep_posterior: boolean value, if the sedimentation rate iterations of each core should be kept as float32 
+        array with the composite depths, which can be read with get_SR_posterior; default value: False
+        @self.chunk_size: number of depths per job, when the sedimentation rates of a single core are split over the workers 
+        of the cluster, or 0 to calculate single cores without the cluster; default value: None (cores with more than 
+        PARALLEL_MIN_AGES ages are split into two jobs per worker thread)
         """
         self.agg = agg
         self.coreid = coreid
         self.mode = mode
         self.model = model
-        if self.model == 'Undatable':
+        self.block_size = block_size
+        self.directory = directory
+        self.approximate = approximate
+        self.sketch_size = sketch_size
+        self.keep_posterior = keep_posterior
+        self.chunk_size = chunk_size
+        if self.block_size is not None and isinstance(agg, StoredModel) and f'{self.model}_core_results' not in vars(agg):
+            #### Iterations in the store stay on disk and are read block by block
+            self.core_results = agg.stored_iterations()
+        elif self.model == 'Undatable':
             self.core_results = agg.Undatable_core_results
         elif self.model == 'Bchron':
             self.core_results = agg.Bchron_core_results
@@ -63,227 +235,290 @@ class CalculateSediRate(object):
         else: 
             raise Exception(f'Please specify the model that you are using')
     
-    def __prep_for_par(self, data):
+    def __sed_rate(self, core_results, mode):
         """
-        Helper function to prepare dataframe to work in parallel
+        Helper function to calculate sedimentation rate based on the mode selected
+        
+        parameters:
+        @core_results: model-specific 10,000 iteration results with MeasurementID and model name added
+        @mode: string of mode or list of modes that should be used for sedimentation rate calculation
         
         returns:
-        @data: dataframe sorted by MeasurementID, where composite depth is sorted numeric not as string
-        and index set to multiindex consisting of MeasurementID, model name and CoreID
+        @sed_frame: numpy array with 10,000 results from the sedimentation rate calculation
+        @posterior: list of float32 arrays with the sedimentation rate iterations of each mode, only with keep_posterior
         """
-        data[['coreid','compositedepth']] = data['measurementid'].str.split(' ', n = 1, expand = True)
-        data = data.astype(dtype = {'compositedepth' : float}).sort_values(by = ['coreid', 'compositedepth'], ignore_index = True)
-        data.drop(['compositedepth'], axis = 1, inplace = True)
-        data = data.set_index(['measurementid','model_name','coreid'])
-        return data    
-
-    def __confidence_intervals(self, g):
+        return sed_rate_multi(core_results, mode, self.approximate, self.sketch_size, self.keep_posterior)
+    
+    def __SR_single(self, modes):
         """
-        Helper function to get basic statistics (median, mean, 1-sigma range, 2-sigma range)
+        Helper function to calculate sedimentation rates for a single sediment core, split into chunks of depths
+        on the cluster if the core is long
+        
+        parameters:
+        @modes: list of modes that should be calculated
         
         returns:
-        @median: median value of input data
-        @mean:  mean value of input data
-        @two_sigma_lo: lower boundary value of 2-sigma range of input data
-        @one_sigma_lo: lower boundary value of 1-sigma range of input data
-        @one_sigma_hi: upper boundary value of 1-sigma range of input data
-        @two_sigma_hi: upper boundary value of 2-sigma range of input data
-        """
-        median = g.median()
-        mean = g.mean()
-        two_sigma_hi = g.quantile(q = 0.954, interpolation = 'nearest') 
-        two_sigma_lo = g.quantile(q = 0.046, interpolation = 'nearest')
-        one_sigma_hi = g.quantile(q = 0.683, interpolation = 'nearest') 
-        one_sigma_lo = g.quantile(q = 0.317, interpolation = 'nearest')
-        return median, mean, two_sigma_lo, one_sigma_lo, one_sigma_hi, two_sigma_hi
+        @out: dictionary with tuples of the summarized sedimentation rates and the kept iterations (or None)
+        indexed by CoreID and mode
+        """
+        #### Only the rows of the core are used, so the cached results do not hold other cores of the same iterations
+        ragged = to_ragged(self.core_results, self.coreid)
+        if self.coreid[0] not in ragged:
+            return {}
+        par_df = ragged.frame(self.coreid[0])
+        chunk_size = self.chunk_size
+        if chunk_size is None and par_df.size > PARALLEL_MIN_AGES:
+            client = start_cluster()
+            chunk_size = -(-len(par_df) // (2 * max(sum(client.nthreads().values()), 1)))
+        if not chunk_size:
+            return self.__split_modes(self.coreid[0], modes, self.__sed_rate(par_df, modes), par_df.index)
+        client = start_cluster()
+        print(f'Calculating sedimentation rates for {-(-len(par_df) // chunk_size)} chunks of depths')
+        result = sed_rate_chunked(client, par_df, modes, chunk_size, self.approximate, self.sketch_size, self.keep_posterior)
+        return self.__split_modes(self.coreid[0], modes, result, par_df.index)
     
-    def __sed_rate(self, core_results, mode):
+    def __SR_multi(self):
         """
-        Helper function to calculate sedimentation rate based on the mode selected
+        Helper function to calculate sedimentation rates in parallel for multiple sediment cores
+        
+        returns:
+        @out: dictionary with tuples of the summarized sedimentation rates and the kept iterations (or None)
+        indexed by CoreID and mode
+        """
+        jobs = self.SR_jobs()
+        ###
+        #### Errors are raised after run_SR_jobs has cancelled the jobs that are still running, the cluster stays usable
+        client = start_cluster()
+        print(f'Calculating sedimentation rates for {len(jobs)} sediment cores')
+        results = run_SR_jobs(client, jobs)
+        return self.__split_results(results)
+    
+    def __iteration_sources(self, coreid):
+        """
+        Helper function to get the iterations of each core as array that is read block by block: the files of the store
+        and the binary files of the Undatable wrapper are read where they are, so the iteration dataframe is not needed;
+        iterations that are held as dataframe are read from it block by block (see FrameIterationRows)
         
         parameters:
-        @core_results: model-specific 10,000 iteration results with MeasurementID and model name added
-        @mode: string of mode that should be used for sedimentation rate calculation; options are 'naive',
-        'move_three', and 'move_five' 
+        @coreid: list of CoreIDs that should be calculated
         
         returns:
-        @sed_frame: numpy array with 10,000 results from the sedimentation rate calculation
+        @sources: generator of tuples of CoreID, array (depth x iteration) sorted by depth, boolean array marking 
+        iterations without missing values, and arrays with the composite depths, MeasurementIDs and model names
+        """
+        block_size = self.block_size
+        if isinstance(self.core_results, StoredIterations):
+            for core in self.core_results.core_list():
+                if core in coreid:
+                    ages = self.core_results.rows(core)
+                    yield core, ages, complete_columns(ages, block_size), ages.depths, ages.measurementid, ages.model_name
+            return
+        files = getattr(self.agg, 'Undatable_iteration_files', {}) if self.model == 'Undatable' else {}
+        groups = None
+        for core in coreid:
+            if core in files:
+                depths, ages = read_temage(files[core])
+                measurementid = pd.Series(undatable_measurementid(core, depths))
+                depths = depth_keys(measurementid)['compositedepth'].to_numpy()
+                #### Depths that are not in order are sorted with the dataframe below
+                if np.all(depths[1:] >= depths[:-1]):
+                    yield (core, ages, complete_columns(ages, block_size), depths, measurementid.to_numpy(), 
+                           np.repeat(self.model, len(depths)))
+                    continue
+            if groups is None:
+                #### Only the keys are sorted, the iterations are read block by block in this order
+                keys = frame_keys(self.core_results, sort = True)
+                groups = keys.groupby('coreid', sort = False, observed = True).groups
+                iteration_columns = iteration_labels(self.core_results)
+            if core not in groups:
+                continue
+            rows = np.asarray(groups[core])
+            ages = FrameIterationRows(self.core_results, rows, iteration_columns)
+            yield (core, ages, complete_columns(ages, block_size), keys.loc[rows, 'compositedepth'].to_numpy(), 
+                   self.core_results['measurementid'].to_numpy()[rows], self.core_results['model_name'].to_numpy()[rows])
+    
+    def __SR_out_of_core(self, directory, coreid, modes):
         """
-        ages = core_results.copy()
-        core_results.reset_index(inplace = True)
-        #####
-        sed_frame = pd.DataFrame()
-        sedimentation_rate = []
-        for i in range(len(ages)):       
-            try:        
-                if mode == 'naive':          ## ('naive') - Naive approach: sedimentation rate(x) = (depth(x)-depth(x-1)) / (age(x)-age(x-1))
-                    sedimentation_step = pd.DataFrame(np.asarray([1/(ages.iloc[i+1] - ages.iloc[i])], dtype = np.float64))
-                    if sedimentation_step.mean().min() < 0:
-                        sedimentation_step = pd.DataFrame(np.asarray([[0] * len(ages.columns)], dtype = np.float64))
-                    sed_frame = pd.concat([sed_frame,sedimentation_step])
+        Helper function to calculate sedimentation rates core by core and block by block, so that the memory used
+        by the calculation depends on the block size instead of the core length
         
-                elif mode == 'move_three':   ## ('move_three') - Moving average over three depths: sedimentation rate(x) = (depth(x+1)-depth(x-1)) / (age(x+1)-age(x-1))
-                    sedimentation_step = pd.DataFrame(np.asarray([2/(ages.iloc[i+1] - ages.iloc[i-1])], dtype = np.float64))
-                    if sedimentation_step.mean().min() < 0:
-                        sedimentation_step = pd.DataFrame(np.asarray([[0] * len(ages.columns)], dtype = np.float64))
-                    sed_frame = pd.concat([sed_frame,sedimentation_step])
-    
-                elif mode == 'move_five':    ## ('move_five') - Moving average over five depths: sedimentation rate(x) = (depth(x+2)-depth(x-2)) / (age(x+2)-age(x-2))
-                    sedimentation_step = pd.DataFrame(np.asarray([4/(ages.iloc[i+2] - ages.iloc[i-2])], dtype = np.float64))
-                    if sedimentation_step.mean().min() < 0:
-                        sedimentation_step = pd.DataFrame(np.asarray([[0] * len(ages.columns)], dtype = np.float64))
-                    sed_frame = pd.concat([sed_frame,sedimentation_step])
-                
-                else: 
-                    sedimentation_step = pd.DataFrame(np.asarray([[0] * len(ages.columns)], dtype = np.float64))
-                    sed_frame = pd.concat([sed_frame,sedimentation_step])
-    
-            except:
-                sedimentation_step = pd.DataFrame(np.asarray([[0] * len(ages.columns)], dtype = np.float64))
-                sed_frame = pd.concat([sed_frame,sedimentation_step])
-        ####
-        sed_frame.reset_index(drop = True, inplace = True)
-        sed_frame.replace([np.inf, -np.inf], 0, inplace=True)
-        sed_frame = sed_frame.apply(self.__confidence_intervals, axis = 1, result_type='expand')
-        sed_frame[['measurementid','model_name']] = core_results[['measurementid','model_name']]
-        sed_frame['SR_mode'] = mode
+        parameters:
+        @directory: directory where the summaries (and kept iterations) of each core are written to
+        @coreid: list of CoreIDs that should be calculated
+        @modes: list of modes that should be calculated
         
-        return sed_frame.to_numpy()
+        returns:
+        @out: dictionary with tuples of the summarized sedimentation rates and the kept iterations (or None)
+        indexed by CoreID and mode
+        """
+        block_size = self.block_size
+        out = {}
+        for core, ages, complete, depths, measurementid, model_name in self.__iteration_sources(coreid):
+            posterior = None
+            if self.keep_posterior:
+                posterior = [np.lib.format.open_memmap(os.path.join(directory, f'{self.model}_{core}_SR_{mode}_posterior.npy'), mode = 'w+',
+                                                       dtype = np.float32, shape = (len(depths), int(complete.sum()))) for mode in modes]
+            summaries = sed_rate_out_of_core(ages, modes, block_size, os.path.join(directory, f'{self.model}_{core}_SR_{{mode}}.npy'), 
+                                             columns = complete, approximate = self.approximate, sketch_size = self.sketch_size,
+                                             posterior = posterior)
+            for position, (mode, summary) in enumerate(zip(modes, summaries)):
+                partial = pd.DataFrame(np.asarray(summary), columns = SR_COLUMNS[:6])
+                partial['measurementid'] = measurementid
+                partial['model_name'] = model_name
+                partial['SR_mode'] = mode
+                kept = None
+                if posterior is not None:
+                    posterior[position].flush()
+                    #### Files in a temporary directory are removed afterwards, so their iterations are loaded
+                    kept = (depths, posterior[position] if self.directory is not None else np.array(posterior[position]))
+                out[(core, mode)] = (partial.to_numpy(), kept)
+            del ages, summaries, posterior
+        return out
     
-    def __split_list(self, original_list):
+    def __split_modes(self, core, modes, result, index):
         """
-        Helper function to split list of CoreID into two lists
+        Helper function to split the output of sed_rate_multi into the results of each mode
+        
+        parameters:
+        @core: CoreID of the results
+        @modes: list of modes that were calculated
+        @result: output of sed_rate_multi
+        @index: multiindex of the input of sed_rate_multi with the MeasurementIDs in the order of the results
         
         returns:
-        two lists containing the original list split by its half
+        @out: dictionary with tuples of the summarized sedimentation rates and the kept iterations (or None)
+        indexed by CoreID and mode
         """
-        half = len(original_list)//2
-        return original_list[:half], original_list[half:]
-
+        posterior = [None] * len(modes)
+        if self.keep_posterior:
+            result, posterior = result
+            depths = depth_keys(index.get_level_values('measurementid').to_series())['compositedepth'].to_numpy()
+            posterior = [(depths, rates) for rates in posterior]
+        return {(core, mode): (summary, kept) for mode, summary, kept in zip(modes, np.split(result, len(modes)), posterior)}
     
-    def __SR_multi(self):
+    def __split_results(self, results):
         """
-        Helper function to calculate sedimentation rates in parallel for multiple sediment cores
+        Helper function to split the outputs of the jobs from SR_jobs into the results of each core and mode
+        
+        parameters:
+        @results: dictionary with the output of sed_rate_multi indexed by CoreID
+        
+        returns:
+        @out: dictionary with tuples of the summarized sedimentation rates and the kept iterations (or None)
+        indexed by CoreID and mode
+        """
+        out = {}
+        for core, result in results.items():
+            out.update(self.__split_modes(core, self.__job_modes, result, self.__job_index[core]))
+        return out
+    
+    def __SR_cache(self):
+        """
+        Helper function to get the cache of summarized sedimentation rates, which is kept with the aggregation object
+        and indexed by model, CoreID, mode and sketch size (None for exact results); entries of iterations that have 
+        been replaced are not used
+        
+        returns:
+        @cache: dictionary with tuples of a reference to the iterations, the summarized sedimentation rates and
+        the kept iterations (None if they were not kept)
+        """
+        cache = getattr(self.agg, 'SR_cache', None)
+        if cache is None:
+            cache = {}
+            self.agg.SR_cache = cache
+        return cache
+    
+    def __cached(self, core, mode):
+        """
+        Helper function to check if the cache holds the results of a core and mode for the current iterations
+        
+        returns:
+        @cached: boolean value, if the results can be taken from the cache
+        """
+        statistics = self.sketch_size if self.approximate else None
+        entry = self.__SR_cache().get((self.model, core, mode, statistics))
+        return entry is not None and entry[0]() is self.core_results and (entry[2] is not None or not self.keep_posterior)
+    
+    def __pending(self):
+        """
+        Helper function to find the cores and modes that are not in the cache yet
+        
+        returns:
+        @pending_cores: list of CoreIDs with at least one mode that has to be calculated
+        @pending_modes: list of modes that have to be calculated for at least one core
+        """
+        modes = sr_modes(self.mode)
+        pending_cores = [core for core in self.coreid if not all(self.__cached(core, mode) for mode in modes)]
+        pending_modes = [mode for mode in modes if not all(self.__cached(core, mode) for core in self.coreid)]
+        return pending_cores, pending_modes
+    
+    def SR_jobs(self, keys = None):
+        """
+        Function to prepare one sedimentation rate job per core that is not in the cache yet, so that the jobs can be 
+        scheduled together with the jobs of other models; the results are handed back with collect_SR
+        
+        parameters:
+        @keys: dataframe with the columns coreid and compositedepth for every row of the iterations, e.g. from frame_keys
+        for several models at once; default value: None (taken from the key index or created from the MeasurementIDs)
         
         returns:
-        @Out_p: dataframe containing the summarizing statistics from the sedimentation rate calculation for multiple cores
+        @jobs: dictionary with tuples of the arguments for sed_rate_multi indexed by CoreID
         """
         core_results = self.core_results
-        coreid = self.coreid
-        mode = self.mode
-        ###
-        par_df = self.__prep_for_par(core_results)
-        ###
-        with LocalCluster(scheduler_port = 0) as cluster, Client(cluster, timeout="90s") as client:
-            try:
-                #### This section splits calculation into two parts, if number of sediment cores is bigger than twice the available number of threads
-                if len(coreid) > 2*multiprocessing.cpu_count(): 
-                    coreid_split_1, coreid_split_2 = self.__split_list(coreid)
-                    ###
-                    par_df_1 = par_df[par_df.index.get_level_values('coreid').isin(coreid_split_1)]
-                    par_df_2 = par_df[par_df.index.get_level_values('coreid').isin(coreid_split_2)]
-                    ###
-                    print(f'Calculating first batch with {len(coreid_split_1)} sediment cores')
-                    with joblib.parallel_backend('dask'):
-                        self.out1 = joblib.Parallel(n_jobs = -1, verbose=100)(
-                            joblib.delayed(sed_rate_multi)(par_df_1[par_df_1.index.get_level_values('coreid') == i].dropna(axis = 1), mode = mode)
-                            for i in coreid_split_1)
-                    print(f'Calculating second batch with {len(coreid_split_2)} sediment cores')
-                    with joblib.parallel_backend('dask'):
-                        self.out2 = joblib.Parallel(n_jobs = -1, verbose=100)(
-                            joblib.delayed(sed_rate_multi)(par_df_2[par_df_2.index.get_level_values('coreid') == i].dropna(axis = 1), mode = mode)
-                            for i in coreid_split_2)
-                    ###
-                    self.out = self.out1 + self.out2
-                
-                #### This section splits calculation into four parts, if number of sediment cores is bigger than four times the available number of threads    
-                elif len(coreid) > 4*multiprocessing.cpu_count():
-                    split_A, split_B = self.__split_list(coreid)
-                    coreid_split_1, coreid_split_2 = self.__split_list(split_A)
-                    coreid_split_3, coreid_split_4 = self.__split_list(split_B)
-                    ###
-                    par_df_1 = par_df[par_df.index.get_level_values('coreid').isin(coreid_split_1)]
-                    par_df_2 = par_df[par_df.index.get_level_values('coreid').isin(coreid_split_2)]
-                    par_df_3 = par_df[par_df.index.get_level_values('coreid').isin(coreid_split_3)]
-                    par_df_4 = par_df[par_df.index.get_level_values('coreid').isin(coreid_split_4)]
-                    ###
-                    print(f'Calculating first batch with {len(coreid_split_1)} sediment cores')
-                    with joblib.parallel_backend('dask'):
-                        self.out1 = joblib.Parallel(n_jobs = -1, verbose=100)(
-                            joblib.delayed(sed_rate_multi)(par_df_1[par_df_1.index.get_level_values('coreid') == i].dropna(axis = 1), mode = mode)
-                            for i in coreid_split_1)
-                    print(f'Calculating second batch with {len(coreid_split_2)} sediment cores')
-                    with joblib.parallel_backend('dask'):
-                        self.out2 = joblib.Parallel(n_jobs = -1, verbose=100)(
-                            joblib.delayed(sed_rate_multi)(par_df_2[par_df_2.index.get_level_values('coreid') == i].dropna(axis = 1), mode = mode)
-                            for i in coreid_split_2)
-                    print(f'Calculating third batch with {len(coreid_split_2)} sediment cores')     
-                    with joblib.parallel_backend('dask'):
-                        self.out3 = joblib.Parallel(n_jobs = -1, verbose=100)(
-                            joblib.delayed(sed_rate_multi)(par_df_3[par_df_3.index.get_level_values('coreid') == i].dropna(axis = 1), mode = mode)
-                            for i in coreid_split_3)
-                    print(f'Calculating fourth batch with {len(coreid_split_4)} sediment cores')
-                    with joblib.parallel_backend('dask'):
-                        self.out4 = joblib.Parallel(n_jobs = -1, verbose=100)(
-                            joblib.delayed(sed_rate_multi)(par_df_4[par_df_4.index.get_level_values('coreid') == i].dropna(axis = 1), mode = mode)
-                            for i in coreid_split_4)
-                    ###
-                    self.out = self.out1 + self.out2 + self.out3 + self.out4
-                
-                else:
-                    with joblib.parallel_backend('dask'):
-                        self.out = joblib.Parallel(verbose=100)(
-                            joblib.delayed(sed_rate_multi)(par_df[par_df.index.get_level_values('coreid') == i].dropna(axis = 1), mode = mode)
-                            for i in coreid)
-            except: 
-                print('Caught an error - restart jupyter notebook!')
-                self.out = []
-        ###
-        if not self.out:
-            Out_p = []
-        else:
-            Out_p = pd.DataFrame()
-            for i in range(len(self.out)):
-                partial = pd.DataFrame(self.out[i])
-                Out_p = pd.concat([Out_p,partial], ignore_index = True)
-            Out_p.columns = ['SR_median',
-                             'SR_mean',
-                             'SR_lower_2_sigma',
-                             'SR_lower_1_sigma',
-                             'SR_upper_1_sigma',
-                             'SR_upper_2_sigma',
-                             'measurementid',
-                             'model_name',
-                             'SR_mode']
-        return Out_p
-
+        pending_cores, pending_modes = self.__pending()
+        self.__job_modes = pending_modes
+        self.__job_index = {}
+        if not pending_cores:
+            return {}
+        #### Every pending core is copied once without its missing iterations, the jobs are views of these copies
+        ragged = to_ragged(core_results, pending_cores, keys)
+        jobs = {}
+        for core in ragged.cores:
+            frame = ragged.frame(core)
+            self.__job_index[core] = frame.index
+            jobs[core] = (frame, pending_modes, self.approximate, self.sketch_size, self.keep_posterior)
+        return jobs
     
-    def calculating_SR(self):
+    def collect_SR(self, results):
+        """
+        Function to store the results of the jobs from SR_jobs and to create the variable based on model name
+        
+        parameters:
+        @results: dictionary with the output of sed_rate_multi indexed by CoreID
+        
+        returns:
+        @self.SR_model_result_{self.model}: dataframe containing the summarizing statistics from the sedimentation rate calculation
         """
-        Main function that calls helper functions and creates variable based on model name for summarized statistics of sedimentation rate
+        self.__store(self.__split_results(results))
+    
+    def __store(self, out):
+        """
+        Helper function to put new results into the cache and to create the variable based on model name from the cache
+        
+        parameters:
+        @out: dictionary with tuples of the summarized sedimentation rates and the kept iterations (or None)
+        indexed by CoreID and mode
         
         returns:
         @self.SR_model_result_{self.model}: dataframe containing the summarizing statistics from the sedimentation rate calculation
         """
         coreid = self.coreid
         core_results = self.core_results
-        mode = self.mode
+        modes = sr_modes(self.mode)
         if core_results is None:
             Out_p = []
-            print ('No sedimentation rate data available!')
         else:
-            if len(coreid) > 1:
-                Out_p = self.__SR_multi()
+            cache = self.__SR_cache()
+            statistics = self.sketch_size if self.approximate else None
+            for (core, mode), (result, kept) in out.items():
+                cache[(self.model, core, mode, statistics)] = (weakref.ref(core_results), result, kept)
+            partials = [cache[(self.model, core, mode, statistics)][1] for mode in modes for core in coreid if self.__cached(core, mode)]
+            if not partials:
+                Out_p = []
             else:
-                Out_p = pd.DataFrame(self.__sed_rate(self.__prep_for_par(core_results), mode), columns = ['SR_median',
-                                                                                                         'SR_mean',
-                                                                                                         'SR_lower_2_sigma',
-                                                                                                         'SR_lower_1_sigma',
-                                                                                                         'SR_upper_1_sigma',
-                                                                                                         'SR_upper_2_sigma',
-                                                                                                         'measurementid',
-                                                                                                         'model_name',
-                                                                                                         'SR_mode'])
+                #### The results of each mode are sorted by the key, so the modes are not mixed by sorting again
+                Out_p = set_key_index(pd.DataFrame(np.concatenate(partials), columns = SR_COLUMNS), sort = False)
+                Out_p = as_categorical(Out_p)
         if self.model == 'Undatable':
             self.SR_model_result_Undatable = Out_p
         elif self.model == 'Bchron':
@@ -298,59 +533,525 @@ class CalculateSediRate(object):
             self.SR_model_result_clam = Out_p       
         else: 
             raise Exception(f'Please specify the model that you are using')  
+    
+    def calculating_SR(self):
+        """
+        Main function that calls helper functions and creates variable based on model name for summarized statistics of sedimentation rate;
+        results of earlier calculations for the same model, core and mode are taken from the cache
+        
+        returns:
+        @self.SR_model_result_{self.model}: dataframe containing the summarizing statistics from the sedimentation rate calculation
+        """
+        coreid = self.coreid
+        core_results = self.core_results
+        out = {}
+        if core_results is None:
+            print ('No sedimentation rate data available!')
+        else:
+            pending_cores, pending_modes = self.__pending()
+            if not pending_cores:
+                pass
+            elif self.block_size is not None:
+                if self.directory is None:
+                    with tempfile.TemporaryDirectory(dir = os.environ.get('LANDO_SPILL_DIR', tempfile.gettempdir())) as directory:
+                        out = self.__SR_out_of_core(directory, pending_cores, pending_modes)
+                else:
+                    os.makedirs(self.directory, exist_ok = True)
+                    out = self.__SR_out_of_core(self.directory, pending_cores, pending_modes)
+            elif len(coreid) > 1:
+                out = self.__SR_multi()
+            else:
+                out = self.__SR_single(pending_modes)
+        self.__store(out)
+    
+    def get_SR_posterior(self, core, mode = None):
+        """
+        Function to get the sedimentation rate iterations of one core that were kept by calculating_SR with keep_posterior = True;
+        the dataframe is only created on request and shares the memory of the kept float32 array
+        
+        parameters:
+        @core: CoreID of the sediment core
+        @mode: string of mode of the sedimentation rates; default value: None (first mode in self.mode)
+        
+        returns:
+        @posterior: float32 dataframe (depth x iteration) with the sedimentation rate iterations indexed by composite depth
+        """
+        if mode is None:
+            mode = sr_modes(self.mode)[0]
+        statistics = self.sketch_size if self.approximate else None
+        entry = getattr(self.agg, 'SR_cache', {}).get((self.model, core, mode, statistics))
+        if entry is None or entry[0]() is not self.core_results or entry[2] is None:
+            raise Exception(f'No sedimentation rate iterations kept for {core} and {mode} - use keep_posterior = True and calculating_SR()')
+        depths, rates = entry[2]
+        return pd.DataFrame(rates, index = pd.Index(depths, name = 'compositedepth'), copy = False)
             
-def sed_rate_multi(core_results, mode):
+class CalculateSediRateModels(object):
+    def __init__(self, aggs, coreid, mode, approximate = False, sketch_size = SKETCH_SIZE, keep_posterior = False):
+        """
+        parameters:
+        @self.aggs: dictionary with the objects containing the results from the aggregation function indexed by model name, 
+        e.g. {'Bacon': aggBa, 'hamstr': aggh}
+        @self.coreid: list of CoreIDs used within the LANDO environment
+        @self.mode: string of mode or list of modes that should be used for sedimentation rate calculation (see CalculateSediRate)
+        @self.approximate: boolean value, if the quantiles should be approximated with a quantile sketch; default value: False
+        @self.sketch_size: number of values per depth and level of the quantile sketch; default value: SKETCH_SIZE
+        @self.keep_posterior: boolean value, if the sedimentation rate iterations should be kept; default value: False
+        @self.SR_models: dictionary with one CalculateSediRate object per model, e.g. to read kept iterations with get_SR_posterior
+        """
+        self.aggs = aggs
+        self.coreid = coreid
+        self.mode = mode
+        self.SR_models = {model: CalculateSediRate(agg, model, coreid, mode, approximate = approximate, sketch_size = sketch_size,
+                                                   keep_posterior = keep_posterior) for model, agg in aggs.items()}
+    
+    def calculating_SR(self):
+        """
+        Main function to calculate the sedimentation rates of all models at once: the keys of models with the key index
+        are taken from the index, the MeasurementIDs of the other models are split together in one call, and the jobs of 
+        all models and cores are scheduled on the shared cluster from one queue, so that the workers stay busy across the models
+        
+        returns:
+        @self.SR_model_result_{model}: dataframe containing the summarizing statistics from the sedimentation rate calculation 
+        for every model
+        @self.SR_model_results: dictionary with these dataframes indexed by model name
+        """
+        available = {model: SR for model, SR in self.SR_models.items() if SR.core_results is not None}
+        jobs = {}
+        if available:
+            keys = {model: frame_keys(SR.core_results) for model, SR in available.items() if has_key_index(SR.core_results)}
+            unkeyed = [model for model in available if model not in keys]
+            if unkeyed:
+                #### MeasurementIDs that the models share are only split once
+                split = depth_keys(pd.concat([available[model].core_results['measurementid'].astype(object) for model in unkeyed], 
+                                             ignore_index = True))
+                start = 0
+                for model in unkeyed:
+                    keys[model] = split.iloc[start:start + len(available[model].core_results)].reset_index(drop = True)
+                    start += len(available[model].core_results)
+            for model, SR in available.items():
+                jobs.update({(model, core): job for core, job in SR.SR_jobs(keys[model]).items()})
+        results = {}
+        if jobs:
+            #### Errors are raised after run_SR_jobs has cancelled the other jobs, so no model keeps partial results
+            client = start_cluster()
+            print(f'Calculating sedimentation rates for {len(jobs)} combinations of model and sediment core')
+            results = run_SR_jobs(client, jobs)
+        self.SR_model_results = {}
+        for model, SR in self.SR_models.items():
+            if model in available:
+                SR.collect_SR({core: result for (job_model, core), result in results.items() if job_model == model})
+            else:
+                SR.calculating_SR()
+            self.SR_model_results[model] = getattr(SR, f'SR_model_result_{model}')
+            setattr(self, f'SR_model_result_{model}', self.SR_model_results[model])
+
+def sed_rate_array(ages, mode):
+    """
+    Helper function to calculate sedimentation rate for an entire core as one shifted-difference operation
+    
+    ('naive')      - Naive approach: sedimentation rate(x) = (depth(x+1)-depth(x)) / (age(x+1)-age(x))
+    ('move_three') - Moving average over three depths: sedimentation rate(x) = (depth(x+1)-depth(x-1)) / (age(x+1)-age(x-1))
+    ('move_five')  - Moving average over five depths: sedimentation rate(x) = (depth(x+2)-depth(x-2)) / (age(x+2)-age(x-2))
+    ('move_k')     - Moving average over k depths (k odd): sedimentation rate(x) = (depth(x+k//2)-depth(x-k//2)) / (age(x+k//2)-age(x-k//2))
+    
+    Depths without a complete window at the edges of the core, depths with at least one negative rate
+    and unknown modes give rows of zeros; infinite rates are set to zero
+    
+    parameters:
+    @ages: array (depth x iteration) with the age iterations of one sediment core, sorted by depth
+    @mode: string of mode that should be used for sedimentation rate calculation; options are 'naive',
+    'move_three', 'move_five', and 'move_k' for any odd window k
+    
+    returns:
+    @rates: float array (depth x iteration) with the sedimentation rate for every iteration
+    """
+    return sed_rate_block(ages, mode)
+
+def sed_rate_block(ages, mode, start = 0, stop = None, columns = None):
+    """
+    Helper function to calculate sedimentation rate for a block of depths of one core (see sed_rate_array), 
+    reading only the depths of the block and the depths around it that are needed for the window of the mode
+    
+    parameters:
+    @ages: array (depth x iteration) with the age iterations of one sediment core, sorted by depth; 
+    can be a memory-mapped array
+    @mode: string of mode that should be used for sedimentation rate calculation; options are 'naive',
+    'move_three', 'move_five', and 'move_k' for any odd window k
+    @start: position of first depth of the block; default value: 0
+    @stop: position after the last depth of the block; default value: None (until the end of the core)
+    @columns: boolean array or positions of the iterations that should be used; default value: None (all iterations)
+    
+    returns:
+    @rates: float array (block depth x iteration) with the sedimentation rate for every iteration
+    """
+    return sed_rate_modes_block(ages, [mode], start, stop, columns)[0]
+
+def sed_rate_modes_block(ages, modes, start = 0, stop = None, columns = None, zero_negative = True):
+    """
+    Helper function to calculate sedimentation rates of several modes for a block of depths of one core (see sed_rate_array)
+    
+    The block is read once with the depths around it that are needed for the widest window, and the shifted 
+    differences of every window width are calculated once and shared by all modes with that width
+    
+    parameters:
+    @ages: array (depth x iteration) with the age iterations of one sediment core, sorted by depth; 
+    can be a memory-mapped array
+    @modes: list of modes that should be used for sedimentation rate calculation
+    @start: position of first depth of the block; default value: 0
+    @stop: position after the last depth of the block; default value: None (until the end of the core)
+    @columns: boolean array or positions of the iterations that should be used; default value: None (all iterations)
+    @zero_negative: boolean value, if depths with at least one negative rate are set to zero; only switched off 
+    when the iterations of a depth are processed in several chunks; default value: True
+    
+    returns:
+    @rates: list of float arrays (block depth x iteration) with the sedimentation rate for every iteration, 
+    in the order of the modes
+    """
+    n_depths = len(ages)
+    stop = n_depths if stop is None else min(stop, n_depths)
+    n_iterations = ages.shape[1] if columns is None else len(np.arange(ages.shape[1])[columns])
+    windows = [sr_window(mode) for mode in modes]
+    known = [window for window in windows if window is not None]
+    if known:
+        #### One read of the block including the depths needed by the widest window
+        low = max(start - max(window[0] for window in known), 0)
+        high = min(stop + max(window[1] for window in known), n_depths)
+        block = np.asarray(ages[low:high], dtype = np.float64)
+        if columns is not None:
+            block = block[:,columns]
+    differences = {}
+    out = []
+    for window in windows:
+        rates = np.zeros((max(stop - start, 0), n_iterations), dtype = np.float64)
+        out.append(rates)
+        if window is None:
+            continue
+        lag, lead = window
+        span = lag + lead
+        #### Depths of the block that have a complete window
+        first = max(start, lag)
+        last = min(stop, n_depths - lead)
+        if first >= last:
+            continue
+        if span not in differences:
+            #### differences[span][j] = age(low+j+span) - age(low+j)
+            differences[span] = block[span:] - block[:len(block) - span]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            rates[first - start:last - start] = span / differences[span][first - lag - low:last - lag - low]
+        if zero_negative:
+            rates[(rates < 0).any(axis = 1)] = 0
+        rates[np.isinf(rates)] = 0
+    return out
+
+def summarize_rates(ages, modes, start = 0, stop = None, columns = None, approximate = False, sketch_size = SKETCH_SIZE, posterior = None):
+    """
+    Helper function to calculate and summarize the sedimentation rates of several modes for a block of depths of one core
+    
+    In the approximate mode, the iterations are processed in chunks of sketch_size iterations that are merged into 
+    one quantile sketch per mode; depths with a negative rate in any chunk are set to zero at the end
+    
+    parameters:
+    @ages: array (depth x iteration) with the age iterations of one sediment core, sorted by depth; 
+    can be a memory-mapped array
+    @modes: list of modes that should be used for sedimentation rate calculation
+    @start: position of first depth of the block; default value: 0
+    @stop: position after the last depth of the block; default value: None (until the end of the core)
+    @columns: boolean array or positions of the iterations that should be used; default value: None (all iterations)
+    @approximate: boolean value, if the quantiles should be approximated with QuantileSketch; default value: False
+    @sketch_size: number of values per depth and level of the sketch; default value: SKETCH_SIZE
+    @posterior: list of arrays (block depth x iteration) per mode, such as float32 arrays, into which the 
+    sedimentation rates are written; default value: None (rates are not kept)
+    
+    returns:
+    @summaries: list of arrays with one row per depth and the columns of confidence_intervals, in the order of the modes
+    """
+    if not approximate:
+        summaries = []
+        for position, rates in enumerate(sed_rate_modes_block(ages, modes, start, stop, columns)):
+            if posterior is not None:
+                posterior[position][:] = rates
+            summaries.append(confidence_intervals(rates))
+        return summaries
+    stop = len(ages) if stop is None else min(stop, len(ages))
+    positions = np.arange(ages.shape[1])
+    if columns is not None:
+        positions = positions[columns]
+    sketches = [QuantileSketch(max(stop - start, 0), sketch_size) for mode in modes]
+    negative = [np.zeros(max(stop - start, 0), dtype = bool) for mode in modes]
+    for chunk in range(0, len(positions), sketch_size):
+        chunk_rates = sed_rate_modes_block(ages, modes, start, stop, positions[chunk:chunk + sketch_size], zero_negative = False)
+        for position, (sketch, is_negative, rates) in enumerate(zip(sketches, negative, chunk_rates)):
+            is_negative |= (rates < 0).any(axis = 1)
+            sketch.update(rates)
+            if posterior is not None:
+                posterior[position][:,chunk:chunk + sketch_size] = rates
+    summaries = []
+    for position, (sketch, is_negative) in enumerate(zip(sketches, negative)):
+        summary = sketch.confidence_intervals()
+        summary[is_negative] = 0
+        summaries.append(summary)
+        if posterior is not None:
+            posterior[position][is_negative] = 0
+    return summaries
+
+def complete_columns(ages, block_size):
+    """
+    Helper function to find the iterations without missing values of an array on disk, read block by block
+    
+    parameters:
+    @ages: array (depth x iteration) that can be sliced by depths, e.g. memory-mapped array, FrameIterationRows or StoredIterationRows
+    @block_size: number of depths that are read at once
+    
+    returns:
+    @complete: boolean array marking iterations without missing values, same as dropna(axis = 1)
+    """
+    complete = np.ones(ages.shape[1], dtype = bool)
+    for start in range(0, len(ages), block_size):
+        complete &= ~np.isnan(np.asarray(ages[start:start + block_size], dtype = np.float64)).any(axis = 0)
+    return complete
+
+class FrameIterationRows(object):
+    def __init__(self, core_results, rows, columns):
+        """
+        Iterations of one core that are held as dataframe, sliced like an array (depth x iteration): a slice of depths 
+        only converts the rows of these depths, so the out-of-core mode reads the dataframe block by block without a copy of the core
+
+        parameters:
+        @self.core_results: model-specific 10,000 iteration results with MeasurementID and model name added
+        @self.rows: integer array with the positions of the depths of the core, sorted by depth
+        @columns: labels of the iteration columns
+
+        returns:
+        @self.shape: tuple with the number of depths and iterations
+        """
+        self.core_results = core_results
+        self.rows = np.asarray(rows)
+        self.column_positions = core_results.columns.get_indexer(columns)
+        self.shape = (len(self.rows), len(self.column_positions))
+
+    def __len__(self):
+        """
+        Helper function to get the number of depths
+        """
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        """
+        Function to read a range of depths
+
+        parameters:
+        @rows: slice of depths
+
+        returns:
+        @ages: float64 array (depth x iteration) with the iterations of the depths
+        """
+        if rows.step not in (None, 1):
+            raise Exception('Only ranges of consecutive depths can be read from the iterations')
+        return self.core_results.iloc[self.rows[rows], self.column_positions].to_numpy(dtype = np.float64)
+
+def sed_rate_out_of_core(ages, mode, block_size, summary_path = None, columns = None, approximate = False, sketch_size = SKETCH_SIZE, 
+                         posterior = None):
+    """
+    Function to calculate and summarize sedimentation rates of one core block by block, e.g. from an array on disk; 
+    summaries are written out after each block
+    
+    parameters:
+    @ages: array (depth x iteration) that can be sliced by depths, such as a memory-mapped array, FrameIterationRows or 
+    StoredIterationRows, or string with the location of a .npy file with the age iterations of one sediment core, sorted by depth
+    @mode: string of mode that should be used for sedimentation rate calculation; options are 'naive',
+    'move_three', 'move_five', and 'move_k' for any odd window k, or a list of modes, which share one read of each block
+    @block_size: number of depths per block
+    @summary_path: string with the location of the .npy file for the summaries, in which '{mode}' is replaced by the mode; 
+    default value: None (kept in memory)
+    @columns: boolean array or positions of the iterations that should be used; default value: None (all iterations)
+    @approximate: boolean value, if the quantiles should be approximated with QuantileSketch; default value: False
+    @sketch_size: number of values per depth and level of the sketch; default value: SKETCH_SIZE
+    @posterior: list of arrays (depth x iteration) per mode, such as memory-mapped float32 arrays, into which the 
+    sedimentation rates are written block by block; default value: None (rates are not kept)
+    
+    returns:
+    @summary: array with one row per depth and the columns of confidence_intervals, or a list of these arrays 
+    in the order of the modes if a list of modes is given
+    """
+    if isinstance(ages, str):
+        ages = np.load(ages, mmap_mode = 'r')
+    modes = sr_modes(mode)
+    n_depths = len(ages)
+    summaries = []
+    for sr_mode in modes:
+        if summary_path is None:
+            summaries.append(np.empty((n_depths, 6), dtype = np.float64))
+        else:
+            summaries.append(np.lib.format.open_memmap(summary_path.replace('{mode}', sr_mode), mode = 'w+', 
+                                                       dtype = np.float64, shape = (n_depths, 6)))
+    for start in range(0, n_depths, block_size):
+        stop = min(start + block_size, n_depths)
+        block_posterior = None if posterior is None else [rates[start:stop] for rates in posterior]
+        for summary, block_summary in zip(summaries, summarize_rates(ages, modes, start, stop, columns, approximate, sketch_size, block_posterior)):
+            summary[start:stop] = block_summary
+            if isinstance(summary, np.memmap):
+                summary.flush()
+    if isinstance(mode, str):
+        return summaries[0]
+    return summaries
+
+def run_SR_jobs(client, jobs, max_in_flight = None, function = None):
+    """
+    Helper function to calculate sedimentation rates for many jobs from one queue on the shared cluster
+    
+    Jobs are submitted largest first and a new job is only submitted when another one has finished, so that 
+    the data held by the cluster stays bounded, while the scheduler lets idle workers steal queued jobs
+    
+    parameters:
+    @client: dask client connected to the shared local cluster
+    @jobs: dictionary with tuples of the arguments for sed_rate_multi (input dataframe, mode, ...) indexed by a job key, such as the CoreID
+    @max_in_flight: maximum number of jobs that are submitted at the same time; default value: None (twice the number of worker threads)
+    @function: function that is called with the arguments of each job; default value: None (sed_rate_multi)
+    
+    returns:
+    @results: dictionary with the output of the function indexed by the job key
+    """
+    if function is None:
+        function = sed_rate_multi
+    if max_in_flight is None:
+        max_in_flight = 2 * max(sum(client.nthreads().values()), 1)
+    #### Smallest job first in the list, so that pop() takes the largest remaining job
+    queue = sorted(jobs, key = lambda key: jobs[key][0].size)
+    submitted = {}
+    running = as_completed()
+    def submit_next():
+        key = queue.pop()
+        frame, *arguments = jobs[key]
+        future = client.submit(function, frame, *arguments, pure = False, priority = frame.size)
+        submitted[future.key] = key
+        running.add(future)
+    for _ in range(min(max_in_flight, len(queue))):
+        submit_next()
+    results = {}
+    try:
+        for future in running:
+            results[submitted.pop(future.key)] = future.result()
+            future.release()
+            if queue:
+                submit_next()
+    except:
+        client.cancel(list(running.futures))
+        raise
+    return results
+
+def sed_rate_multi(core_results, mode, approximate = False, sketch_size = SKETCH_SIZE, keep_posterior = False):
     """
     Helper function to work with dask to calculate sedimentation rate based on the mode selected
     
     parameters:
     @core_results: model-specific 10,000 iteration results with MeasurementID and model name added
     @mode: string of mode that should be used for sedimentation rate calculation; options are 'naive',
-    'move_three', and 'move_five' 
+    'move_three', 'move_five', and 'move_k' for any odd window k, or a list of modes, which share one read of the iterations
+    @approximate: boolean value, if the quantiles should be approximated with QuantileSketch; default value: False
+    @sketch_size: number of values per depth and level of the sketch; default value: SKETCH_SIZE
+    @keep_posterior: boolean value, if the sedimentation rate iterations should be returned as well; default value: False
     
     returns:
-    @sed_frame: numpy array with 10,000 results from the sedimentation rate calculation
-    """
-    ages = core_results.copy()
-    core_results.reset_index(inplace = True)
-    #####
-    sed_frame = pd.DataFrame()
-    sedimentation_rate = []
-    for i in range(len(ages)):       
-        try:        
-            if mode == 'naive':          ## ('naive') - Naive approach: sedimentation rate(x) = (depth(x)-depth(x-1)) / (age(x)-age(x-1))
-                sedimentation_step = pd.DataFrame(np.asarray([1/(ages.iloc[i+1] - ages.iloc[i])], dtype = np.float64))
-                if sedimentation_step.mean().min() < 0:
-                    sedimentation_step = pd.DataFrame(np.asarray([[0] * len(ages.columns)], dtype = np.float64))
-                sed_frame = pd.concat([sed_frame,sedimentation_step])
-    
-            elif mode == 'move_three':   ## ('move_three') - Moving average over three depths: sedimentation rate(x) = (depth(x+1)-depth(x-1)) / (age(x+1)-age(x-1))
-                sedimentation_step = pd.DataFrame(np.asarray([2/(ages.iloc[i+1] - ages.iloc[i-1])], dtype = np.float64))
-                if sedimentation_step.mean().min() < 0:
-                    sedimentation_step = pd.DataFrame(np.asarray([[0] * len(ages.columns)], dtype = np.float64))
-                sed_frame = pd.concat([sed_frame,sedimentation_step])
-    
-            elif mode == 'move_five':    ## ('move_five') - Moving average over five depths: sedimentation rate(x) = (depth(x+2)-depth(x-2)) / (age(x+2)-age(x-2))
-                sedimentation_step = pd.DataFrame(np.asarray([4/(ages.iloc[i+2] - ages.iloc[i-2])], dtype = np.float64))
-                if sedimentation_step.mean().min() < 0:
-                    sedimentation_step = pd.DataFrame(np.asarray([[0] * len(ages.columns)], dtype = np.float64))
-                sed_frame = pd.concat([sed_frame,sedimentation_step])
-            
-            else: 
-                sedimentation_step = pd.DataFrame(np.asarray([[0] * len(ages.columns)], dtype = np.float64))
-                sed_frame = pd.concat([sed_frame,sedimentation_step])
-    
-        except:
-            sedimentation_step = pd.DataFrame(np.asarray([[0] * len(ages.columns)], dtype = np.float64))
-            sed_frame = pd.concat([sed_frame,sedimentation_step])
-    ####
-    sed_frame.reset_index(drop = True, inplace = True)
-    sed_frame.replace([np.inf, -np.inf], 0, inplace=True)
-    sed_frame = sed_frame.apply(confidence_intervals_multi, axis = 1, result_type='expand')
-    sed_frame[['measurementid','model_name']] = core_results[['measurementid','model_name']]
-    sed_frame['SR_mode'] = mode
-    
-    return sed_frame.to_numpy()
+    @sed_frame: numpy array with 10,000 results from the sedimentation rate calculation; for a list of modes, 
+    the results of each mode follow each other in the order of the modes
+    @posterior: list of float32 arrays (depth x iteration) with the sedimentation rate iterations of each mode, 
+    only returned with keep_posterior
+    """
+    modes = sr_modes(mode)
+    posterior = None
+    if keep_posterior:
+        posterior = [np.empty(core_results.shape, dtype = np.float32) for sr_mode in modes]
+    summaries = summarize_rates(core_results.to_numpy(dtype = np.float64), modes, approximate = approximate, 
+                                sketch_size = sketch_size, posterior = posterior)
+    return SR_output(core_results.index, modes, summaries, posterior)
+
+def SR_output(index, modes, summaries, posterior = None):
+    """
+    Helper function to combine the summarized sedimentation rates of one core with MeasurementID, model name and mode
+    
+    parameters:
+    @index: multiindex with MeasurementID and model name of every depth of the core
+    @modes: list of modes that were calculated
+    @summaries: list of arrays with the summarized sedimentation rates in the order of the modes
+    @posterior: list of float32 arrays with the sedimentation rate iterations, which are returned as well; default value: None
+    
+    returns:
+    @sed_frame: numpy array with the results of all modes, see sed_rate_multi
+    @posterior: list of float32 arrays, only returned if given
+    """
+    index = index.to_frame(index = False)
+    out = []
+    for sr_mode, summary in zip(modes, summaries):
+        sed_frame = pd.DataFrame(summary)
+        sed_frame[['measurementid','model_name']] = index[['measurementid','model_name']]
+        sed_frame['SR_mode'] = sr_mode
+        out.append(sed_frame.to_numpy())
+    
+    if posterior is not None:
+        return np.concatenate(out), posterior
+    return np.concatenate(out)
+
+def sed_rate_chunked(client, core_results, mode, chunk_size, approximate = False, sketch_size = SKETCH_SIZE, keep_posterior = False):
+    """
+    Function to calculate sedimentation rates of one long core in parallel: the core is split into chunks of depths, 
+    which are sent to the workers together with the depths around them that the windows of the modes need (halo), 
+    and the results are put back together in the order of the depths; the output is identical to sed_rate_multi
+    
+    parameters:
+    @client: dask client connected to the shared local cluster
+    @core_results: iterations of one core sorted by depth with the index of sed_rate_multi
+    @mode: string of mode or list of modes that should be used for sedimentation rate calculation
+    @chunk_size: number of depths per job
+    @approximate: boolean value, if the quantiles should be approximated with QuantileSketch; default value: False
+    @sketch_size: number of values per depth and level of the sketch; default value: SKETCH_SIZE
+    @keep_posterior: boolean value, if the sedimentation rate iterations should be returned as well; default value: False
+    
+    returns:
+    @sed_frame: numpy array with the results from the sedimentation rate calculation, see sed_rate_multi
+    @posterior: list of float32 arrays with the sedimentation rate iterations, only returned with keep_posterior
+    """
+    modes = sr_modes(mode)
+    ages = core_results.to_numpy(dtype = np.float64)
+    n_depths = len(ages)
+    windows = [sr_window(sr_mode) for sr_mode in modes if sr_window(sr_mode) is not None]
+    lag = max([window[0] for window in windows], default = 0)
+    lead = max([window[1] for window in windows], default = 0)
+    jobs = {}
+    for start in range(0, n_depths, chunk_size):
+        stop = min(start + chunk_size, n_depths)
+        #### The edges of a halo that is cut off by the core ends match the edges of the core
+        low = max(start - lag, 0)
+        high = min(stop + lead, n_depths)
+        jobs[start] = (ages[low:high], modes, start - low, stop - low, approximate, sketch_size, keep_posterior)
+    results = run_SR_jobs(client, jobs, function = sed_rate_chunk)
+    starts = sorted(results)
+    summaries = [np.concatenate([results[start][0][position] for start in starts]) for position in range(len(modes))]
+    posterior = None
+    if keep_posterior:
+        posterior = [np.concatenate([results[start][1][position] for start in starts]) for position in range(len(modes))]
+    return SR_output(core_results.index, modes, summaries, posterior)
+
+def sed_rate_chunk(ages, modes, start, stop, approximate = False, sketch_size = SKETCH_SIZE, keep_posterior = False):
+    """
+    Helper function to work with dask to calculate and summarize sedimentation rates for one chunk of depths
+    
+    parameters:
+    @ages: array with the age iterations of the chunk and its halo
+    @modes: list of modes that should be used for sedimentation rate calculation
+    @start: position of first depth of the chunk within ages
+    @stop: position after the last depth of the chunk within ages
+    @approximate: boolean value, if the quantiles should be approximated with QuantileSketch; default value: False
+    @sketch_size: number of values per depth and level of the sketch; default value: SKETCH_SIZE
+    @keep_posterior: boolean value, if the sedimentation rate iterations should be returned as well; default value: False
+    
+    returns:
+    @summaries: list of arrays with the summarized sedimentation rates in the order of the modes
+    @posterior: list of float32 arrays with the sedimentation rate iterations, or None
+    """
+    posterior = None
+    if keep_posterior:
+        posterior = [np.empty((stop - start, ages.shape[1]), dtype = np.float32) for sr_mode in modes]
+    return summarize_rates(ages, modes, start, stop, approximate = approximate, sketch_size = sketch_size, posterior = posterior), posterior
 
 def confidence_intervals_multi( g):
     """
@@ -364,10 +1065,5 @@ def confidence_intervals_multi( g):
     @one_sigma_hi: upper boundary value of 1-sigma range of input data
     @two_sigma_hi: upper boundary value of 2-sigma range of input data
     """
-    median = g.median()
-    mean = g.mean()
-    two_sigma_hi = g.quantile(q = 0.954, interpolation = 'nearest') 
-    two_sigma_lo = g.quantile(q = 0.046, interpolation = 'nearest')
-    one_sigma_hi = g.quantile(q = 0.683, interpolation = 'nearest') 
-    one_sigma_lo = g.quantile(q = 0.317, interpolation = 'nearest')
-    return median, mean, two_sigma_lo, one_sigma_lo, one_sigma_hi, two_sigma_hi
+    median, mean, two_sigma_lo, one_sigma_lo, one_sigma_hi, two_sigma_hi = confidence_intervals(g)[0]
+    return median, mean, two_sigma_lo, one_sigma_lo, one_sigma_hi, two_sigma_hi
\ No newline at end of file
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Module within LANDO to summarize the iterations of age-depth models and sedimentation rates
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import numpy as np
+
+#### Quantiles of the 2-sigma and 1-sigma ranges in the order of the summary columns
+SIGMA_QUANTILES = np.array([0.046, 0.317, 0.683, 0.954])
+
+
+def nearest_positions(count, quantiles = SIGMA_QUANTILES):
+    """
+    Helper function to find the position of quantiles within sorted data, identical to
+    pandas quantile(interpolation = 'nearest')
+
+    parameters:
+    @count: number of values per row
+    @quantiles: array with quantiles between 0 and 1; default value: SIGMA_QUANTILES
+
+    returns:
+    @positions: integer array with the position of each quantile in the sorted values
+    """
+    #### pandas hands percentiles to numpy, which divides them by 100 again
+    quantiles = np.true_divide(np.asarray(quantiles, dtype = np.float64) * 100.0, 100)
+    return np.around((count - 1) * quantiles).astype(np.intp)
+
+def confidence_intervals(values):
+    """
+    Function to get basic statistics (median, mean, 1-sigma range, 2-sigma range) for every row
+    of an iteration matrix in one pass; NaN values are skipped
+
+    The values of each row are partitioned once around all required positions instead of being sorted
+    for every quantile. The quantiles follow pandas quantile(interpolation = 'nearest') exactly.
+
+    parameters:
+    @values: array or dataframe (depth x iteration) with the iteration results
+
+    returns:
+    @summary: float array with one row per depth and the columns median, mean, lower boundary of 2-sigma range,
+    lower boundary of 1-sigma range, upper boundary of 1-sigma range, upper boundary of 2-sigma range
+    """
+    values = np.array(values, dtype = np.float64, ndmin = 2)
+    summary = np.full((len(values), 6), np.nan)
+    nan_mask = np.isnan(values)
+    has_nan = nan_mask.any()
+    counts = values.shape[1] - nan_mask.sum(axis = 1)
+    #### Mean has to be calculated before the values are reordered by the partition
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        if has_nan:
+            summary[:,1] = np.where(nan_mask, 0, values).sum(axis = 1) / counts
+        else:
+            summary[:,1] = values.sum(axis = 1) / counts
+    del nan_mask
+    for count in np.unique(counts):
+        if count == 0:
+            continue
+        positions = nearest_positions(count)
+        middle = [(count - 1) // 2, count // 2]
+        if has_nan:
+            rows = counts == count
+            block = values[rows]
+        else:
+            rows = slice(None)
+            block = values
+        block.partition(np.unique(np.concatenate((positions, middle))), axis = 1)
+        summary[rows,0] = (block[:,middle[0]] + block[:,middle[1]]) / 2
+        summary[rows,2:] = block[:,positions]
+    return summary
+
+#### Number of values per row and level that a quantile sketch keeps before the level is compacted
+SKETCH_SIZE = 2048
+
+
+class QuantileSketch(object):
+    def __init__(self, n_rows, sketch_size = SKETCH_SIZE):
+        """
+        Mergeable quantile sketch (compactor hierarchy as in KLL) for every row of an iteration matrix, so that
+        chunks of iterations can be summarized one after the other or on different workers and merged afterwards
+
+        Values on level h stand for 2**h iterations. When a level holds more than sketch_size values per row,
+        it is sorted and every second value is moved to the next level. Each of these compactions changes the rank 
+        of any value by at most 2**h, and level h is compacted at most count / (sketch_size * 2**h) times, so the 
+        rank error of the quantiles is at most ceil(log2(count / sketch_size)) * count / sketch_size, i.e. a relative 
+        rank error of ceil(log2(count / sketch_size)) / sketch_size (e.g. < 0.3 % for 100,000 iterations and the default 
+        sketch size). The bound reached by the actual data is tracked in self.rank_error. The mean is exact.
+
+        parameters:
+        @self.n_rows: number of rows (depths) that are summarized
+        @self.sketch_size: number of values per row and level before the level is compacted; default value: SKETCH_SIZE
+        @self.levels: list of arrays (row x value) with the values of each level, missing values are NaN
+        @self.count: number of values per row that were added
+        @self.total: sum of values per row that were added
+        @self.rank_error: upper bound of the rank error per row that was introduced by the compactions
+        """
+        self.n_rows = n_rows
+        self.sketch_size = sketch_size
+        self.levels = []
+        self.count = np.zeros(n_rows, dtype = np.int64)
+        self.total = np.zeros(n_rows, dtype = np.float64)
+        self.rank_error = np.zeros(n_rows, dtype = np.int64)
+        self.__offsets = []
+
+    def update(self, values):
+        """
+        Function to add a chunk of iterations to the sketch; NaN values are skipped
+
+        parameters:
+        @values: array or dataframe (row x iteration) with the iterations of the chunk
+
+        returns:
+        @self: sketch including the chunk
+        """
+        values = np.array(values, dtype = np.float64, ndmin = 2)
+        if len(values) != self.n_rows:
+            raise Exception(f'The chunk has {len(values)} rows, but the sketch summarizes {self.n_rows} rows')
+        nan_mask = np.isnan(values)
+        self.count += values.shape[1] - nan_mask.sum(axis = 1)
+        self.total += np.where(nan_mask, 0, values).sum(axis = 1)
+        self.__add(0, values)
+        self.__compact()
+        return self
+
+    def merge(self, other):
+        """
+        Function to merge another sketch of the same rows into this sketch
+
+        parameters:
+        @other: QuantileSketch of the same rows, e.g. of another chunk of iterations
+
+        returns:
+        @self: merged sketch
+        """
+        if other.n_rows != self.n_rows:
+            raise Exception(f'Sketches of {other.n_rows} and {self.n_rows} rows cannot be merged')
+        self.count += other.count
+        self.total += other.total
+        self.rank_error += other.rank_error
+        for level, values in enumerate(other.levels):
+            self.__add(level, values)
+        self.__compact()
+        return self
+
+    def __add(self, level, values):
+        """
+        Helper function to append values to a level
+        """
+        while len(self.levels) <= level:
+            self.levels.append(np.empty((self.n_rows, 0), dtype = np.float64))
+            self.__offsets.append(0)
+        self.levels[level] = np.concatenate((self.levels[level], values), axis = 1)
+
+    def __compact(self):
+        """
+        Helper function to compact all levels that hold more values than the sketch size
+        """
+        level = 0
+        rows = np.arange(self.n_rows)
+        while level < len(self.levels):
+            if self.levels[level].shape[1] > self.sketch_size:
+                #### NaN values are sorted to the end of each row
+                values = np.sort(self.levels[level], axis = 1)
+                valid = values.shape[1] - np.isnan(values).sum(axis = 1)
+                pairs = valid // 2
+                #### Alternating offset, so that compactions do not always favour the smaller or larger value
+                offset = self.__offsets[level]
+                self.__offsets[level] = 1 - offset
+                kept = values[:,offset:2 * pairs.max():2].copy()
+                kept[np.arange(kept.shape[1]) >= pairs[:,None]] = np.nan
+                leftover = np.where(valid % 2 == 1, values[rows,np.maximum(valid - 1, 0)], np.nan)
+                self.levels[level] = leftover[:,None]
+                self.rank_error += np.where(pairs > 0, 2 ** level, 0)
+                self.__add(level + 1, kept)
+            level += 1
+
+    def error_bound(self):
+        """
+        Function to get the relative rank error of the quantiles that is guaranteed for the data in the sketch
+
+        returns:
+        @error: array with the maximum deviation of the rank of each quantile as fraction of the iterations per row
+        """
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return self.rank_error / self.count
+
+    def confidence_intervals(self):
+        """
+        Function to get basic statistics (median, mean, 1-sigma range, 2-sigma range) for every row from the sketch;
+        without compactions the result is identical to confidence_intervals
+
+        returns:
+        @summary: float array with one row per depth and the same columns as confidence_intervals
+        """
+        summary = np.full((self.n_rows, 6), np.nan)
+        if not self.levels:
+            return summary
+        values = np.concatenate(self.levels, axis = 1)
+        weights = np.concatenate([np.full(values_level.shape, 2.0 ** level) for level, values_level in enumerate(self.levels)], axis = 1)
+        order = np.argsort(values, axis = 1)
+        values = np.take_along_axis(values, order, axis = 1)
+        weights = np.take_along_axis(weights, order, axis = 1)
+        weights[np.isnan(values)] = 0
+        cumulative = np.cumsum(weights, axis = 1)
+        count = self.count
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            summary[:,1] = self.total / count
+        #### Ranks of the two middle values and of the sigma quantiles
+        ranks = np.column_stack(((count - 1) // 2, count // 2, nearest_positions(count[:,None])))
+        picked = np.empty(ranks.shape, dtype = np.float64)
+        for column in range(ranks.shape[1]):
+            position = (cumulative <= ranks[:,column,None]).sum(axis = 1)
+            picked[:,column] = values[np.arange(self.n_rows),np.minimum(position, values.shape[1] - 1)]
+        summary[:,0] = (picked[:,0] + picked[:,1]) / 2
+        summary[:,2:] = picked[:,2:]
+        summary[count == 0] = np.nan
+        return summary
+
+def summarize(values, approximate = False, sketch_size = SKETCH_SIZE):
+    """
+    Function to get basic statistics (median, mean, 1-sigma range, 2-sigma range) for every row of an
+    iteration matrix, either exact or approximate from a quantile sketch that is filled chunk by chunk
+
+    parameters:
+    @values: array or dataframe (depth x iteration) with the iteration results
+    @approximate: boolean value, if the quantiles should be approximated with QuantileSketch; default value: False
+    @sketch_size: number of values per row and level of the sketch, which is also the number of iterations per chunk;
+    default value: SKETCH_SIZE
+
+    returns:
+    @summary: float array with one row per depth and the same columns as confidence_intervals
+    """
+    if not approximate:
+        return confidence_intervals(values)
+    #### Chunks are taken from the dataframe or array as it is, so only one chunk at a time is converted to float64
+    if hasattr(values, 'iloc'):
+        chunks = values.iloc
+    else:
+        values = np.asarray(values)
+        chunks = values = values.reshape(1, -1) if values.ndim < 2 else values
+    sketch = QuantileSketch(len(values), sketch_size)
+    for start in range(0, values.shape[1], sketch_size):
+        sketch.update(chunks[:,start:start + sketch_size])
+    return sketch.confidence_intervals()
+
+def interpolate_iterations(depths, ages, target):
+    """
+    Function to interpolate the iterations of an age-depth model linearly onto other depths, for all iterations at once
+    
+    parameters:
+    @depths: sorted array with the depths of the iterations
+    @ages: array (depth x iteration) with the age iterations
+    @target: array with the depths the iterations should be interpolated onto
+    
+    returns:
+    @values: float array (target depth x iteration); depths outside the range of the model are NaN
+    """
+    depths = np.asarray(depths, dtype = np.float64)
+    ages = np.array(ages, dtype = np.float64, ndmin = 2)
+    target = np.asarray(target, dtype = np.float64)
+    if np.array_equal(depths, target):
+        return ages
+    values = np.full((len(target), ages.shape[1]), np.nan)
+    if len(depths) == 0:
+        return values
+    upper = np.clip(np.searchsorted(depths, target, side = 'right'), 1, max(len(depths) - 1, 1))
+    lower = np.minimum(upper - 1, len(depths) - 1)
+    upper = np.minimum(upper, len(depths) - 1)
+    inside = (target >= depths[0]) & (target <= depths[-1])
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        fraction = (target - depths[lower]) / (depths[upper] - depths[lower])
+    #### Depths of the model are taken as they are, so missing values next to them do not spread
+    exact = depths[lower] == target
+    between = inside & ~exact
+    values[between] = ages[lower[between]] + (ages[upper[between]] - ages[lower[between]]) * fraction[between,None]
+    values[exact] = ages[lower[exact]]
+    return values
+
+def pooled_iterations(members, depths, n_draws = 10000, weights = None, seed = None):
+    """
+    Function to pool the iterations of several age-depth models of one core into one iteration matrix; each model
+    contributes randomly drawn iterations in proportion to its weight, so that the pooled matrix has the size of 
+    one model instead of the iterations of all models side by side
+    
+    parameters:
+    @members: list with a tuple (sorted depths, array (depth x iteration) with the age iterations) per model
+    @depths: array with the depths of the pooled matrix
+    @n_draws: number of iterations of the pooled matrix; default value: 10000
+    @weights: list with the weight of each model; default value: None (every model contributes equally)
+    @seed: seed or numpy Generator for drawing the iterations; default value: None
+    
+    returns:
+    @pooled: float array (depth x n_draws) with the pooled iterations; depths outside the range of a model are NaN 
+    for the iterations of that model
+    """
+    weights = np.ones(len(members)) if weights is None else np.asarray(weights, dtype = np.float64)
+    if len(weights) != len(members) or (weights < 0).any() or weights.sum() <= 0:
+        raise Exception('There has to be one non-negative weight per model and at least one weight above zero')
+    #### Largest remainder method, so the numbers of iterations per model add up to n_draws
+    shares = n_draws * weights / weights.sum()
+    counts = np.floor(shares).astype(np.intp)
+    counts[np.argsort(counts - shares, kind = 'stable')[:n_draws - counts.sum()]] += 1
+    rng = np.random.default_rng(seed)
+    pooled = np.empty((len(depths), n_draws))
+    start = 0
+    for (member_depths, ages), count in zip(members, counts):
+        if count == 0:
+            continue
+        n_iterations = np.shape(ages)[1]
+        columns = np.sort(rng.choice(n_iterations, size = count, replace = count > n_iterations))
+        pooled[:,start:start + count] = interpolate_iterations(member_depths, np.asarray(ages)[:,columns], depths)
+        start += count
+    return pooled
+
+def thinned_positions(n_columns, n_iterations, seed = 0):
+    """
+    Function to draw a fixed number of iterations from the iterations of one core; the drawn iterations are used 
+    for every depth, so that each of them stays a complete age-depth model
+    
+    With more iterations than n_iterations, the iterations are thinned by drawing without replacement. With fewer
+    iterations, every iteration is kept once and the rest is resampled with replacement.
+    
+    parameters:
+    @n_columns: number of iterations of the core
+    @n_iterations: number of iterations that should be drawn
+    @seed: seed or numpy Generator for drawing the iterations; default value: 0
+    
+    returns:
+    @positions: sorted integer array with the positions of the drawn iterations
+    """
+    if n_columns == 0:
+        raise Exception('There are no iterations that could be drawn')
+    rng = np.random.default_rng(seed)
+    if n_columns >= n_iterations:
+        positions = rng.choice(n_columns, size = n_iterations, replace = False)
+    else:
+        positions = np.concatenate((np.arange(n_columns), rng.choice(n_columns, size = n_iterations - n_columns, replace = True)))
+    return np.sort(positions)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures of the tests of LANDO
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from dask.distributed import Client, LocalCluster
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope = 'session')
+def client():
+    """
+    Dask client of a small cluster in this process for the sedimentation rates that are calculated on the cluster
+    """
+    cluster = LocalCluster(n_workers = 1, threads_per_worker = 2, processes = False, dashboard_address = None)
+    client = Client(cluster)
+    yield client
+    client.close()
+    cluster.close()
+
+@pytest.fixture
+def core_ages():
+    """
+    Age iterations (depth x iteration) of one core that increase with depth, with a repeated depth (infinite rates)
+    and a reversal (negative rates)
+    """
+    rng = np.random.default_rng(42)
+    ages = np.cumsum(rng.gamma(2.0, 25.0, size = (12, 40)), axis = 0)
+    ages[5] = ages[4]
+    ages[8,3] = ages[7,3] - 10
+    return ages
+
+@pytest.fixture
+def bacon_results():
+    """
+    Iteration results of three cores in the input format of AggDataBacon, with the rows not sorted by depth
+    """
+    rng = np.random.default_rng(1)
+    rows = []
+    for core, n_depths in [('EN10', 12), ('EN2', 9), ('012', 15)]:
+        for depth in range(n_depths):
+            rows.append([f'{core} {depth * 2}'] + list(depth * 30 + rng.normal(0, 10, 50)))
+    data = pd.DataFrame(rows, columns = ['depth'] + [f'iter_{i}' for i in range(50)])
+    return data.sample(frac = 1, random_state = 3).reset_index(drop = True)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the column-wise normalization of age determination data
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from psycopg2.extras import NumericRange
+from src.age_input import age_bounds, exact_ages, surface_samples, surface_mask, calibration_curves
+
+
+def test_age_bounds_of_ranges_and_strings():
+    values = pd.Series([NumericRange(100, 100, '[]'), NumericRange(45000, None), '>45000', '<300', ' 1200 ', 'abc', None],
+                       index = range(10, 17))
+    bounds = age_bounds(values)
+    assert bounds.index.tolist() == list(range(10, 17))
+    np.testing.assert_array_equal(bounds['lower'], [100, 45000, 45000, np.nan, 1200, np.nan, np.nan])
+    np.testing.assert_array_equal(bounds['upper'], [100, np.nan, np.nan, 300, 1200, np.nan, np.nan])
+
+def test_exact_ages_keep_index_and_integers():
+    data = pd.DataFrame({'age': [NumericRange(100, 100, '[]'), '>45000', '1200', None], 'labid': ['L1', 'L2', 'L3', 'L4']},
+                        index = [3, 1, 7, 5])
+    ages = exact_ages(data)
+    assert ages.index.tolist() == [3, 7] and ages['labid'].tolist() == ['L1', 'L3']
+    assert ages['age'].dtype == np.int64 and ages['age'].tolist() == [100, 1200]
+    assert data['age'].tolist()[1] == '>45000'
+
+def test_surface_samples_are_typed_and_flagged():
+    expedition = pd.DataFrame({'coreid': ['EN1', 'EN2'], 'expeditionyear': [2018, '2019']}, index = [4, 2])
+    columns = ['measurementid', 'labid', 'age', 'thickness', 'reservoir_age', 'coreid', 'compositedepth', 'is_surface']
+    surface = surface_samples(expedition, columns)
+    assert list(surface.columns) == columns
+    assert surface['measurementid'].tolist() == ['EN1 0', 'EN2 0'] and surface['labid'].tolist() == ['EN1_Surface', 'EN2_Surface']
+    assert surface['age'].tolist() == [-68, -69] and surface['age'].dtype == np.int64
+    assert surface['thickness'].tolist() == [0, 0] and surface['compositedepth'].tolist() == [0.0, 0.0]
+    all_ages = pd.concat([surface, pd.DataFrame({'labid': ['L1'], 'is_surface': [np.nan]})], ignore_index = True)
+    assert surface_mask(all_ages).tolist() == [True, True, False]
+    #### Age determination data of earlier versions has no column is_surface
+    assert surface_mask(all_ages.drop(columns = 'is_surface')).tolist() == [True, True, False]
+
+@pytest.mark.parametrize('default_curve, hemisphere, expected', [('IntCal20', 'NH', ['IntCal20', 'IntCal20', 'Marine20']),
+                                                                 ('Marine20', 'SH', ['Marine20', 'SHCal20', 'Marine20']),
+                                                                 ('none', 'NH', ['none', 'IntCal20', 'Marine20'])])
+def test_calibration_curves_by_category_and_bounds(default_curve, hemisphere, expected):
+    all_ages = pd.DataFrame({'material_category': ['14C sediment', '14C terrestrial fossil', '14C marine fossil', 
+                                                   '14C sediment', '14C sediment', '14C sediment', 'OSL', 'other'],
+                             'material_description': ['bulk'] * 7 + ['derived surface age'],
+                             #### Within the bounds, above the upper bound, below the lower bound after the reservoir age, 
+                             #### younger than today within the error, not radiocarbon and the surface sample
+                             'age': [1000, 2000, 3000, 50100, 575, 150, 1000, -68],
+                             'reservoir_age': [0, 0, 0, 0, 500, 0, 0, 0],
+                             'age_error': [50, 50, 50, 50, 10, 180, 50, 5],
+                             'reservoir_error': [0, 0, 0, 0, 0, 50, 0, 0]},
+                            index = range(20, 28))
+    curves = calibration_curves(all_ages, default_curve, hemisphere)
+    assert curves.index.tolist() == list(range(20, 28))
+    assert curves.tolist() == expected + ['none'] * 5
+
+def test_calibration_curves_reject_inputs():
+    all_ages = pd.DataFrame({'material_category': ['14C sediment'], 'material_description': ['bulk'], 'age': [1000],
+                             'reservoir_age': [0], 'age_error': [50], 'reservoir_error': [0]})
+    with pytest.raises(Exception):
+        calibration_curves(all_ages, 'IntCal13')
+    with pytest.raises(Exception):
+        calibration_curves(all_ages, hemisphere = 'EH')
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of reading and aggregating the iteration results of the age-depth models
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import types
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.io as sio
+from src.aggregate_data import read_temage, undatable_measurementid, core_preselection, AggDataUndatable, AggDataBacon, AggDataClam, AggDataReservoir, aggregate_models
+from src.sedi_rate import CalculateSediRate
+from tests.test_summary_stats import pandas_confidence_intervals
+
+
+def write_temage(path, depths, ages, magic = b'LANDOAGE', version = 1):
+    """
+    Writes iterations in the binary layout of the Undatable wrapper (udsummary.m)
+    """
+    with open(path, 'wb') as file:
+        file.write(magic)
+        np.array([version, len(depths), ages.shape[1], 0], dtype = '<u4').tofile(file)
+        np.asarray(depths, dtype = '<f8').tofile(file)
+        np.asarray(ages, dtype = '<f4').tofile(file)
+
+def test_read_temage(tmp_path):
+    depths = np.array([0.5, 1.0, 2.25])
+    ages = np.arange(12, dtype = np.float32).reshape(3, 4) * 10
+    path = str(tmp_path / 'EN1_temage.bin')
+    write_temage(path, depths, ages)
+    read_depths, read_ages = read_temage(path)
+    np.testing.assert_array_equal(read_depths, depths)
+    assert isinstance(read_ages, np.memmap) and read_ages.shape == (3, 4) and read_ages.dtype == np.float32
+    np.testing.assert_array_equal(read_ages, ages)
+    assert undatable_measurementid('EN1', read_depths) == ['EN1 0.5', 'EN1 1', 'EN1 2.25']
+
+@pytest.mark.parametrize('magic, version', [(b'NOTLANDO', 1), (b'LANDOAGE', 2)])
+def test_read_temage_rejects_other_files(tmp_path, magic, version):
+    path = str(tmp_path / 'EN1_temage.bin')
+    write_temage(path, [0.0], np.zeros((1, 2)), magic, version)
+    with pytest.raises(Exception):
+        read_temage(path)
+
+def test_aggregation_matches_pandas(bacon_results):
+    agg = AggDataBacon(bacon_results.copy(), 'No')
+    agg.results_agg()
+    result = agg.age_model_result_Bacon
+    expected = bacon_results.set_index('depth').loc[result['measurementid'].astype(str)]
+    summary = result[['modeloutput_median', 'modeloutput_mean', 'lower_2_sigma', 'lower_1_sigma', 'upper_1_sigma', 'upper_2_sigma']]
+    #### The aggregated ages are cut to whole years
+    np.testing.assert_array_equal(summary.to_numpy(), pandas_confidence_intervals(expected.to_numpy()).astype(int))
+
+def test_core_preselection():
+    coreid = np.array(['EN1', 'EN2', 'EN2', '012'])
+    assert core_preselection('Yes', coreid) == 'Yes'
+    assert core_preselection({'EN2': 'Yes'}, coreid).tolist() == ['No', 'Yes', 'Yes', 'No']
+    all_ages = pd.DataFrame({'coreid': ['EN1', 'EN1', '012'], 'dttp': ['Yes', 'Yes', 'No']})
+    assert core_preselection(all_ages, coreid).tolist() == ['Yes', 'No', 'No', 'No']
+
+def test_preselection_per_core(bacon_results):
+    agg = AggDataBacon(bacon_results, {'EN2': 'Yes', 'EN10': 'No'})
+    agg.results_agg()
+    result = agg.age_model_result_Bacon
+    expected = np.where(result['measurementid'].astype(str).str.startswith('EN2 '), 'Yes', 'No')
+    assert result['preselection'].tolist() == expected.tolist()
+
+@pytest.mark.parametrize('which', ['bulk', 'without'])
+def test_add_reservoir(which):
+    reservoir = AggDataReservoir.__new__(AggDataReservoir)
+    reservoir.reservoir_values = {'EN1': [500.0, 50.0]}
+    all_ages = pd.DataFrame({'coreid': ['EN1', 'EN1', 'EN1', 'EN2'],
+                             'labid': ['EN1_Surface', 'L1', 'L2', 'L3'],
+                             'material_category': ['14C sediment', '14C sediment', '14C plant', '14C sediment'],
+                             'age': [-68, 1000, 2000, 3000],
+                             'reservoir_age': 0,
+                             'reservoir_error': 0,
+                             'compositedepth': [0, 10, 20, 5]})
+    all_ages = reservoir.add_reservoir(all_ages, which)
+    corrected = which == 'bulk'
+    #### The surface sample would become younger than the present, so it is not corrected
+    assert all_ages['reservoir_age'].tolist() == [0, 500 if corrected else 0, 0, 0]
+    assert all_ages['reservoir_error'].tolist() == [0, 50 if corrected else 0, 0, 0]
+    assert all_ages['dttp'].tolist() == (['Yes'] * 3 if corrected else ['No'] * 3) + ['No']
+    assert reservoir.core_dttp == {'EN1': 'Yes' if corrected else 'No', 'EN2': 'No'}
+    assert reservoir.dttp == ('Yes' if corrected else 'No') and reservoir.which == which
+
+def write_undatable(folder, coreid, depths, ages, binary = False):
+    """
+    Writes the summaries and iterations of one core as Undatable writes them, the iterations as .mat file of earlier
+    versions of the wrapper or as binary file
+    """
+    with open(folder / f'{coreid}_admodel.txt', 'w') as file:
+        file.write('Undatable age model\n')
+        file.write('depth\tmedian\tmean\t2s_lo\t1s_lo\t1s_hi\t2s_hi\n')
+        for depth, row in zip(depths, ages):
+            file.write('%f\t' % depth + '\t'.join(str(int(value)) for value in row[:6]) + '\n')
+    if binary:
+        write_temage(str(folder / f'{coreid}_temage.bin'), depths, ages)
+    else:
+        sio.savemat(str(folder / f'{coreid}_temage.mat'), {'tempage': ages, 'other': np.zeros(3)})
+
+def undatable_results(tmp_path, monkeypatch, cores, binary = False, n_iterations = None):
+    """
+    Aggregation of the Undatable results of the cores with random iterations that increase with depth
+    """
+    monkeypatch.chdir(tmp_path)
+    folder = tmp_path / 'Undatable'
+    folder.mkdir()
+    rng = np.random.default_rng(0)
+    ages = {coreid: np.cumsum(rng.uniform(1, 100, size = (len(depths), 8)), axis = 0) for coreid, depths in cores.items()}
+    for coreid, depths in cores.items():
+        write_undatable(folder, coreid, depths, ages[coreid].astype(np.float32) if binary else ages[coreid], binary)
+    prep = types.SimpleNamespace(location_UndatableFolder = 'Undatable', coreid_df = pd.DataFrame({'coreid': list(cores)}))
+    agg = AggDataUndatable(prep, str(tmp_path), 'No', n_iterations = n_iterations)
+    agg.results_agg()
+    return agg, ages
+
+def test_undatable_results(tmp_path, monkeypatch):
+    agg, ages = undatable_results(tmp_path, monkeypatch, {'EN1': [0.0, 2.5, 10.0], 'EN2': [0.125, 1.0]})
+    result = agg.age_model_result_Undatable
+    assert result['measurementid'].tolist() == ['EN1 0', 'EN1 2.5', 'EN1 10', 'EN2 0.125', 'EN2 1']
+    assert result['modeloutput_median'].dtype == np.int64 and (result['model_name'] == 'Undatable').all()
+    np.testing.assert_array_equal(result['modeloutput_median'], np.concatenate([ages['EN1'], ages['EN2']])[:,0].astype(int))
+    iterations = agg.Undatable_core_results
+    np.testing.assert_array_equal(iterations[list(range(8))].to_numpy(), np.concatenate([ages['EN1'], ages['EN2']]))
+    assert iterations['measurementid'].tolist() == result['measurementid'].tolist()
+    assert agg.Undatable_iteration_files == {}
+
+def test_undatable_blocks_from_binary_files(tmp_path, monkeypatch):
+    agg, ages = undatable_results(tmp_path, monkeypatch, {'EN1': np.arange(0, 30, 1.5), 'EN2': [0.125, 1.0, 3.0]}, binary = True)
+    assert sorted(agg.Undatable_iteration_files) == ['EN1', 'EN2']
+    np.testing.assert_array_equal(agg.Undatable_core_results[list(range(8))].to_numpy(), 
+                                  np.concatenate([ages['EN1'], ages['EN2']]).astype(np.float32))
+    in_memory = CalculateSediRate(agg, 'Undatable', ['EN1'], ['naive', 'move_three'], chunk_size = 0)
+    in_memory.calculating_SR()
+    agg.SR_cache = {}
+    #### The iterations of the dataframe are not used, the blocks are read from the binary files
+    agg.Undatable_core_results = agg.Undatable_core_results.copy()
+    agg.Undatable_core_results[list(range(8))] = np.nan
+    blocks = CalculateSediRate(agg, 'Undatable', ['EN1', 'EN2'], ['naive', 'move_three'], block_size = 4)
+    blocks.calculating_SR()
+    #### The categories of the string columns depend on the cores of the calculation
+    labels = {'measurementid': str, 'model_name': str, 'SR_mode': str}
+    result = blocks.SR_model_result_Undatable.astype(labels)
+    expected = in_memory.SR_model_result_Undatable.astype(labels).reset_index(drop = True)
+    pd.testing.assert_frame_equal(result[result['measurementid'].str.startswith('EN1 ')].reset_index(drop = True), expected)
+    assert (result['measurementid'] == 'EN2 0.125').sum() == 2
+
+def test_thinned_undatable_iterations(tmp_path, monkeypatch):
+    agg, ages = undatable_results(tmp_path, monkeypatch, {'EN1': [0.0, 2.5, 10.0], 'EN2': [0.125, 1.0]}, binary = True, n_iterations = 5)
+    #### The binary files hold all iterations, so the out-of-core rates use the thinned iterations of the dataframe
+    assert agg.Undatable_iteration_files == {}
+    iterations = agg.Undatable_core_results
+    columns = [f'V{i}' for i in range(1, 6)]
+    assert set(iterations.columns) == set(columns + ['measurementid', 'model_name'])
+    values = iterations[columns].to_numpy()
+    for core, rows in [('EN1', slice(0, 3)), ('EN2', slice(3, 5))]:
+        positions = [np.flatnonzero(ages[core][0].astype(np.float32) == value)[0] for value in values[rows][0]]
+        np.testing.assert_array_equal(values[rows], ages[core][:,positions].astype(np.float32))
+
+def test_thinned_iterations_per_core(bacon_results):
+    original = bacon_results.set_index('depth')
+    agg = AggDataBacon(bacon_results, 'No', n_iterations = 20, seed = 1)
+    agg.results_agg()
+    core_results = agg.Bacon_core_results
+    columns = [f'V{i}' for i in range(1, 21)]
+    assert set(core_results.columns) == set(columns + ['measurementid', 'model_name'])
+    for measurementid, row in core_results.set_index('measurementid')[columns].iterrows():
+        assert set(row) <= set(original.loc[measurementid])
+    #### The same iterations are drawn for every depth of a core, and the draws of a core do not depend on the other cores
+    en2 = core_results[core_results['measurementid'].str.startswith('EN2 ')]
+    positions = [original.loc['EN2 0'].tolist().index(value) for value in en2[en2['measurementid'] == 'EN2 0'][columns].iloc[0]]
+    np.testing.assert_array_equal(en2[columns].to_numpy(), original.loc[en2['measurementid']].iloc[:,positions].to_numpy())
+    single = AggDataBacon(original[original.index.str.startswith('EN2 ')].reset_index(), 'No', n_iterations = 20, seed = 1)
+    single.results_agg()
+    np.testing.assert_array_equal(single.Bacon_core_results[columns].to_numpy(), en2[columns].to_numpy())
+
+def test_clam_variants_are_combined():
+    rng = np.random.default_rng(4)
+    #### EN1 has two clam variants, EN10 only one, so only EN1 is combined
+    labels = [f'EN1 {depth}-{variant}' for variant in ['smooth_spline', 'linear_interpolation'] for depth in [10, 0, 5]]
+    labels += [f'EN10 {depth}-smooth_spline' for depth in [0, 5]]
+    iterations = np.sort(rng.uniform(0, 1000, size = (len(labels), 6)), axis = 1)
+    clam_core_results = pd.DataFrame(iterations, columns = [f'V{i}' for i in range(1, 7)])
+    clam_core_results.insert(0, 'model_label', labels)
+    agg = AggDataClam(clam_core_results, 'No')
+    agg.results_agg()
+    result = agg.age_model_result_clam
+    assert result['measurementid'].tolist() == ['EN1 0', 'EN1 5', 'EN1 10', 'EN10 0', 'EN10 5']
+    assert result['model_name'].tolist() == ['clam combined'] * 3 + ['smooth spline'] * 2
+    summaries = pandas_confidence_intervals(iterations).astype(int)
+    np.testing.assert_allclose(result.iloc[:3, 1:7].to_numpy(dtype = np.float64), (summaries[[1, 2, 0]] + summaries[[4, 5, 3]]) / 2)
+    core_results = agg.clam_core_results
+    assert core_results['measurementid'].tolist() == result['measurementid'].tolist()
+    #### The iterations of the variants are side by side in alphabetical order of the variants
+    values = core_results[[f'V{i}' for i in range(1, 13)]].to_numpy(dtype = np.float64)
+    np.testing.assert_array_equal(values[0], np.concatenate([iterations[4], iterations[1]]))
+    np.testing.assert_array_equal(values[3], np.concatenate([iterations[6], np.full(6, np.nan)]))
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_aggregate_models_equals_serial(bacon_results, processes):
+    serial = AggDataBacon(bacon_results.copy(), 'No')
+    serial.results_agg()
+    aggregations = {'Bacon': AggDataBacon(bacon_results.copy(), 'No'), 'thinned': AggDataBacon(bacon_results.copy(), 'No', n_iterations = 10)}
+    assert aggregate_models(aggregations, processes = processes) is aggregations
+    pd.testing.assert_frame_equal(aggregations['Bacon'].age_model_result_Bacon, serial.age_model_result_Bacon)
+    pd.testing.assert_frame_equal(aggregations['Bacon'].Bacon_core_results, serial.Bacon_core_results)
+    assert aggregations['thinned'].Bacon_core_results.shape == (36, 12)
+    assert aggregate_models([]) == []
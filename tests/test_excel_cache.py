@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the cache of the sheets of input files
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import datetime
+import os
+import pandas as pd
+from src.excel_cache import CACHE_DIRECTORY, CachedWorkbook
+
+
+def write_workbook(path, age):
+    with pd.ExcelWriter(path) as writer:
+        pd.DataFrame({'measurementid': ['EN1 0', 'EN1 5', 'EN1 10', 'EN1 15', 'EN1 20', 'EN1 25'],
+                      'labid': ['0123', '1e3', 'L3', '12', 'L5', 'L6'],
+                      'age': age,
+                      'age_error': [10, 20, 30, 40, 50, 60]}).to_excel(writer, sheet_name = 'Age', index = False)
+        pd.DataFrame({'coreid': ['EN1'], 'expeditionyear': [2018]}).to_excel(writer, sheet_name = 'Metadata', index = False)
+
+def cached_reads(path):
+    return CachedWorkbook(path).read(), CachedWorkbook(path).read()
+
+def test_cached_read_equals_file(tmp_path):
+    path = str(tmp_path / 'ages.xlsx')
+    #### Numbers, detection limits and strings that look like numbers in one column
+    write_workbook(path, [1200, '>45000', '0123', '1e3', 2.5, None])
+    expected = pd.read_excel(path, sheet_name = None)
+    first, second = cached_reads(path)
+    assert os.listdir(os.path.join(str(tmp_path), CACHE_DIRECTORY, 'ages.xlsx'))
+    for sheet in expected:
+        pd.testing.assert_frame_equal(first[sheet], expected[sheet])
+        pd.testing.assert_frame_equal(second[sheet], expected[sheet])
+    assert [type(value) for value in second['Age']['age']] == [type(value) for value in expected['Age']['age']]
+    assert second['Age']['age'].tolist()[:5] == [1200, '>45000', '0123', '1e3', 2.5]
+
+def test_other_types_are_not_cached(tmp_path):
+    path = str(tmp_path / 'ages.xlsx')
+    write_workbook(path, [1200, datetime.datetime(2018, 7, 1), 300, 400, 500, 600])
+    expected = pd.read_excel(path, sheet_name = 'Age')
+    first, second = cached_reads(path)
+    pd.testing.assert_frame_equal(second['Age'], expected)
+    assert sorted(os.listdir(CachedWorkbook(path).directory)) == ['sheet-1.parquet', 'sheet_names.json']
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the selection of age determination data from the database
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import pandas as pd
+import pytest
+from psycopg2.extras import NumericRange
+from src import get_data
+from src.age_input import exact_ages
+from src.get_data import core_condition, read_ages, AgeFromDBMultiCores, AgeFromDBOneCore
+
+#### EN1 has one exact age and one age with a detection limit, EN2 only an age with a detection limit and EN3 a single exact age
+AGES = pd.DataFrame({'measurementid': ['EN1 10', 'EN1 20', 'EN2 5', 'EN3 5'],
+                     'thickness': 1,
+                     'labid': ['L1', 'L2', 'L3', 'L4'],
+                     'lab_location': 'NaN',
+                     'material_category': '14C sediment',
+                     'material_description': 'bulk',
+                     'material_weight': 'NaN',
+                     'age': [NumericRange(100, 100, '[]'), NumericRange(45000, None), NumericRange(200, None), NumericRange(300, 300, '[]')],
+                     'age_error': 20,
+                     'pretreatment_dating': 'None',
+                     'reservoir_age': 0,
+                     'reservoir_error': 0})
+DRILLING = pd.DataFrame({'coreid': ['EN1', 'EN2', 'EN3'], 'expeditionyear': 2018, 'corelength': [1.0, 2.0, 3.0]})
+
+
+class Connection(object):
+    def close(self):
+        pass
+
+class Engine(object):
+    def connect(self):
+        return Connection()
+
+def fake_read_ages(con, cores = None, exact = True):
+    """
+    Selection of the ages by core and exactness as done by the query of read_ages
+    """
+    ages = AGES if cores is None else AGES[AGES['measurementid'].str.split(' ').str[0].isin(cores)]
+    return (exact_ages(ages) if exact else ages.copy()).reset_index(drop = True)
+
+def fake_read_drilling(con, cores = None):
+    return DRILLING if cores is None else DRILLING[DRILLING['coreid'].isin(cores)].reset_index(drop = True)
+
+def loader(cls, monkeypatch, coreid = None):
+    monkeypatch.setattr(get_data, 'read_ages', fake_read_ages)
+    monkeypatch.setattr(get_data, 'read_exact_ages', lambda con, cores = None: fake_read_ages(con, cores))
+    monkeypatch.setattr(get_data, 'read_drilling', fake_read_drilling)
+    #### The engine is replaced, as there is no database
+    data = cls.__new__(cls)
+    data.engine = Engine()
+    data.coreid = coreid
+    data.get_dates()
+    return data
+
+def test_core_condition_escapes_wildcards():
+    condition, params = core_condition(['EN1', 'a_b%'])
+    assert condition == '(measurementid LIKE :core_0 OR measurementid LIKE :core_1)'
+    assert params == {'core_0': 'EN1 %', 'core_1': 'a\\_b\\% %'}
+    assert core_condition([])[0] == 'FALSE'
+
+def test_read_ages_query(monkeypatch):
+    queries = []
+    def read_sql(query, con, params = None):
+        queries.append((str(query), params))
+        return AGES.copy()
+    monkeypatch.setattr(get_data.pd, 'read_sql', read_sql)
+    assert read_ages(None, ['EN1'])['age'].tolist() == [100, 300]
+    read_ages(None, exact = False)
+    assert queries == [('SELECT * FROM agedetermination WHERE lower(age) = upper(age) AND (measurementid LIKE :core_0)', {'core_0': 'EN1 %'}),
+                       ('SELECT * FROM agedetermination', {})]
+
+def test_multi_cores_keep_cores_with_an_exact_age(monkeypatch):
+    #### Ages with a detection limit are left out before the dates are counted, as in the earlier versions
+    all_ages = loader(AgeFromDBMultiCores, monkeypatch).all_ages
+    assert all_ages['measurementid'].tolist() == ['EN1 0', 'EN1 10', 'EN3 0', 'EN3 5']
+    assert all_ages['is_surface'].tolist() == [True, False, True, False]
+
+@pytest.mark.parametrize('coreid, expected', [('EN1', ['EN1 0', 'EN1 10']), ('EN2', ['EN2 0']), ('EN3', ['EN3 0'])])
+def test_one_core_counts_all_dates(monkeypatch, coreid, expected):
+    #### A single date of the core is dropped, while a date with a detection limit counts as second date
+    assert loader(AgeFromDBOneCore, monkeypatch, coreid).all_ages['measurementid'].tolist() == expected
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the structured key (CoreID, composite depth) behind every MeasurementID
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import numpy as np
+import pandas as pd
+from src.measurement_keys import depth_keys, has_key_index, set_key_index, frame_keys, select_cores, as_categorical
+
+
+def results():
+    return pd.DataFrame({'measurementid': ['EN18 10', 'EN18 2.5', 'EN182 0', 'EN18 2.5', 'EN2 100'],
+                         'value': [1, 2, 3, 4, 5]},
+                        index = [7, 3, 9, 1, 4])
+
+def test_depth_keys():
+    keys = depth_keys(results()['measurementid'])
+    assert keys.index.tolist() == [7, 3, 9, 1, 4]
+    assert keys['coreid'].tolist() == ['EN18', 'EN18', 'EN182', 'EN18', 'EN2']
+    assert isinstance(keys['coreid'].dtype, pd.CategoricalDtype)
+    np.testing.assert_array_equal(keys['compositedepth'], [10.0, 2.5, 0.0, 2.5, 100.0])
+
+def test_set_key_index_sorts_by_numeric_depth():
+    data = set_key_index(results())
+    assert has_key_index(data) and not has_key_index(results())
+    #### Depths are sorted as numbers and rows with the same key keep their order
+    assert data['measurementid'].tolist() == ['EN18 2.5', 'EN18 2.5', 'EN18 10', 'EN182 0', 'EN2 100']
+    assert data['value'].tolist() == [2, 4, 1, 3, 5]
+    assert set_key_index(data) is data
+
+def test_frame_keys_are_positions():
+    data = results()
+    keys = frame_keys(data, sort = True)
+    assert keys.index.tolist() == [1, 3, 0, 2, 4]
+    pd.testing.assert_frame_equal(frame_keys(set_key_index(data)), frame_keys(data, sort = True).reset_index(drop = True))
+
+def test_select_cores_by_exact_coreid():
+    data = results()
+    assert select_cores(data, 'EN18')['value'].tolist() == [1, 2, 4]
+    assert select_cores(set_key_index(data), ['EN182', 'EN2'])['value'].tolist() == [3, 5]
+
+def test_as_categorical_keeps_other_columns():
+    data = results().assign(model_name = 'Bacon', ages = np.arange(5.0))
+    converted = as_categorical(data)
+    assert [isinstance(converted[column].dtype, pd.CategoricalDtype) for column in converted] == [True, False, True, False]
+    assert converted['measurementid'].astype(str).tolist() == data['measurementid'].tolist()
+    assert data['model_name'].dtype != converted['model_name'].dtype
+    assert np.shares_memory(converted['ages'].to_numpy(), data['ages'].to_numpy())
+    assert as_categorical(converted) is converted
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the ragged layout of the iterations of several sediment cores
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import numpy as np
+import pytest
+from src.aggregate_data import AggDataBacon
+from src.ragged_iterations import to_ragged
+
+
+@pytest.fixture
+def core_results(bacon_results):
+    agg = AggDataBacon(bacon_results, 'No')
+    agg.results_agg()
+    core_results = agg.Bacon_core_results.copy()
+    #### One iteration of EN2 is incomplete and is left out for EN2 only
+    core_results.loc[core_results['measurementid'] == 'EN2 4', 'iter_7'] = np.nan
+    return core_results
+
+def test_ragged_equals_dropna(core_results):
+    ragged = to_ragged(core_results)
+    assert list(ragged.cores) == ['012', 'EN10', 'EN2'] and ragged.widths.tolist() == [50, 50, 49]
+    coreid = core_results['measurementid'].str.split(' ').str[0]
+    for core, ages in ragged.items():
+        rows = core_results[coreid == core]
+        depths = rows['measurementid'].str.split(' ').str[1].astype(float)
+        expected = rows.loc[depths.sort_values().index].drop(columns = ['measurementid', 'model_name']).dropna(axis = 1)
+        np.testing.assert_array_equal(ages, expected.to_numpy())
+        np.testing.assert_array_equal(ragged.depths[ragged.rows(core)], np.sort(depths.to_numpy()))
+        assert np.shares_memory(ages, ragged.buffer)
+
+def test_ragged_selected_cores(core_results):
+    ragged = to_ragged(core_results, cores = ['EN2'])
+    assert len(ragged) == 1 and 'EN2' in ragged and 'EN10' not in ragged
+    assert ragged.frame('EN2').shape == (9, 49)
+    with pytest.raises(Exception):
+        ragged['EN10']
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the round trip of results through the Parquet store
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from src import results_store
+from src.aggregate_data import AggDataBacon
+from src.results_store import ResultsStore, StoredIterations
+from src.sedi_rate import CalculateSediRate
+
+
+@pytest.fixture
+def agg(bacon_results):
+    agg = AggDataBacon(bacon_results, {'EN2': 'Yes'})
+    agg.results_agg()
+    return agg
+
+def iteration_values(core_results):
+    return core_results.drop(columns = ['measurementid', 'model_name'])
+
+def test_round_trip(tmp_path, agg):
+    store = ResultsStore(str(tmp_path))
+    assert store.write_model(agg, 'Bacon') == ['iterations', 'age']
+    assert store.models('age') == ['Bacon'] and sorted(store.cores('Bacon')) == ['012', 'EN10', 'EN2']
+    ages = store.read('age', 'Bacon')
+    expected = agg.age_model_result_Bacon
+    assert ages.index.tolist() == expected.index.tolist()
+    np.testing.assert_array_equal(ages.astype(str).to_numpy(), expected[ages.columns].astype(str).to_numpy())
+    iterations = store.read('iterations', 'Bacon')
+    np.testing.assert_array_equal(iteration_values(iterations).to_numpy(), iteration_values(agg.Bacon_core_results).to_numpy())
+
+def test_partial_reads(tmp_path, agg):
+    store = ResultsStore(str(tmp_path))
+    store.write_model(agg, 'Bacon')
+    part = store.read('iterations', 'Bacon', cores = ['EN2'], columns = 3, depths = (4, 10))
+    assert sorted(part.columns) == ['iter_0', 'iter_1', 'iter_2', 'measurementid', 'model_name']
+    assert part.index.get_level_values('compositedepth').tolist() == [4.0, 6.0, 8.0, 10.0]
+    assert set(part.index.get_level_values('coreid')) == {'EN2'}
+
+def test_stored_model(tmp_path, agg):
+    store = ResultsStore(str(tmp_path))
+    store.write_model(agg, 'Bacon')
+    model = store.load_model('Bacon', cores = ['EN10', 'EN2'])
+    assert 'age_model_result_Bacon' not in vars(model)
+    assert model.dttp == 'Yes'
+    preselection = model.age_model_result_Bacon.groupby(level = 'coreid', observed = True)['preselection'].first()
+    assert preselection.astype(str).to_dict() == {'EN10': 'No', 'EN2': 'Yes'}
+    assert model.Bacon_core_results.shape == (21, 52)
+
+def test_iteration_rows_by_row_group(tmp_path, agg, monkeypatch):
+    monkeypatch.setattr(results_store, 'ITERATION_ROW_GROUP', 4)
+    store = ResultsStore(str(tmp_path))
+    store.write_model(agg, 'Bacon', tables = ['iterations'])
+    rows = store.load_model('Bacon').stored_iterations().rows('012')
+    expected = iteration_values(store.read('iterations', 'Bacon', cores = ['012'])).to_numpy()
+    assert rows.shape == expected.shape and len(rows.offsets) == 5
+    np.testing.assert_array_equal(rows.depths, np.arange(15) * 2.0)
+    for start, stop in [(0, 15), (3, 9), (8, 12), (14, 15), (6, 6)]:
+        np.testing.assert_array_equal(rows[start:stop], expected[start:stop])
+    with pytest.raises(Exception):
+        rows[::2]
+
+def test_blocks_from_store(tmp_path, agg, monkeypatch):
+    monkeypatch.setattr(results_store, 'ITERATION_ROW_GROUP', 4)
+    store = ResultsStore(str(tmp_path / 'store'))
+    store.write_model(agg, 'Bacon', tables = ['iterations'])
+    in_memory = CalculateSediRate(agg, 'Bacon', ['EN10'], ['naive', 'move_three'], chunk_size = 0)
+    in_memory.calculating_SR()
+    model = store.load_model('Bacon')
+    blocks = CalculateSediRate(model, 'Bacon', ['EN10'], ['naive', 'move_three'], block_size = 5)
+    assert isinstance(blocks.core_results, StoredIterations)
+    blocks.calculating_SR()
+    #### The iterations are read block by block and never loaded as a whole
+    assert 'Bacon_core_results' not in vars(model)
+    labels = {'measurementid': str, 'model_name': str, 'SR_mode': str}
+    pd.testing.assert_frame_equal(blocks.SR_model_result_Bacon.astype(labels).reset_index(drop = True),
+                                  in_memory.SR_model_result_Bacon.astype(labels).reset_index(drop = True))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the sedimentation rate kernels against the pandas implementation they replace
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import dask
+import numpy as np
+import pandas as pd
+import pytest
+from src import sedi_rate
+from src.aggregate_data import AggDataBacon
+from src.sedi_rate import CalculateSediRate, CalculateSediRateModels, sr_window, sed_rate_array, sed_rate_modes_block, sed_rate_multi, sed_rate_chunked, sed_rate_out_of_core, FrameIterationRows, iteration_labels, run_SR_jobs, DaskClusterManager
+from tests.test_summary_stats import pandas_confidence_intervals
+
+MODES = ['naive', 'move_three', 'move_five', 'move_7']
+
+
+def pandas_rates(ages, mode):
+    """
+    Sedimentation rates as calculated depth by depth with pandas before: span / (age(x+lead) - age(x-lag)),
+    depths with a negative rate are set to zero, infinite rates are zero; depths without a complete window are zero
+    """
+    lag, lead = sr_window(mode)
+    ages = pd.DataFrame(ages)
+    rates = pd.DataFrame(0.0, index = ages.index, columns = ages.columns)
+    for i in range(lag, len(ages) - lead):
+        step = (lag + lead) / (ages.iloc[i + lead] - ages.iloc[i - lag])
+        if step.min() < 0:
+            step[:] = 0
+        rates.iloc[i] = step
+    return rates.replace([np.inf, -np.inf], 0).to_numpy()
+
+def core_frame(ages, core = 'EN1'):
+    """
+    Iterations of one core with the index of MeasurementID and model name that sed_rate_multi expects
+    """
+    index = pd.MultiIndex.from_arrays([[f'{core} {depth}' for depth in range(len(ages))], ['Bacon'] * len(ages)],
+                                      names = ['measurementid', 'model_name'])
+    return pd.DataFrame(ages, index = index)
+
+@pytest.mark.parametrize('mode', MODES)
+def test_rates_match_pandas(core_ages, mode):
+    np.testing.assert_allclose(sed_rate_array(core_ages, mode), pandas_rates(core_ages, mode))
+
+def test_edge_rules(core_ages):
+    naive, move_five, unknown = sed_rate_modes_block(core_ages, ['naive', 'move_five', 'move_two'])
+    #### Depths without a complete window
+    assert (naive[-1] == 0).all()
+    assert (move_five[:2] == 0).all() and (move_five[-2:] == 0).all()
+    #### Repeated depth (infinite rate) and reversal of one iteration (negative rate)
+    assert (naive[4] == 0).all() and (naive[7] == 0).all()
+    assert (naive[3] > 0).all()
+    assert (unknown == 0).all()
+
+@pytest.mark.parametrize('start, stop', [(0, 3), (2, 9), (9, 12), (5, 5)])
+def test_blocks_equal_whole_core(core_ages, start, stop):
+    whole = sed_rate_modes_block(core_ages, MODES)
+    for block, rates in zip(sed_rate_modes_block(core_ages, MODES, start, stop), whole):
+        np.testing.assert_array_equal(block, rates[start:stop])
+
+def test_frame_rows_equal_whole_core(core_ages):
+    #### The rows of the dataframe are not sorted by depth and have other columns besides the iterations
+    order = np.random.default_rng(0).permutation(len(core_ages))
+    frame = pd.DataFrame(core_ages[order])
+    frame.insert(0, 'measurementid', [f'EN1 {depth}' for depth in order])
+    ages = FrameIterationRows(frame, np.argsort(order), frame.columns[1:])
+    assert ages.shape == core_ages.shape
+    np.testing.assert_array_equal(ages[3:7], core_ages[3:7])
+    for block, whole in zip(sed_rate_out_of_core(ages, MODES, 5), sed_rate_out_of_core(core_ages, MODES, len(core_ages))):
+        np.testing.assert_array_equal(block, whole)
+    with pytest.raises(Exception):
+        ages[::2]
+
+def test_sed_rate_multi_matches_pandas(core_ages):
+    output = sed_rate_multi(core_frame(core_ages), MODES)
+    assert len(output) == len(MODES) * len(core_ages)
+    for position, mode in enumerate(MODES):
+        rows = output[position * len(core_ages):(position + 1) * len(core_ages)]
+        np.testing.assert_allclose(rows[:,:6].astype(np.float64), pandas_confidence_intervals(pandas_rates(core_ages, mode)))
+        assert (rows[:,8] == mode).all() and rows[0,6] == 'EN1 0'
+
+def test_sketched_rates(core_ages):
+    exact = sed_rate_out_of_core(core_ages, MODES, 5)
+    for block, whole in zip(sed_rate_out_of_core(core_ages, MODES, 5, approximate = True, sketch_size = 64), exact):
+        np.testing.assert_allclose(block, whole)
+    #### A negative rate in the first chunk of iterations sets the depth to zero in every chunk
+    naive = sed_rate_out_of_core(core_ages, 'naive', 5, approximate = True, sketch_size = 8)
+    assert (naive[[4, 7, 11]] == 0).all() and (naive[3] > 0).all()
+    np.testing.assert_allclose(naive[:,1], exact[0][:,1])
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 12, 50])
+def test_chunks_with_halo_equal_whole_core(client, core_ages, chunk_size):
+    frame = core_frame(core_ages)
+    expected, expected_posterior = sed_rate_multi(frame, MODES, keep_posterior = True)
+    output, posterior = sed_rate_chunked(client, frame, MODES, chunk_size, keep_posterior = True)
+    pd.testing.assert_frame_equal(pd.DataFrame(output), pd.DataFrame(expected))
+    for chunked, whole in zip(posterior, expected_posterior):
+        np.testing.assert_array_equal(chunked, whole)
+
+def test_chunked_core_raises_errors(client, bacon_results, monkeypatch):
+    monkeypatch.setattr(sedi_rate, 'start_cluster', lambda: client)
+    agg = AggDataBacon(bacon_results, 'No')
+    agg.results_agg()
+    agg.Bacon_core_results['iter_3'] = 'x'
+    sr = CalculateSediRate(agg, 'Bacon', ['EN2'], 'naive', chunk_size = 4)
+    with pytest.raises(Exception):
+        sr.calculating_SR()
+    assert not hasattr(sr, 'SR_model_result_Bacon')
+
+def test_kept_posterior(core_ages):
+    output, posterior = sed_rate_multi(core_frame(core_ages), MODES, keep_posterior = True)
+    np.testing.assert_array_equal(output, sed_rate_multi(core_frame(core_ages), MODES))
+    for rates, mode in zip(posterior, MODES):
+        assert rates.dtype == np.float32
+        np.testing.assert_array_equal(rates, sed_rate_array(core_ages, mode).astype(np.float32))
+
+def test_kept_posterior_of_blocks(bacon_results, tmp_path):
+    agg = AggDataBacon(bacon_results, 'No')
+    agg.results_agg()
+    sr = CalculateSediRate(agg, 'Bacon', ['EN2'], MODES, block_size = 4, directory = str(tmp_path), keep_posterior = True)
+    sr.calculating_SR()
+    rows = agg.Bacon_core_results[agg.Bacon_core_results['measurementid'].str.startswith('EN2 ')]
+    depths = rows['measurementid'].str.split(' ').str[1].astype(float).sort_values()
+    ages = rows.loc[depths.index].drop(columns = ['measurementid', 'model_name']).to_numpy(dtype = np.float64)
+    for mode in MODES:
+        posterior = sr.get_SR_posterior('EN2', mode)
+        np.testing.assert_array_equal(posterior.index, depths)
+        np.testing.assert_array_equal(posterior.to_numpy(), sed_rate_array(ages, mode).astype(np.float32))
+    with pytest.raises(Exception):
+        sr.get_SR_posterior('EN10')
+
+def test_jobs_from_one_queue(client, core_ages):
+    jobs = {core: (core_frame(core_ages[:,:n_iterations], core), 'naive') for core, n_iterations in [('EN1', 40), ('EN2', 10), ('EN3', 25)]}
+    results = run_SR_jobs(client, jobs, max_in_flight = 1)
+    assert sorted(results) == ['EN1', 'EN2', 'EN3']
+    for core, (frame, mode) in jobs.items():
+        pd.testing.assert_frame_equal(pd.DataFrame(results[core]), pd.DataFrame(sed_rate_multi(frame, mode)))
+    #### Iterations that are not numbers fail on the cluster, the error reaches the caller
+    jobs['EN4'] = (core_frame(np.full((3, 2), 'x'), 'EN4'), 'naive')
+    with pytest.raises(Exception):
+        run_SR_jobs(client, jobs)
+
+def model_aggs(bacon_results):
+    """
+    Aggregation objects of two models, the second one with the iterations of the first one stretched by two and 
+    without the key index
+    """
+    agg = AggDataBacon(bacon_results.copy(), 'No')
+    agg.results_agg()
+    other = AggDataBacon(bacon_results.copy(), 'No')
+    other.results_agg()
+    hamstr = other.Bacon_core_results.reset_index(drop = True)
+    columns = iteration_labels(hamstr)
+    hamstr[columns] = hamstr[columns] * 2
+    hamstr['model_name'] = 'hamstr'
+    other.hamstr_core_results = hamstr
+    return {'Bacon': agg, 'hamstr': other}
+
+def test_models_from_one_queue(client, bacon_results, monkeypatch):
+    monkeypatch.setattr(sedi_rate, 'start_cluster', lambda: client)
+    coreid = ['EN10', 'EN2', '012']
+    models = CalculateSediRateModels(model_aggs(bacon_results), coreid, ['naive', 'move_three'])
+    models.calculating_SR()
+    for model, agg in model_aggs(bacon_results).items():
+        separate = CalculateSediRate(agg, model, coreid, ['naive', 'move_three'])
+        separate.calculating_SR()
+        expected = getattr(separate, f'SR_model_result_{model}')
+        pd.testing.assert_frame_equal(models.SR_model_results[model], expected)
+        assert getattr(models, f'SR_model_result_{model}') is models.SR_model_results[model]
+    #### Iterations that are not numbers fail on the cluster, no model keeps partial results
+    aggs = model_aggs(bacon_results)
+    aggs['hamstr'].hamstr_core_results['iter_3'] = 'x'
+    failing = CalculateSediRateModels(aggs, coreid, 'naive')
+    with pytest.raises(Exception):
+        failing.calculating_SR()
+    assert not hasattr(failing, 'SR_model_results')
+
+def test_cluster_settings_are_restored(tmp_path):
+    before = dask.config.get('distributed.comm.timeouts.tcp')
+    manager = DaskClusterManager(n_workers = 1, threads_per_worker = 1, spill_directory = str(tmp_path))
+    client = manager.start()
+    try:
+        assert dask.config.get('distributed.comm.timeouts.tcp') == '90s'
+        assert dask.config.get('temporary-directory') == str(tmp_path)
+    finally:
+        manager.shutdown()
+    assert client.status != 'running'
+    assert dask.config.get('distributed.comm.timeouts.tcp') == before
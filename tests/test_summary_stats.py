@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the summaries of iterations against the pandas implementation they replace
+
+Author: Gregor Pfalz
+github: GPawi
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from src.summary_stats import nearest_positions, confidence_intervals, QuantileSketch, summarize, pooled_iterations, thinned_positions
+
+
+def pandas_confidence_intervals(values):
+    """
+    Summary of every row as calculated row by row with pandas before (median, mean, 2-sigma and 1-sigma range)
+    """
+    def row_summary(g):
+        return (g.median(), g.mean(),
+                g.quantile(q = 0.046, interpolation = 'nearest'), g.quantile(q = 0.317, interpolation = 'nearest'),
+                g.quantile(q = 0.683, interpolation = 'nearest'), g.quantile(q = 0.954, interpolation = 'nearest'))
+    return pd.DataFrame(values).apply(row_summary, axis = 1, result_type = 'expand').to_numpy(dtype = np.float64)
+
+@pytest.mark.parametrize('n_iterations', [1, 2, 7, 100, 1001])
+def test_confidence_intervals_match_pandas(n_iterations):
+    values = np.random.default_rng(n_iterations).normal(size = (6, n_iterations))
+    np.testing.assert_allclose(confidence_intervals(values), pandas_confidence_intervals(values))
+
+def test_confidence_intervals_skip_missing_values():
+    values = np.random.default_rng(0).normal(size = (5, 60))
+    values[1,::3] = np.nan
+    values[3,:59] = np.nan
+    values[4] = np.nan
+    np.testing.assert_allclose(confidence_intervals(values), pandas_confidence_intervals(values))
+
+def test_sketch_without_compaction_is_exact():
+    values = np.random.default_rng(1).normal(size = (4, 300))
+    sketch = QuantileSketch(4, sketch_size = 512).update(values[:,:100]).update(values[:,100:])
+    np.testing.assert_allclose(sketch.confidence_intervals(), confidence_intervals(values))
+    assert (sketch.error_bound() == 0).all()
+
+def assert_ranks_within_bound(values, sketch):
+    """
+    Checks that the rank of every approximate quantile deviates from the rank of the exact quantile by at most the
+    error bound of the sketch
+    """
+    summary = sketch.confidence_intervals()
+    ordered = np.sort(values, axis = 1)
+    allowed = sketch.error_bound() * values.shape[1]
+    exact_ranks = nearest_positions(values.shape[1])
+    for row in range(len(values)):
+        ranks = np.searchsorted(ordered[row], summary[row,2:])
+        assert (np.abs(ranks - exact_ranks) <= allowed[row]).all()
+    np.testing.assert_allclose(summary[:,1], values.mean(axis = 1))
+
+@pytest.mark.parametrize('sketch_size', [32, 64, 128])
+def test_sketch_rank_error_within_bound(sketch_size):
+    values = np.random.default_rng(sketch_size).normal(size = (8, 5000))
+    sketch = QuantileSketch(8, sketch_size)
+    for start in range(0, values.shape[1], sketch_size):
+        sketch.update(values[:,start:start + sketch_size])
+    assert (sketch.error_bound() > 0).all()
+    assert (sketch.error_bound() <= np.ceil(np.log2(5000 / sketch_size)) / sketch_size).all()
+    assert_ranks_within_bound(values, sketch)
+    np.testing.assert_array_equal(summarize(values, approximate = True, sketch_size = sketch_size), sketch.confidence_intervals())
+
+def test_sketch_from_dataframe_chunks():
+    values = np.random.default_rng(5).normal(size = (6, 700))
+    from_frame = summarize(pd.DataFrame(values), approximate = True, sketch_size = 64)
+    np.testing.assert_allclose(from_frame, summarize(values, approximate = True, sketch_size = 64))
+
+def test_merged_sketches_within_bound():
+    values = np.random.default_rng(2).normal(size = (3, 2000))
+    left, right = QuantileSketch(3, 64), QuantileSketch(3, 64)
+    for start in range(0, 2000, 250):
+        (left if start < 1000 else right).update(values[:,start:start + 250])
+    merged = left.merge(right)
+    np.testing.assert_array_equal(merged.count, [2000] * 3)
+    assert_ranks_within_bound(values, merged)
+
+@pytest.mark.parametrize('weights, n_draws, expected', [(None, 10, [4, 3, 3]),
+                                                        ([2, 1, 0], 10, [7, 3, 0]),
+                                                        ([1, 1, 1], 1000, [334, 333, 333]),
+                                                        ([5, 3, 2], 7, [4, 2, 1])])
+def test_pooled_iterations_largest_remainder(weights, n_draws, expected):
+    depths = np.array([0.0, 1.0, 2.0])
+    #### Every model has constant ages equal to its number, so the columns of each model can be counted
+    members = [(depths, np.full((3, 20), model)) for model in range(3)]
+    pooled = pooled_iterations(members, depths, n_draws, weights, seed = 0)
+    assert pooled.shape == (3, n_draws)
+    np.testing.assert_array_equal([(pooled[0] == model).sum() for model in range(3)], expected)
+
+def test_pooled_iterations_interpolate_and_reject_weights():
+    members = [(np.array([0.0, 2.0]), np.array([[0.0, 10.0], [2.0, 30.0]]))]
+    pooled = pooled_iterations(members, np.array([0.0, 1.0, 3.0]), n_draws = 2, seed = 0)
+    np.testing.assert_allclose(np.sort(pooled[1]), [1.0, 20.0])
+    assert np.isnan(pooled[2]).all()
+    with pytest.raises(Exception):
+        pooled_iterations(members, np.array([0.0]), weights = [0])
+
+def test_thinned_positions_are_deterministic():
+    first = thinned_positions(1000, 100, seed = [7, 1])
+    np.testing.assert_array_equal(first, thinned_positions(1000, 100, seed = [7, 1]))
+    assert not np.array_equal(first, thinned_positions(1000, 100, seed = [7, 2]))
+    assert len(np.unique(first)) == 100 and (np.diff(first) > 0).all() and first[-1] < 1000
+
+def test_thinned_positions_resample_short_cores():
+    positions = thinned_positions(30, 100, seed = 3)
+    assert len(positions) == 100 and (np.diff(positions) >= 0).all()
+    assert set(np.arange(30)) <= set(positions)
+    with pytest.raises(Exception):
+        thinned_positions(0, 10)